@@ -1 +1 @@
-import pymongofrom collections import defaultdictimport warnings import json from threading import Threadfrom multiprocessing import Process, Queue, Value, Managerfrom .transformation import run as trans_runfrom .batch_update import run as batch_runfrom .transform2 import transform_beta, batch_writefrom ctypes import c_char_pimport time                class DBClient:    """    MongoDB database reader, specific to a collection in the database. This object is typically fairly persistent, i.e.,        sticks around for a while to execute multiple queries.    """    def __init__(self, host=None, port=27017, username=None, password=None, database_name=None, collection_name=None,                 schema_file = None, latest_collection=False):        """        Connect to the specified MongoDB instance, test the connection, then set the specific database and collection.        :param default_param: Dictionary with default parameters. Specified parameters will overwrite default values        :param host: Database connection host name.        :param port: Database connection port number.        :param username: Database authentication username.        :param password: Database authentication password.        :param database_name: Name of database to connect to (do not confuse with collection name).        :param collection_name: Name of database collection from which to query.        """                # Connect immediately upon instantiation.        self.client = pymongo.MongoClient(host=host, port=port, username=username, password=password,                                          connect=True, connectTimeoutMS=5000)        try:            self.client.admin.command('ping')        except pymongo.errors.ConnectionFailure:            warnings.warn("Server not available")            raise ConnectionError("Could not connect to MongoDB.")        if database_name is not None:            self.db = self.client[database_name]            self.database_name = database_name                        if collection_name:                self.collection_name = collection_name                try:                    self.db.create_collection(collection_name)                except:                    pass                self.collection = self.db[collection_name]                            elif latest_collection:                print("No collection name specified. Get the latest collection.")                collection_name = self.get_latest_collection()                self.collection_name = collection_name                self.collection = self.db[collection_name]                        else:                self.collection_name = None                self.collection = None                                            # check for schema. If exists a schema json file, update the collection validator. Otherwise remove the validator                    if schema_file: # add validator                f = open(schema_file)                collection_schema = json.load(f)                self.schema = collection_schema                f.close()                self.db.command("collMod", collection_name, validator=collection_schema)                        # create indices            index_list = ["first_timestamp", "last_timestamp", "starting_x", "ending_x", "_id"]            self.create_index(index_list)        # Class variables that will be set and reset during iterative read across a range.        self.range_iter_parameter = None        self.range_iter_sort = None        self.range_iter_start = None        self.range_iter_start_closed_interval = None        self.range_iter_increment = None        self.range_iter_stop = None        self.range_iter_stop_closed_interval = None                self.safe_collections = set()                            def __del__(self):        """        Upon DBReader deletion, close the client/connection.        :return: None        """        try:            self.client.close()        except pymongo.errors.PyMongoError:            pass            def reset_collection(self):        self.collection.drop()        try:            self.db.create_collection(self.collection_name)            self.collection = self.db[self.collection_name]        except:            pass                    def get_latest_collection(self):        col_list = self.db.list_collection_names()        gen_time = []        for col in col_list:            try:                collection = self.db[col]                doc = collection.find_one({})                gen_time.append(doc["_id"].generation_time)            except TypeError: # means this collection is empty                collection.drop()                    sorted_idx = sorted(range(len(gen_time)), key=gen_time.__getitem__)        try:            latest_col = col_list[sorted_idx[-1]]            return latest_col                except IndexError:            return None            # simple query functions on collection level    def get_first(self, index_name):        '''        get the first document from MongoDB by index_name        TODO: should match index_name        '''        return self.collection.find_one(sort=[(index_name, pymongo.ASCENDING)])            def get_last(self, index_name):        '''        get the last document from MongoDB by index_name         TODO: should match index_name        '''        return self.collection.find_one(sort=[(index_name, pymongo.DESCENDING)])        def find_one(self, index_name, index_value):        return self.collection.find_one({index_name: index_value})            def is_empty(self):        return self.count() == 0            def get_keys(self):         oneKey = self.collection.find().limit(1)        for key in oneKey:            return key.keys()            def create_index(self, indices):        try:            all_field_names = self.collection.find_one({}).keys()            existing_indices = self.collection.index_information().keys()            for index in indices:                if index in all_field_names:                    if index+"_1" not in existing_indices and index+"_-1" not in existing_indices:                        self.collection.create_index(index)             except Exception as e:            # print("create_index ", e)            pass        return        def get_range(self, index_name, start, end):         return self.collection.find({            index_name : { "$gte" : start, "$lt" : end}}).sort(index_name, pymongo.ASCENDING)        def count(self):        return self.collection.count_documents({})        def est_count(self):        return self.collection.estimated_document_count()        def get_min(self, index_name):        return self.get_first(index_name)[index_name]        def get_max(self, index_name):        return self.get_last(index_name)[index_name]        def exists(self, index_name, value):        return self.collection.count_documents({index_name: value }, limit = 1) != 0        def drop(self, collection_name):        self.db[collection_name].drop()            def list_collection_names(self):        return self.db.list_collection_names()            def mark_safe(self, col_list):        '''        Mark collections in col_list as safe so they won't be deleted using delete_collection()        '''        self.safe_collections.add(col_list)            def delete_collections(self, col_list_to_delete = None):        """        drop collections from list        except for the ones in safe_collections        """            for col in col_list_to_delete:            if col not in self.safe_collections:                self.db[col].drop()                print(f"{col} successfully deleted from database {self.db._Database__name}")                            else:                print(f"{col} is in safe_collections of {self.db._Database__name}. Use db['{col}'].drop() instead.")                def insert_one_schema_validation(self, collection, document):        """        A wrapper around pymongo insert_one, which is a thread-safe operation        bypass_document_validation = True: enforce schema        """        try:            collection.insert_one(document, bypass_document_validation = False)        except Exception as e: # schema violated            warnings.warn("Schema violated. Insert anyways. Full error: {}".format(e), UserWarning)            collection.insert_one(document, bypass_document_validation = True)                        def write_one_trajectory(self, thread = True, collection_name = None, **kwargs):        """        Write an arbitrary document specified in kwargs to a specified collection. No schema enforcment.        :param thread: a boolean indicating if multi-threaded write is used        :param collection_name: a string for write collection destination                Use case:        e.g.1.         dbw.write_one_trajectory(timestamp = [1,2,3], x_position = [12,22,33])        e.g.2.         traj = {"timestamp": [1,2,3], "x_position": [12,22,33]}        dbw.write_one_trajectory(**traj)        """        if collection_name is not None:            col = self.db[collection_name] # get default collection during construction        else:            col = self.collection                doc = {}         for key,val in kwargs.items():            doc[key] = val                if not thread:            self.insert_one_schema_validation(col, doc)        else:            # fire off a thread            t = Thread(target=self.insert_one_schema_validation, args=(col, doc,))            # self.threads.append(t)            t.daemon = True            t.start()                def thread_insert(self, document):        t = Thread(target=self.collection.insert_one, args=(document,), kwargs={'bypass_document_validation': True})        # self.threads.append(t)        t.daemon = True        t.start()                           def transform(self, read_database_name=None, read_collection_name=None,                  write_database_name="transformed", write_collection_name=None):        '''        Authors: Zi Nean Toeh and Lisa Liu        transform trajectory-indexed data to timestamp-indexed data, in 25Hz        transformed document schema (RAW):            {                _id: ,                timestamp: ,                configuration_id: -1,                dimensions: [[l0,w0,h0], [l1,w1,h1], ...],                id: [id0, id1, ...],                position: [[x0, y0], [x1, y1], ...],            }        transformed document schema (REC):            {                _id: ,                timestamp: ,                configuration_id: -1,                id: [id0, id1, ...],                position: [[x0, y0], [x1, y1], ...],            }        '''        # re-wrap parameters        config = self.client._MongoClient__init_kwargs        if read_database_name is not None:            config["read_database_name"] = read_database_name        else:            config["read_database_name"] = self.database_name        if read_collection_name is not None:            config["read_collection_name"] = read_collection_name        else:            config["read_collection_name"] = self.collection_name        config["write_database_name"] = write_database_name        if write_collection_name is not None:            config["write_collection_name"] = write_collection_name        else:            config["write_collection_name"] = config["read_collection_name"]        print("Transform collection {} in database {}".format(config["read_collection_name"], config["read_database_name"] ))        manager=Manager()        mode = manager.Value(c_char_p,"")        # mode = None                # initialize Queue for multiprocessing        # - transform pushes mongoDB operation requests to this queue, which batch_update would listen from        batch_update_connection = Queue()                # start 2 child processes        print("Starting Transformation process...")        proc_transform = Process(target=trans_run, args=(config, mode, None, batch_update_connection, ))        proc_transform.start()        print("Starting Batch Update process...")        proc_batch_update = Process(target=batch_run, args=(config, mode,batch_update_connection, ))        proc_batch_update.start()                proc_transform.join()        proc_batch_update.join()        print("TRANSFORMATION TO THE DARK SIDE COMPLETE.")            def transform2(self, read_database_name=None, read_collection_name=None,                  write_database_name="transformed_beta", write_collection_name=None,                   chunk_size=None, interpolate=False):        '''        transform trajectory-indexed data to timestamp-indexed data, in 25Hz        transformed document schema:            {                _id: ,                timestamp: ,                wb: {                    str(id1): [centerx,centery,l,w,dir,v],                    str(id2): [centerx,centery,l,w,dir,v],                    ...                    },                eb: {                    str(id1): [centerx,centery,l,w,dir,v],                    str(id2): [centerx,centery,l,w,dir,v],                    ...                    }                }        schema in transformed_beta.__METADATA__            {                _id: RUN_ID,                name: ""                description: "",                start_time: float,                end_time: float,                num_objects: int,                duration: end_time-start_time,                start_x:                end_x:                road_segment_length:             }        '''        # re-wrap parameters        print("chunk_size: ", chunk_size)                config = self.client._MongoClient__init_kwargs        if read_database_name is not None:            config["read_database_name"] = read_database_name        else:            config["read_database_name"] = self.database_name        if read_collection_name is not None:            config["read_collection_name"] = read_collection_name        else:            config["read_collection_name"] = self.collection_name        config["write_database_name"] = write_database_name        if write_collection_name is not None:            config["write_collection_name"] = write_collection_name        else:            config["write_collection_name"] = config["read_collection_name"]                                 # check if collection exists in read_from_database        rcn = config["read_collection_name"]        rdn = config["read_database_name"]        if rcn not in self.client[rdn].list_collection_names():            print(f"{rcn} does not exists in {rdn}")            return                        print("Transform [db/col] {} / {} to [db/col] {} / {}".format(config["read_database_name"],                                                                       config["read_collection_name"],                                                                       config["write_database_name"],                                                                       config["write_collection_name"]))                         mp_manager = Manager()        bulk_write_queue = mp_manager.Queue()                print("Starting EB transform...")        eb_proc = Process(target=transform_beta, args=("eb", config, bulk_write_queue, chunk_size, interpolate,)) # write collection information to __METADATA__ collection. Only write once        eb_proc.start()        print("Starting WB transform...")        wb_proc = Process(target=transform_beta, args=("wb", config, bulk_write_queue, chunk_size, interpolate,))        wb_proc.start()                print("Starting bulk_write...")        bw_proc = Process(target=batch_write, args=(config, bulk_write_queue, True))        bw_proc.start()                while True:            # Complete condition            all_proc_alive = [proc.is_alive() for proc in [eb_proc, wb_proc, bw_proc]]            if not any(all_proc_alive) and bulk_write_queue.empty():                break                         # restart bulk_write if previous processes are not done            if not bw_proc.is_alive() and (eb_proc.is_alive or wb_proc.is_alive or not bulk_write_queue.empty()):                bw_proc = Process(target=batch_write, args=(config, bulk_write_queue, False, ))                bw_proc.start()                            time.sleep(4)                eb_proc.join()        wb_proc.join()        bw_proc.join()                print("TRANSFORMATION TO THE DARK SIDE COMPLETE.")                            return    def read_query(self, query_filter, query_sort = None,                   limit = 0):        """        Executes a read query against the database collection.        :param query_filter: Currently a dict following pymongo convention (need to abstract this).        :param query_sort: List of tuples: (field_to_sort, sort_direction); direction is ASC/ASCENDING or DSC/DESCENDING        :param limit: Numerical limit for number of documents returned by query.        :return:        """        if query_sort is not None:            sort_fields = []            for sort_field, sort_dir in query_sort:                if sort_dir.upper() in ('ASC', 'ASCENDING'):                    sort_fields.append((sort_field, pymongo.ASCENDING))                elif sort_dir.upper() in ('DSC', 'DESCENDING'):                    sort_fields.append((sort_field, pymongo.DESCENDING))                else:                    raise ValueError("Invalid direction for sort. Use 'ASC'/'ASCENDING' or 'DSC'/'DESCENDING'.")        else:            sort_fields = None        # If user passed None, substitute an empty dictionary (per the PyMongo convention).        if query_filter is None:            filter_field = {}        else:            filter_field = query_filter        result = self.collection.find(filter=filter_field, limit=limit, sort=sort_fields)        # return the pymongo.cursor.Cursor        return result        # TODO: also datetime for range bounds??    def read_query_range(self, range_parameter,                         range_greater_than = None,                         range_greater_equal= None,                         range_less_than = None,                         range_less_equal = None,                         range_increment = None,                         query_sort = None,                         limit = 0,                         query_filter = {}):        """        Iterate across a query range in portions.        Usage:        ```            # Method 1: FOR loop across function call            for result in dbr.read_query_range(range_parameter='t', range_greater_than=0, range_less_equal=100,                                                range_increment=10):                print(result)                            # Method 2: WHILE loop with next(...)            rqr = dbr.read_query_range(range_parameter='t', range_greater_equal=0, range_less_than=100,                                        range_increment=10)            while True:                try:                    result = next(rqr)                    print(result)                except StopIteration:                    print("END OF ITERATION")                    break        ```        :param range_parameter: One document field across which to run range queries.        :param range_greater_than: Sets a '>' bound on `range_parameter` for the query or successive queries.        :param range_greater_equal: Sets a '>' bound on `range_parameter` for the query or successive queries.        :param range_less_than: Sets a '>' bound on `range_parameter` for the query or successive queries.        :param range_less_equal: Sets a '>' bound on `range_parameter` for the query or successive queries.        :param range_increment: When None, executes the range query as a one-off and returns result; otherwise,            returns iterable of queries/results.        :param query_sort: List of tuples: (field_to_sort, sort_direction); direction is ASC/ASCENDING or DSC/DESCENDING        :param limit: Numerical limit for number of documents returned by query.        :param query_filter: other query items            e.g., {"compute_node_id":"videonode2", "direction":-1}        :return: iterator across range-segmented queries (each query executes when __next__() is called in iteration)        """        # # no bounds: raise error TODO: start querying from the min value        # if range_greater_than is None and range_greater_equal is None and range_less_than is None \        #         and range_less_equal is None:        #     raise ValueError("Must specify lower and or upper bound (inclusive or exlusive) for range query.")                    # # only bounded on one side: TODO: start querying from the min value        # if (range_greater_than is None and range_greater_equal is None) or \        #         (range_less_than is None and range_less_equal is None):        #     raise NotImplementedError("Infinite ranges not currently supported.")                        if query_filter:            self.query_filter = query_filter        else:            self.query_filter = defaultdict(dict)                # if no range_increment, query everything between lower bound and upper bound        if range_increment is None:            # more operations: https://www.mongodb.com/docs/manual/reference/operator/query/            operators = ["$gt","$gte","$lt","$lte"]              values = [range_greater_than, range_greater_equal, range_less_than, range_less_equal]            for i, operator in enumerate(operators):                if values[i]:                     try:                        query_filter[range_parameter][operator] = values[i]                    except KeyError:                        query_filter[range_parameter] = {operator: values[i]}                                    if self.query_filter: # merge query filters into a single dictionary                query_filter.update(self.query_filter)            return self.read_query(query_filter=query_filter, query_sort=query_sort, limit=limit)                else:            self.range_iter_parameter = range_parameter            self.range_iter_increment = range_increment            self.range_iter_sort = query_sort            if range_greater_equal is not None: # left closed [a, ~                self.range_iter_start = range_greater_equal                self.range_iter_start_closed_interval = True            elif range_greater_than is not None: # left open (a, ~                self.range_iter_start = range_greater_than                self.range_iter_start_closed_interval = False            else:                # TODO: temporarily set start and end point to the min and max values. For live stream, this is not applicable.                self.range_iter_start = self.get_min(range_parameter)                self.range_iter_start_closed_interval = True            if range_less_equal is not None: # right closed a, b]                self.range_iter_stop = range_less_equal                self.range_iter_stop_closed_interval = True            elif range_less_than is not None: # right open a, b)                self.range_iter_stop = range_less_than                self.range_iter_stop_closed_interval = False            else:                # TODO: temporarily set start and end point to the min and max values. Works on static database collections only.                self.range_iter_stop = self.get_max(range_parameter)                self.range_iter_stop_closed_interval = True                        return iter(self)        def __iter__(self):        if self.range_iter_parameter is None or self.range_iter_start is None or self.range_iter_increment is None \                or self.range_iter_stop is None or self.range_iter_start_closed_interval is None \                or self.range_iter_stop_closed_interval is None:            raise AttributeError("Iterable DBReader only supported via `read_query_range(...).")        return DBReadRangeIterator(self)            class DBReadRangeIterator:    """    Iterable class for executing successive queries using a DBReader. The range iteration values must be set in the        DBReader before instantiating this object. They will be set back to None upon the end of iteration.    """    def __init__(self, db_reader):        self._reader = db_reader        self._current_lower_value = self._reader.range_iter_start        self._current_upper_value = self._current_lower_value + self._reader.range_iter_increment        # Initialize first/last iteration indicator variables.        self._first_iter = True        self._last_iter_exit_flag = False    def _reset_range_iter(self):        """        Goes into the DBReader instance and resets all of its range iteration values back to None.        :return: None        """        self._reader.range_iter_parameter = None        self._reader.range_iter_sort = None        self._reader.range_iter_start = None        self._reader.range_iter_start_closed_interval = None        self._reader.range_iter_increment = None        self._reader.range_iter_stop = None        self._reader.range_iter_stop_closed_interval = None    def _update_values(self):        """        Increments the current iteration lower and upper bound. No interval open/closed indication needed because            iterations other than the first and last are always [lower, upper) interval format.        :return: None        """        self._current_lower_value = self._current_upper_value        self._current_upper_value = self._current_upper_value + self._reader.range_iter_increment    def __next__(self):        """        Runs the next range query based on the current values (self._current_...). Computes the next current values            as well as the open/closed intervals. Sets and reacts to a flag for last iteration and raises            StopIteration exception when complete.        :return: result of next read query within the iteration range        """        # If the last iteration set this flag, then we need to stop iteration.        # But if this current iteration is the last one that will return anything, we'll set the flag this time.        if self._last_iter_exit_flag is True:            self._reset_range_iter()            raise StopIteration        # Check if this will be the last query -- i.e., the current lower value met or exceeded the range stop.        if self._current_lower_value >= self._reader.range_iter_stop:            # Set the flag to exit next iteration.            self._last_iter_exit_flag = True            query_upper_value = self._reader.range_iter_stop        else:            query_upper_value = self._current_upper_value        # If this is the first iteration, check whether we are doing open or closed interval on greater-than side.        if self._first_iter is True:            if self._reader.range_iter_start_closed_interval is True:                gt, gte = None, self._current_lower_value            else:                gt, gte = self._current_lower_value, None        # After first iteration, always do closed interval on greater-than side. [lower, upper)        else:            gt, gte = None, self._current_lower_value        # If this is the last iteration, check whether we are doing open or closed interval on the less-than side.        # We will only reach this point if this is the last results-gathering iteration.        # The exit flag indicates we're about to stop, but we still need to get one more set of results.        if self._last_iter_exit_flag is True:            if self._reader.range_iter_stop_closed_interval is True:                lt, lte = None, query_upper_value            else:                lt, lte = query_upper_value, None        # Before last iteration, always do open interval on less-than side. [lower, upper)        else:            lt, lte = query_upper_value, None        # Now that the range is calculated, execute outright (no increment) using `DBReader.read_query_range(...)`.        # We use the range function so that we don't have to do the formatting of the query filter manually.        iter_result = self._reader.read_query_range(range_parameter=self._reader.range_iter_parameter,                                                    range_greater_than=gt, range_greater_equal=gte,                                                    range_less_than=lt, range_less_equal=lte,                                                    query_sort=self._reader.range_iter_sort, range_increment=None,                                                    query_filter = self._reader.query_filter)        # No matter what, this is not the first iteration anymore at this point.        self._first_iter = False        # Increment the values for the next iteration.        # Even if this is the last results-gathering iteration, it's fine to increment the values.        self._update_values()        return iter_result    def __iter__(self):        """        Needed in order to place DBReader.read_range_query(...) into a FOR loop.        :return: self        """        return self                            
\ No newline at end of file
+import pymongoimport warnings import json import copyimport importlibfrom threading import Thread, RLockfrom concurrent.futures import ThreadPoolExecutorfrom collections import dequefrom .projections import PROJECTIONS, register_projection, resolve_projectionfrom .group_writer import GroupCommitWriterfrom .schema_validator import compile_schema, flag_violationsfrom .range_query import RangeQuery, window_filter, adaptive_windowsfrom .parallel_scan import parallel_scanfrom .connections import get_clientimport time# The transform engines (pandas, numpy, multiprocessing) and numpy-based modules are imported on first use,# so that importing the package for reading and writing stays fast. Their names are still available from the package:_LAZY_IMPORTS = { # name: (module, attribute)    "trans_run": (".transformation", "run"),    "batch_run": (".batch_update", "run"),    "transform_beta": (".transform2", "transform_beta"),    "batch_write": (".transform2", "batch_write"),    "transform_shard": (".transform2", "transform_shard"),    "shard_ranges": (".transform2", "shard_ranges"),    "write_metadata": (".transform2", "write_metadata"),    "RESAMPLE_ENGINES": (".transform2", "RESAMPLE_ENGINES"),    "make_transport": (".transport", "make_transport"),    "TRANSPORTS": (".transport", "TRANSPORTS"),    "transform_aggregate": (".aggregation", "transform_aggregate"),    "supports_aggregate": (".aggregation", "supports_aggregate"),    "ENGINES": (".aggregation", "ENGINES"),    "decode_columnar": (".columnar", "decode_columnar"),    "projected_fields": (".columnar", "projected_fields"),    "split": (".columnar", "split"),    "RAW_CODEC_OPTIONS": (".columnar", "RAW_CODEC_OPTIONS"),    "copy_raw": (".bulk_copy", "copy_raw"),    "export_raw": (".bulk_copy", "export_raw"),    "range_filter": (".bulk_copy", "range_filter"),    "AsyncDBClient": (".async_client", "AsyncDBClient"),    }def __getattr__(name):    try:        module, attribute = _LAZY_IMPORTS[name]    except KeyError:        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))    value = getattr(importlib.import_module(module, __name__), attribute)    globals()[name] = value    return value                class DBClient:    """    MongoDB database reader, specific to a collection in the database. This object is typically fairly persistent, i.e.,        sticks around for a while to execute multiple queries.    """    def __init__(self, host=None, port=27017, username=None, password=None, database_name=None, collection_name=None,                 schema_file = None, latest_collection=False, write_batch_size=1000, write_delay_ms=50,                 write_queue_size=10000, schema_validation="server", lazy=True, shared=True, **client_kwargs):        """        Connect to the specified MongoDB instance, test the connection, then set the specific database and collection.        The connection test, collection creation, schema and index updates run on the first use of self.collection        if lazy (see _setup).        :param default_param: Dictionary with default parameters. Specified parameters will overwrite default values        :param host: Database connection host name.        :param port: Database connection port number.        :param username: Database authentication username.        :param password: Database authentication password.        :param database_name: Name of database to connect to (do not confuse with collection name).        :param collection_name: Name of database collection from which to query.        :param write_batch_size, write_delay_ms, write_queue_size: threaded writes are inserted in batches of up to            write_batch_size documents, or whatever accumulated in write_delay_ms. At most write_queue_size documents            wait to be written, beyond that write_one_trajectory blocks (see group_writer.GroupCommitWriter)        :param schema_validation: "server" (default) lets MongoDB validate each insert against schema_file.            "client" validates documents locally with the compiled schema (see schema_validator), writes violations            anyways with a "flags" annotation, and bypasses server validation, so that valid documents take the batched path        :param lazy: if True (default), defer the connection test and collection setup until first use        :param shared: if True (default), use the process-wide client of these connection parameters            (see connections.get_client), otherwise a private one that close() closes        :param client_kwargs: pymongo options of the client, e.g., maxPoolSize        """        if schema_validation not in ["server", "client"]:            raise ValueError("schema_validation must be 'server' or 'client', got {}".format(schema_validation))        self.validator = None        self.schema = None                self.connection_params = {"host": host, "port": port, "username": username, "password": password}        self.shared = shared        if shared:            self.client = get_client(**self.connection_params, **client_kwargs)        else:            self.client = pymongo.MongoClient(**self.connection_params, connect=False, connectTimeoutMS=5000,                                              **client_kwargs)        self._ready = False        self._in_setup = False        self._setup_lock = RLock()        self._latest_collection = latest_collection        if database_name is not None:            self.db = self.client[database_name]            self.database_name = database_name            self.collection_name = collection_name if collection_name else None            self._collection = self.db[collection_name] if collection_name else None                            # check for schema. If exists a schema json file, update the collection validator (in _setup)            if schema_file: # add validator                f = open(schema_file)                collection_schema = json.load(f)                self.schema = collection_schema                f.close()                if schema_validation == "client":                    self.validator = compile_schema(collection_schema)        # adaptive window bounds, see adaptive_windows        self.window_cache = {}                self.safe_collections = set()                self.write_batch_size = write_batch_size        self.write_delay_ms = write_delay_ms        self.write_queue_size = write_queue_size        self.group_writer = None # started on the first threaded write                if not lazy or latest_collection:            self._setup()            def _setup(self):        """        Test the connection, create the collection (or find the latest one), update its validator and indices.        Runs once, upon instantiation or, if lazy, on first use of self.collection        """        with self._setup_lock:            if self._ready or self._in_setup: # done, or called from below                return            self._in_setup = True            try:                try:                    self.client.admin.command('ping')                except pymongo.errors.ConnectionFailure:                    warnings.warn("Server not available")                    raise ConnectionError("Could not connect to MongoDB.")                                if getattr(self, "database_name", None) is not None:                    if self.collection_name:                        try:                            self.db.create_collection(self.collection_name)                        except:                            pass                    elif self._latest_collection:                        print("No collection name specified. Get the latest collection.")                        self.collection_name = self.get_latest_collection()                        self._collection = self.db[self.collection_name]                                            if self.schema:                        self.db.command("collMod", self.collection_name, validator=self.schema)                                        # create indices                    index_list = ["first_timestamp", "last_timestamp", "starting_x", "ending_x", "_id"]                    self.create_index(index_list)                self._ready = True            finally:                self._in_setup = False    @property    def collection(self):        if not self._ready:            self._setup()        return self._collection    @collection.setter    def collection(self, collection):        self._collection = collection    def __del__(self):        """        Upon DBReader deletion, flush pending writes and close the client/connection.        :return: None        """        try:            self.close()        except Exception:            pass            def reset_collection(self):        self.collection.drop()        try:            self.db.create_collection(self.collection_name)            self.collection = self.db[self.collection_name]        except:            pass                    def get_latest_collection(self):        col_list = self.db.list_collection_names()        gen_time = []        for col in col_list:            try:                collection = self.db[col]                doc = collection.find_one({})                gen_time.append(doc["_id"].generation_time)            except TypeError: # means this collection is empty                collection.drop()                    sorted_idx = sorted(range(len(gen_time)), key=gen_time.__getitem__)        try:            latest_col = col_list[sorted_idx[-1]]            return latest_col                except IndexError:            return None            # simple query functions on collection level    def get_first(self, index_name):        '''        get the first document from MongoDB by index_name        TODO: should match index_name        '''        return self.collection.find_one(sort=[(index_name, pymongo.ASCENDING)])            def get_last(self, index_name):        '''        get the last document from MongoDB by index_name         TODO: should match index_name        '''        return self.collection.find_one(sort=[(index_name, pymongo.DESCENDING)])        def find_one(self, index_name, index_value):        return self.collection.find_one({index_name: index_value})            def is_empty(self):        return self.count() == 0            def get_keys(self):         oneKey = self.collection.find().limit(1)        for key in oneKey:            return key.keys()            def create_index(self, indices):        try:            all_field_names = self.collection.find_one({}).keys()            existing_indices = self.collection.index_information().keys()            for index in indices:                if index in all_field_names:                    if index+"_1" not in existing_indices and index+"_-1" not in existing_indices:                        self.collection.create_index(index)             except Exception as e:            # print("create_index ", e)            pass        return        def get_range(self, index_name, start, end):         return self.collection.find({            index_name : { "$gte" : start, "$lt" : end}}).sort(index_name, pymongo.ASCENDING)        def count(self):        return self.collection.count_documents({})        def est_count(self):        return self.collection.estimated_document_count()        def get_min(self, index_name):        return self.get_first(index_name)[index_name]        def get_max(self, index_name):        return self.get_last(index_name)[index_name]        def exists(self, index_name, value):        return self.collection.count_documents({index_name: value }, limit = 1) != 0        def drop(self, collection_name):        self.db[collection_name].drop()            def list_collection_names(self):        return self.db.list_collection_names()            def mark_safe(self, col_list):        '''        Mark collections in col_list as safe so they won't be deleted using delete_collection()        '''        self.safe_collections.add(col_list)            def delete_collections(self, col_list_to_delete = None):        """        drop collections from list        except for the ones in safe_collections        """            for col in col_list_to_delete:            if col not in self.safe_collections:                self.db[col].drop()                print(f"{col} successfully deleted from database {self.db._Database__name}")                            else:                print(f"{col} is in safe_collections of {self.db._Database__name}. Use db['{col}'].drop() instead.")                def copy_collection(self, to_database_name, to_collection_name=None, from_collection_name=None,                        from_database_name=None, query_filter=None, first_timestamp_range=None,                        batch_size=1000, num_threads=4, bypass_document_validation=False):        """        Copy a collection (e.g., between trajectories, reconciled and stitched databases) as raw BSON,        documents are not decoded to python. Batches are inserted with insert_many from num_threads threads.        :param to_database_name: database to copy to        :param to_collection_name: defaults to the name of the source collection        :param from_collection_name: defaults to the current collection        :param from_database_name: defaults to the current database        :param query_filter: copy only the documents that match, e.g., {"direction": 1}        :param first_timestamp_range: (start, end), copy only the documents with first_timestamp in [start, end)        :return: number of documents copied        """        from .bulk_copy import copy_raw, range_filter        from_database = self.client[from_database_name] if from_database_name is not None else self.db        from_collection_name = from_collection_name or self.collection_name        to_collection = self.client[to_database_name][to_collection_name or from_collection_name]        count = copy_raw(from_database[from_collection_name], to_collection,                         range_filter(query_filter, first_timestamp_range), batch_size, num_threads,                         bypass_document_validation)        print("Copied {} documents to {}.{}".format(count, to_database_name, to_collection.name))        return count        def export(self, file_path, collection_name=None, query_filter=None, first_timestamp_range=None, batch_size=1000):        """        Export a collection to a .bson file (mongodump format) as raw BSON, documents are not decoded to python.        Read back with bson.decode_file_iter or mongorestore.        :param collection_name: defaults to the current collection        :param query_filter, first_timestamp_range: see copy_collection        :return: number of documents exported        """        from .bulk_copy import export_raw, range_filter        collection = self.db[collection_name] if collection_name is not None else self.collection        return export_raw(collection, file_path, range_filter(query_filter, first_timestamp_range), batch_size)                def insert_one_schema_validation(self, collection, document):        """        A wrapper around pymongo insert_one, which is a thread-safe operation        bypass_document_validation = True: enforce schema        """        if self.client_validated(collection, document):            collection.insert_one(document, bypass_document_validation = True)            return        try:            collection.insert_one(document, bypass_document_validation = False)        except Exception as e: # schema violated            warnings.warn("Schema violated. Insert anyways. Full error: {}".format(e), UserWarning)            collection.insert_one(document, bypass_document_validation = True)                        def write_one_trajectory(self, thread = True, collection_name = None, **kwargs):        """        Write an arbitrary document specified in kwargs to a specified collection. No schema enforcment.        :param thread: a boolean indicating if multi-threaded write is used        :param collection_name: a string for write collection destination                Use case:        e.g.1.         dbw.write_one_trajectory(timestamp = [1,2,3], x_position = [12,22,33])        e.g.2.         traj = {"timestamp": [1,2,3], "x_position": [12,22,33]}        dbw.write_one_trajectory(**traj)        """        if collection_name is not None:            col = self.db[collection_name] # get default collection during construction        else:            col = self.collection                doc = {}         for key,val in kwargs.items():            doc[key] = val                if not thread:            self.insert_one_schema_validation(col, doc)        else:            # batched with other threaded writes            bypass = self.client_validated(col, doc)            self.get_group_writer().submit(col, doc, bypass_document_validation=bypass)             def client_validated(self, collection, document):        """        With schema_validation="client", validate document locally if it goes to the validated collection,        and flag the violations (see schema_validator.flag_violations)        :return: True if document was validated locally, i.e., server validation can be bypassed        """        if self.validator is None or collection.name != self.collection_name:            return False        errors = flag_violations(self.validator, document)        if errors:            warnings.warn("Schema violated. Insert anyways with flags. First error: {}".format(errors[0]), UserWarning)        return True    def thread_insert(self, document):        self.get_group_writer().submit(self.collection, document, bypass_document_validation=True)            def get_group_writer(self):        if self.group_writer is None:            self.group_writer = GroupCommitWriter(max_batch=self.write_batch_size, max_delay_ms=self.write_delay_ms,                                                  max_queue=self.write_queue_size)        return self.group_writer        def flush(self, timeout=None):        """        Wait until all threaded writes issued so far are written        :param timeout: maximum time to wait in sec, None to wait until done        :return: False if writes are still pending after timeout, True otherwise        """        if self.group_writer is None:            return True        return self.group_writer.flush(timeout)        def close(self, timeout=None):        """        Flush the threaded writes (see flush), stop the writer thread and close the client/connection if not shared.        Also called upon deletion, and when leaving a with block:            with DBClient(**params) as dbc:                dbc.write_one_trajectory(**traj)        :return: see flush        """        flushed = self.group_writer.close(timeout) if self.group_writer is not None else True        if not self.shared: # shared clients stay open for the other users, see connections.close_all            self.client.close()        return flushed        def write_stats(self):        """        Counters of threaded writes, in number of documents:            {"pending", "completed", "failed", "batches", "mean_batch_ms": mean duration of an insert_many}        """        if self.group_writer is None:            return {"pending": 0, "completed": 0, "failed": 0, "batches": 0, "mean_batch_ms": 0}        return self.group_writer.stats()        def __enter__(self):        return self        def __exit__(self, exc_type, exc_value, traceback):        self.close()                         def transform(self, read_database_name=None, read_collection_name=None,                  write_database_name="transformed", write_collection_name=None, write_mode="upsert",                  transport="queue", engine="python", max_queue_size=None, backpressure="block", spill_dir=None,                  resume=True, max_cache_size=None):        '''        Authors: Zi Nean Toeh and Lisa Liu        transform trajectory-indexed data to timestamp-indexed data, in 25Hz        :param write_mode: "upsert" (default) writes every timestamp with an UpdateOne(upsert=True).            "insert" inserts timestamp documents with insert_many once no trajectory left can touch them,            and keeps upserts only for the timestamps still open at the end        :param transport: "queue" (default) sends one dictionary per trajectory to the writer process.            "chunked" sends columnar batches of resampled trajectories over a queue, "shared_memory" through shared memory        :param engine: "python" (default) reads the trajectories, transforms them in a child process and writes them back.            "aggregate" runs the transform as an aggregation pipeline inside MongoDB (RECONCILED only, see aggregation.py).            Bins without a sample are left out instead of interpolated, which only differs for trajectories that are            not uniformly sampled at 25Hz.            "auto" picks "aggregate" if the collection and the server support it, otherwise "python"        :param max_queue_size: maximum number of items waiting for the writer process, defaults to            transport.DEFAULT_MAX_SIZE[transport], 0 for no limit        :param backpressure: when the queue is full, "block" (default) holds back the transform process,            "spill" lets it go on and keeps what does not fit in a temporary file in spill_dir        :param resume: if a transform to the same collection with the same parameters stopped partway, keep the            timestamps it completed and transform the rest (the time ranges it completed for engine "aggregate",            see job_manifest.py). Otherwise start over        :param max_cache_size: maximum number of open timestamps the writer process keeps in memory. If exceeded, the            earliest ones are written before they are complete, and merged with the rest later. Defaults to no limit        transformed document schema (RAW):            {                _id: ,                timestamp: ,                configuration_id: -1,                dimensions: [[l0,w0,h0], [l1,w1,h1], ...],                id: [id0, id1, ...],                position: [[x0, y0], [x1, y1], ...],            }        transformed document schema (REC):            {                _id: ,                timestamp: ,                configuration_id: -1,                id: [id0, id1, ...],                position: [[x0, y0], [x1, y1], ...],            }        '''        from multiprocessing import Process, Manager        from ctypes import c_char_p        from .transformation import run as trans_run        from .batch_update import run as batch_run        from .transport import make_transport, flush_channel        from .aggregation import transform_aggregate, supports_aggregate, ENGINES        from .job_manifest import JobManifest                # re-wrap parameters        config = dict(self.connection_params)        if read_database_name is not None:            config["read_database_name"] = read_database_name        else:            config["read_database_name"] = self.database_name        if read_collection_name is not None:            config["read_collection_name"] = read_collection_name        else:            config["read_collection_name"] = self.collection_name        config["write_database_name"] = write_database_name        if write_collection_name is not None:            config["write_collection_name"] = write_collection_name        else:            config["write_collection_name"] = config["read_collection_name"]        config["write_mode"] = write_mode        config["transport"] = transport        if max_cache_size is not None:            config["max_cache_size"] = max_cache_size        if engine not in ENGINES:            raise ValueError("Invalid engine. Use one of {}".format(ENGINES))        if engine == "auto":            read_collection = self.client[config["read_database_name"]][config["read_collection_name"]]            engine = "aggregate" if supports_aggregate(self.client, read_collection) else "python"        if engine == "aggregate":            print("Transform collection {} in database {} with aggregation pipeline".format(config["read_collection_name"], config["read_database_name"] ))            transform_aggregate(self.client, config, resume=resume)            print("TRANSFORMATION TO THE DARK SIDE COMPLETE.")            return        print("Transform collection {} in database {}".format(config["read_collection_name"], config["read_database_name"] ))        manifest = JobManifest(self.client[config["write_database_name"]], config["write_collection_name"])        params = {"transform": "transform", "read_database_name": config["read_database_name"],                  "read_collection_name": config["read_collection_name"], "write_mode": write_mode}        job = manifest.resumable(params) if resume else None        if job is not None and job.get("committed_until") is not None:            config["resume_from"] = job["committed_until"]            print("Resume from timestamp {}".format(job["committed_until"]))        else:            manifest.start(params)        config["job_id"] = manifest.job_id        manager=Manager()        mode = manager.Value(c_char_p,"")        # mode = None                # initialize Queue for multiprocessing        # - transform pushes mongoDB operation requests to this queue, which batch_update would listen from        batch_update_connection = make_transport(transport, maxsize=max_queue_size, backpressure=backpressure,                                                 spill_dir=spill_dir)                # start 2 child processes        print("Starting Transformation process...")        proc_transform = Process(target=trans_run, args=(config, mode, None, batch_update_connection, ))        proc_transform.start()        print("Starting Batch Update process...")        proc_batch_update = Process(target=batch_run, args=(config, mode,batch_update_connection, ))        proc_batch_update.start()                # the queue is bounded, so the transform process would wait forever on a writer that died        while proc_transform.is_alive():            proc_transform.join(timeout=1)            if proc_transform.is_alive() and not proc_batch_update.is_alive():                print("Batch Update process exited with code {}, stop the Transformation process".format(proc_batch_update.exitcode))                proc_transform.terminate()                proc_transform.join()        if proc_batch_update.is_alive(): # everything is sent (or the transform failed), end the writer            batch_update_connection.put(None)            flush_channel(batch_update_connection)        proc_batch_update.join()        if transport == "shared_memory":            batch_update_connection.close()        print("Writer queue: " + batch_update_connection.stats())        if proc_transform.exitcode != 0 or proc_batch_update.exitcode != 0:            print("Transform failed, run it again to resume")            return        manifest.complete()        print("TRANSFORMATION TO THE DARK SIDE COMPLETE.")            def transform2(self, read_database_name=None, read_collection_name=None,                  write_database_name="transformed_beta", write_collection_name=None,                   chunk_size=None, interpolate=False, engine="pandas", write_mode="upsert",                  num_workers=None, halo=None, transport="queue", max_queue_size=None, backpressure="block",                  spill_dir=None, resume=True, incremental=False, high_water_field="_id", max_cache_size=None):        '''        transform trajectory-indexed data to timestamp-indexed data, in 25Hz        :param engine: resampling engine, "pandas" (default) or "numpy". The numpy engine bins and interpolates            on whole arrays and gives the same result as pandas, with much less overhead per trajectory        :param write_mode: "upsert" (default) writes every timestamp of each direction with an UpdateOne(upsert=True).            "insert" assembles complete timestamp documents in memory and inserts them with insert_many once            both directions are past them. Timestamps are closed at the end of each chunk, so chunk_size bounds the memory use.        :param num_workers: if specified, partition the time range into num_workers shards and transform them in parallel            processes (see transform_shard), instead of one process per direction and a single writer        :param halo: sec. A shard also reads trajectories that start up to halo before it, since they can run into the shard.            Defaults to the duration of the longest trajectory in the collection.        :param transport: how transform processes send to the writer process. "queue" (default) puts one pymongo            operation per timestamp to a manager queue. "chunked" sends columnar batches of timestamps over a            multiprocessing queue, "shared_memory" through shared memory, and the writer builds the operations.        :param max_queue_size, backpressure, spill_dir: bound of the queue to the writer process and what the transform            processes do when it is full, see transform        :param resume: if a transform2 to the same collection with the same parameters stopped partway, transform only            the chunks (shards if num_workers) it did not complete. Otherwise start over. See job_manifest.py        :param incremental: if True, transform only the trajectories added since the last incremental run, i.e., whose            high_water_field is above the high-water mark in __METADATA__, and merge them into the existing timestamp            documents. The mark is moved to the largest high_water_field transformed once the job is complete.        :param high_water_field: "_id" (default), trajectories are new if inserted later (ObjectIds are generated with            the time of the inserting client, so writers with skewed clocks can fall behind the mark).            "first_timestamp": trajectories are new if they start later, for collections written in time order        :param max_cache_size: maximum number of open timestamps each transform process, and the writer process in            write_mode "insert", keeps in memory. If exceeded, the earliest ones are written before they are complete,            and merged with the rest later. Defaults to no limit        transformed document schema:            {                _id: ,                timestamp: ,                wb: {                    str(id1): [centerx,centery,l,w,dir,v],                    str(id2): [centerx,centery,l,w,dir,v],                    ...                    },                eb: {                    str(id1): [centerx,centery,l,w,dir,v],                    str(id2): [centerx,centery,l,w,dir,v],                    ...                    }                }        schema in transformed_beta.__METADATA__            {                _id: RUN_ID,                name: ""                description: "",                start_time: float,                end_time: float,                num_objects: int,                duration: end_time-start_time,                start_x:                end_x:                road_segment_length:                 high_water_field: "_id" or "first_timestamp", if incremental                high_water_mark: the largest high_water_field transformed, if incremental            }        '''        import queue        from multiprocessing import Process, Manager        from .transform2 import transform_beta, batch_write, write_metadata, RESAMPLE_ENGINES, \            high_water_filter, read_high_water_mark, write_high_water_mark        from .resample import decimal_range        from .transport import make_transport, TRANSPORTS        from .job_manifest import JobManifest                if engine not in RESAMPLE_ENGINES:            raise ValueError("Invalid engine. Use one of {}".format(list(RESAMPLE_ENGINES)))        if write_mode not in ("upsert", "insert"):            raise ValueError("Invalid write_mode. Use 'upsert' or 'insert'.")        if transport not in TRANSPORTS:            raise ValueError("Invalid transport. Use one of {}".format(TRANSPORTS))        if high_water_field not in ("_id", "first_timestamp"):            raise ValueError("Invalid high_water_field. Use '_id' or 'first_timestamp'.")                    # re-wrap parameters        print("chunk_size: ", chunk_size)                config = dict(self.connection_params)        if read_database_name is not None:            config["read_database_name"] = read_database_name        else:            config["read_database_name"] = self.database_name        if read_collection_name is not None:            config["read_collection_name"] = read_collection_name        else:            config["read_collection_name"] = self.collection_name        config["write_database_name"] = write_database_name        if write_collection_name is not None:            config["write_collection_name"] = write_collection_name        else:            config["write_collection_name"] = config["read_collection_name"]        if max_cache_size is not None:            config["max_cache_size"] = max_cache_size                                 # check if collection exists in read_from_database        rcn = config["read_collection_name"]        rdn = config["read_database_name"]        if rcn not in self.client[rdn].list_collection_names():            print(f"{rcn} does not exists in {rdn}")            return                        print("Transform [db/col] {} / {} to [db/col] {} / {}".format(config["read_database_name"],                                                                       config["read_collection_name"],                                                                       config["write_database_name"],                                                                       config["write_collection_name"]))                        manifest = JobManifest(self.client[config["write_database_name"]], config["write_collection_name"])        config["job_id"] = manifest.job_id        params = {"transform": "transform2", "read_database_name": rdn, "read_collection_name": rcn,                  "chunk_size": chunk_size, "interpolate": interpolate, "engine": engine, "write_mode": write_mode,                  "num_workers": num_workers}        until = None        if incremental:            after = read_high_water_mark(self.client, config, high_water_field)            params["incremental"], params["after"] = high_water_field, after        job = manifest.resumable(params) if resume else None                if incremental:            # the trajectories in (after, until], until stays the same on resume            if job is not None:                until = job["until"]            else:                latest = self.client[rdn][rcn].find_one({}, {high_water_field: 1}, sort=[(high_water_field, -1)])                until = latest[high_water_field] if latest is not None else None            if until is None or (after is not None and until <= after):                print("No new trajectories since {} = {}".format(high_water_field, after))                return            config["query_filter"] = high_water_filter(high_water_field, after, until)            print("Incremental: transform trajectories with {} in ({}, {}]".format(high_water_field, after, until))                if num_workers:            if self._transform_sharded(config, num_workers, halo, chunk_size, interpolate, engine, write_mode,                                       manifest, params, job, until):                if incremental:                    write_high_water_mark(self.client, config, high_water_field, until)                print("TRANSFORMATION TO THE DARK SIDE COMPLETE.")            return                # chunks of first_timestamp, the same on resume        if job is None:            from_collection = self.client[rdn][rcn]            query_filter = config.get("query_filter", {})            start = from_collection.find_one(query_filter, {"first_timestamp": 1}, sort=[("first_timestamp", 1)])["first_timestamp"]-1            end = from_collection.find_one(query_filter, {"first_timestamp": 1}, sort=[("first_timestamp", -1)])["first_timestamp"]+1            manifest.start(params, grid={"start": start, "end": end}, until=until)        else:            start, end = job["grid"]["start"], job["grid"]["end"]            print("Resume: {} EB and {} WB chunks are done".format(len(job["chunks"].get("eb", [])),                                                                 len(job["chunks"].get("wb", []))))        config["chunk_start"], config["chunk_end"] = start, end        num_chunks = len(list(decimal_range(start, end, chunk_size or end-start)))                 mp_manager = Manager()        bulk_write_queue = make_transport(transport, manager=mp_manager, maxsize=max_queue_size,                                          backpressure=backpressure, spill_dir=spill_dir)                print("Starting EB transform...")        eb_proc = Process(target=transform_beta, args=("eb", config, bulk_write_queue, chunk_size, interpolate, engine, write_mode, transport,)) # write collection information to __METADATA__ collection. Only write once        eb_proc.start()        print("Starting WB transform...")        wb_proc = Process(target=transform_beta, args=("wb", config, bulk_write_queue, chunk_size, interpolate, engine, write_mode, transport,))        wb_proc.start()                print("Starting bulk_write...")        bw_proc = Process(target=batch_write, args=(config, bulk_write_queue, True, write_mode,))        bw_proc.start()                ends_to_put = 0 # bulk_write runs until it gets a None, put once the transform processes are done        transform_done = False        while True:            if not transform_done and not (eb_proc.is_alive() or wb_proc.is_alive()):                transform_done = True # everything they sent is in the queue                ends_to_put += 1                        if not bw_proc.is_alive():                if bw_proc.exitcode == 0: # got the end                    break                # restart bulk_write                # (a chunk is committed only by the bulk_write that received all of it, the others are redone on resume)                print("bulk_write failed with exit code {}, restart it".format(bw_proc.exitcode))                if transform_done:                    ends_to_put += 1 # the failed one may have taken the end                bw_proc = Process(target=batch_write, args=(config, bulk_write_queue, False, write_mode,))                bw_proc.start()                        while ends_to_put: # without blocking on a full queue, so that a failed bulk_write is still restarted                try:                    bulk_write_queue.put(None, block=False)                    ends_to_put -= 1                except queue.Full:                    break                            time.sleep(1)                eb_proc.join()        wb_proc.join()        bw_proc.join()        if transport == "shared_memory":            bulk_write_queue.close()        print("Writer queue: " + bulk_write_queue.stats())                chunks = manifest.load()["chunks"]        if any(len(chunks.get(direction, [])) < num_chunks for direction in ["eb", "wb"]):            print("Transform incomplete, run transform2 again to resume")            return        manifest.complete()        if incremental:            write_high_water_mark(self.client, config, high_water_field, until)        print("TRANSFORMATION TO THE DARK SIDE COMPLETE.")                            return    def _transform_sharded(self, config, num_workers, halo, chunk_size, interpolate, engine, write_mode, manifest,                           params, job=None, until=None):        """        Run transform2 with num_workers transform_shard processes, each owns a time range of the output        The shards of job (a manifest to resume) that are committed already are skipped        Only the trajectories that match config["query_filter"] are transformed, if specified. until is stored with the job        :returns: True if every shard is committed        """        from multiprocessing import Process        from .transform2 import transform_shard, shard_ranges, write_metadata        from_collection = self.client[config["read_database_name"]][config["read_collection_name"]]        query_filter = config.get("query_filter", {})        if job is None:            start = from_collection.find_one(query_filter, {"first_timestamp": 1}, sort=[("first_timestamp", 1)])["first_timestamp"]            end = from_collection.find_one(query_filter, {"last_timestamp": 1}, sort=[("last_timestamp", -1)])["last_timestamp"]            if halo is None:                # the longest trajectory                pipeline = [{"$match": query_filter},                            {"$group": {"_id": None, "duration": {"$max": {"$subtract": ["$last_timestamp", "$first_timestamp"]}}}}]                halo = list(from_collection.aggregate(pipeline))[0]["duration"] + 1            manifest.start(params, grid={"start": start, "end": end, "halo": halo}, until=until)            committed = set()        else:            start, end, halo = job["grid"]["start"], job["grid"]["end"], job["grid"]["halo"]            committed = set(job["chunks"].get("shards", []))            print("Resume: {} of {} shards are done".format(len(committed), num_workers))                    write_metadata(self.client, config)                procs = []        for shard_index, (shard_start, shard_end) in enumerate(shard_ranges(start, end, num_workers)):            if shard_index in committed:                continue            print("Starting transform for shard [{}, {})...".format(shard_start, shard_end))            proc = Process(target=transform_shard, args=(config, shard_start, shard_end, halo, chunk_size, interpolate, engine, write_mode, shard_index,))            proc.start()            procs.append(proc)                    for proc in procs:            proc.join()                if len(manifest.committed_chunks("shards")) < num_workers:            print("Transform incomplete, run transform2 again to resume")            return False        manifest.complete()        return True                def read_query(self, query_filter, query_sort = None,                   limit = 0, projection = None, batch_size = 0, hint = None, max_time_ms = None, columnar = False):        """        Executes a read query against the database collection.        :param query_filter: Currently a dict following pymongo convention (need to abstract this).        :param query_sort: List of tuples: (field_to_sort, sort_direction); direction is ASC/ASCENDING or DSC/DESCENDING        :param limit: Numerical limit for number of documents returned by query.        :param projection: Fields to return, either a pymongo projection or a name in projections.PROJECTIONS            (e.g., "bounds", "positions", "full"). None returns whole documents.        :param batch_size: Number of documents per batch fetched from the server, 0 for the server default.        :param hint: Index to use, an index name or a list of (field, direction) like in pymongo.        :param max_time_ms: Time limit of the query on the server in milliseconds.        :param columnar: If True, decode the result straight from raw BSON to numpy arrays and return them            (see columnar.decode_columnar) instead of a cursor. Array fields are flat with offsets, e.g.,            result["x_position"][result["offsets"]["x_position"][i]:result["offsets"]["x_position"][i+1]]            is the x_position of document i, or use columnar.split(result, "x_position")        :return:        """        if query_sort is not None:            sort_fields = []            for sort_field, sort_dir in query_sort:                if sort_dir.upper() in ('ASC', 'ASCENDING'):                    sort_fields.append((sort_field, pymongo.ASCENDING))                elif sort_dir.upper() in ('DSC', 'DESCENDING'):                    sort_fields.append((sort_field, pymongo.DESCENDING))                else:                    raise ValueError("Invalid direction for sort. Use 'ASC'/'ASCENDING' or 'DSC'/'DESCENDING'.")        else:            sort_fields = None        # If user passed None, substitute an empty dictionary (per the PyMongo convention).        if query_filter is None:            filter_field = {}        else:            filter_field = query_filter        projection = resolve_projection(projection)        if columnar:            from .columnar import decode_columnar, projected_fields, RAW_CODEC_OPTIONS            collection = self.collection.with_options(codec_options=RAW_CODEC_OPTIONS)        else:            collection = self.collection        result = collection.find(filter=filter_field, projection=projection, limit=limit,                                 sort=sort_fields, batch_size=batch_size, hint=hint, max_time_ms=max_time_ms)        if columnar:            return decode_columnar(result, projected_fields(projection))        # return the pymongo.cursor.Cursor        return result        # TODO: also datetime for range bounds??    def read_query_range(self, range_parameter,                         range_greater_than = None,                         range_greater_equal= None,                         range_less_than = None,                         range_less_equal = None,                         range_increment = None,                         query_sort = None,                         limit = 0,                         query_filter = {},                         projection = None,                         batch_size = 0,                         hint = None,                         max_time_ms = None,                         columnar = False,                         prefetch = 0,                         docs_per_window = None,                         bytes_per_window = None):        """        Iterate across a query range in portions.        Usage:        ```            # Method 1: FOR loop across function call            for result in dbr.read_query_range(range_parameter='t', range_greater_than=0, range_less_equal=100,                                                range_increment=10):                print(result)                            # prefetched windows: close the iterator if the loop may stop early            with dbr.read_query_range(range_parameter='t', range_greater_equal=0, range_less_than=100,                                      range_increment=10, prefetch=2) as windows:                for result in windows:                    print(result)            # Method 2: WHILE loop with next(...)            rqr = dbr.read_query_range(range_parameter='t', range_greater_equal=0, range_less_than=100,                                        range_increment=10)            while True:                try:                    result = next(rqr)                    print(result)                except StopIteration:                    print("END OF ITERATION")                    break        ```        :param range_parameter: One document field across which to run range queries.        :param range_greater_than: Sets a '>' bound on `range_parameter` for the query or successive queries.        :param range_greater_equal: Sets a '>' bound on `range_parameter` for the query or successive queries.        :param range_less_than: Sets a '>' bound on `range_parameter` for the query or successive queries.        :param range_less_equal: Sets a '>' bound on `range_parameter` for the query or successive queries.        :param range_increment: When None, executes the range query as a one-off and returns result; otherwise,            returns iterable of queries/results.        :param query_sort: List of tuples: (field_to_sort, sort_direction); direction is ASC/ASCENDING or DSC/DESCENDING        :param limit: Numerical limit for number of documents returned by query.        :param query_filter: other query items            e.g., {"compute_node_id":"videonode2", "direction":-1}        :param projection, batch_size, hint, max_time_ms, columnar: see read_query, applied to every range-segmented query        :param prefetch: number of windows read ahead by background threads while the current one is consumed.            Prefetched windows are materialized (lists of documents, or numpy arrays if columnar) instead of cursors,            and at most [prefetch] of them are buffered at any time.        :param docs_per_window, bytes_per_window: adaptive windows instead of range_increment. Window boundaries are            placed so that each window holds about docs_per_window documents, or bytes_per_window bytes of documents            (see adaptive_windows)        :return: iterator across range-segmented queries (each query executes when __next__() is called in iteration)        """        # # no bounds: raise error TODO: start querying from the min value        # if range_greater_than is None and range_greater_equal is None and range_less_than is None \        #         and range_less_equal is None:        #     raise ValueError("Must specify lower and or upper bound (inclusive or exlusive) for range query.")                    # # only bounded on one side: TODO: start querying from the min value        # if (range_greater_than is None and range_greater_equal is None) or \        #         (range_less_than is None and range_less_equal is None):        #     raise NotImplementedError("Infinite ranges not currently supported.")                        query_filter = copy.deepcopy(query_filter) if query_filter else {}                # if no range_increment, query everything between lower bound and upper bound        if range_increment is None and docs_per_window is None and bytes_per_window is None:            # more operations: https://www.mongodb.com/docs/manual/reference/operator/query/            bounds = (range_greater_than, range_greater_equal, range_less_than, range_less_equal)            return self.read_query(query_filter=window_filter(range_parameter, bounds, query_filter), query_sort=query_sort,                                   limit=limit, projection=projection, batch_size=batch_size, hint=hint,                                   max_time_ms=max_time_ms, columnar=columnar)                if range_greater_equal is not None: # left closed [a, ~            start, start_closed = range_greater_equal, True        elif range_greater_than is not None: # left open (a, ~            start, start_closed = range_greater_than, False        else:            # TODO: temporarily set start and end point to the min and max values. For live stream, this is not applicable.            start, start_closed = self.get_min(range_parameter), True        if range_less_equal is not None: # right closed a, b]            stop, stop_closed = range_less_equal, True        elif range_less_than is not None: # right open a, b)            stop, stop_closed = range_less_than, False        else:            # TODO: temporarily set start and end point to the min and max values. Works on static database collections only.            stop, stop_closed = self.get_max(range_parameter), True        windows = None        if docs_per_window is not None or bytes_per_window is not None:            windows = tuple(self.adaptive_windows(range_parameter, start, stop, start_closed, stop_closed,                                                  docs_per_window=docs_per_window, bytes_per_window=bytes_per_window,                                                  query_filter=query_filter))        options = {"limit": limit, "projection": projection, "batch_size": batch_size, "hint": hint,                   "max_time_ms": max_time_ms, "columnar": columnar}        spec = RangeQuery(range_parameter, start, stop, start_closed, stop_closed, range_increment, windows,                          query_filter, query_sort, options, prefetch)        return DBReadRangeIterator(self, spec)    def adaptive_windows(self, range_parameter, start, stop, start_closed=True, stop_closed=False,                         docs_per_window=None, bytes_per_window=None, query_filter=None, sample_size=10000):        """        Windows of [start, stop] with about the same number of documents, from a $bucketAuto histogram of            range_parameter (see range_query.adaptive_windows). Windows are cached per collection and arguments,            clear self.window_cache to recompute them after the collection changed.        :param docs_per_window: target number of documents per window        :param bytes_per_window: target size of a window, converted to documents with the average document size        :param sample_size: estimate the histogram on a sample of this many documents for larger ranges        :return: list of window bounds (gt, gte, lt, lte)        """        if docs_per_window is None:            avg_size = self.db.command("collStats", self.collection_name).get("avgObjSize") or 1            docs_per_window = max(1, bytes_per_window // avg_size)        key = (self.collection.full_name, range_parameter, start, stop, start_closed, stop_closed, docs_per_window,               repr(query_filter), sample_size)        if key not in self.window_cache:            self.window_cache[key] = adaptive_windows(self.collection, range_parameter, start, stop, docs_per_window,                                                      start_closed, stop_closed, query_filter, sample_size)        return self.window_cache[key]        def parallel_scan(self, range_parameter, start=None, stop=None, num_partitions=4, ordered=True, processes=False,                      query_filter=None, projection=None, batch_size=1000, max_buffered_batches=4):        """        Read all documents with range_parameter in [start, stop] with num_partitions concurrent queries, each on            an equal partition of the range (see parallel_scan.parallel_scan).        Usage:        ```            for doc in dbc.parallel_scan("first_timestamp", num_partitions=8, ordered=False, projection="bounds"):                print(doc)        ```        :param range_parameter: field to partition on, preferably indexed (e.g., first_timestamp, last_timestamp)        :param start, stop: range bounds, both inclusive. Default to the min and max of range_parameter        :param num_partitions: number of partitions, read at the same time        :param ordered: if True, documents are yielded in range_parameter order, otherwise as they arrive (faster)        :param processes: if True, partitions are read by processes with their own connection instead of threads        :param query_filter: other query items        :param projection: see read_query        :param batch_size: documents are passed from the workers in batches of batch_size        :param max_buffered_batches: how many batches a worker reads ahead of the consumer        :return: generator of documents        """        if start is None or stop is None:            first, last = self.get_first(range_parameter), self.get_last(range_parameter)            if first is None or last is None: # empty collection                return iter([])            start = first[range_parameter] if start is None else start            stop = last[range_parameter] if stop is None else stop        return parallel_scan(self.collection, range_parameter, start, stop, num_partitions=num_partitions,                             ordered=ordered, processes=processes, connection_params=self.connection_params,                             query_filter=query_filter, projection=resolve_projection(projection),                             batch_size=batch_size, max_buffered_batches=max_buffered_batches)class DBReadRangeIterator:    """    Iterable class for executing successive queries using a DBReader. Each iterator holds its own RangeQuery, and        nothing is stored on the DBReader, so any number of them can run concurrently on one client (and its pool).    With prefetch > 0, the next windows are queried by a thread pool while the current one is consumed. The pool is        shut down at the end of the range; an iterator that is left before that should be closed, e.g.,        `with dbc.read_query_range(..., prefetch=2) as windows:`    """    def __init__(self, db_reader, spec):        """        :param db_reader: DBClient that runs the queries        :param spec: range_query.RangeQuery        """        self._reader = db_reader        self.spec = spec        self._windows = spec.iter_windows()        self._prefetch = spec.prefetch        self._executor = ThreadPoolExecutor(max_workers=self._prefetch) if self._prefetch else None        self._pending = deque() # futures of prefetched windows, in range order    def _read_window(self, bounds):        """        Query one window, materialized if prefetched        :param bounds: (gt, gte, lt, lte) of the window, see range_query.range_windows        """        query_filter = window_filter(self.spec.range_parameter, bounds, self.spec.query_filter)        result = self._reader.read_query(query_filter=query_filter, query_sort=self.spec.query_sort, **self.spec.options)        if self._prefetch and not self.spec.options["columnar"]:            return list(result)        return result    def _fill(self):        """        Start prefetching windows until [prefetch] are pending        """        while len(self._pending) < self._prefetch:            bounds = next(self._windows, None)            if bounds is None:                break            self._pending.append(self._executor.submit(self._read_window, bounds))    def close(self):        """        Stop prefetching. Windows not returned yet are discarded.        """        if self._executor is not None:            for future in self._pending:                future.cancel()            self._pending.clear()            self._executor.shutdown(wait=False)            self._executor = None    def __del__(self):        self.close()    def __enter__(self):        return self    def __exit__(self, exc_type, exc_value, traceback):        self.close()    def __next__(self):        """        Runs the next range query (see range_query.range_windows for the windows), or returns the next prefetched            window. Raises StopIteration exception when complete.        :return: result of next read query within the iteration range        """        if self._prefetch:            if self._executor is not None:                self._fill()            if not self._pending:                self.close()                raise StopIteration            future = self._pending.popleft()            self._fill() # keep [prefetch] windows in flight while this one is consumed            return future.result()        bounds = next(self._windows, None)        if bounds is None:            raise StopIteration        return self._read_window(bounds)    def __iter__(self):        """        Needed in order to place DBReader.read_range_query(...) into a FOR loop.        :return: self        """        return self
\ No newline at end of file
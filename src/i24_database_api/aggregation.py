@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Server-side engine for DBClient.transform: the vehicle-to-timestamp pivot of RECONCILED trajectories runs as an
+aggregation pipeline inside MongoDB, so that trajectory documents never travel to the client and back.
+
+pipeline, per range of first_timestamp:
+    $match first_timestamp range -> $zip timestamp, x_position, y_position -> $unwind samples
+    -> bin timestamps on the 0.04s grid (same labels as resample.resample_batch with origin="epoch")
+    -> $group by (vehicle, bin), average -> $group by bin, push id and position
+    -> $merge into the transformed collection on timestamp, appending the vehicles that are not in the existing
+       document yet to its id and position, so that a range can be merged again after a failure
+
+Unlike the python engine, bins that have no sample are not interpolated: a vehicle is left out of the timestamps
+between two of its samples that are more than 0.04s apart, where the python engine has its interpolated position.
+This makes no difference for reconciled trajectories that are uniformly sampled at 25Hz already.
+test/test_aggregation.py checks the pipeline against resample.resample_batch(interpolate=False).
+Requires MongoDB >= 4.2 ($merge, $round).
+"""
+
+import pymongo
+
+from .job_manifest import JobManifest
+
+from .resample import NS_PER_SEC, DT_NS, decimal_range
+
+ENGINES = ["python", "aggregate", "auto"]
+
+
+def timestamp_bin(field):
+    '''
+    Aggregation expression of the label of the 0.04s bin of a timestamp in seconds, rounded to 2 digits
+    float to nanosecond conversion follows resample.to_ns, the arithmetic after that is on longs
+    '''
+    base = {"$trunc": field}
+    frac = {"$round": [{"$subtract": [field, base]}, 9]}
+    ns = {"$add": [{"$multiply": [{"$toLong": base}, NS_PER_SEC]},
+                   {"$toLong": {"$trunc": {"$multiply": [frac, NS_PER_SEC]}}}]}
+    return {"$let": {
+        "vars": {"ns": ns},
+        "in": {"$round": [{"$multiply": [{"$subtract": ["$$ns", {"$mod": ["$$ns", DT_NS]}]}, 1e-9]}, 2]}
+        }}
+
+
+def reconciled_pipeline(range_start, range_end, write_database_name, write_collection_name):
+    '''
+    Aggregation pipeline that transforms the RECONCILED trajectories with first_timestamp in [range_start, range_end)
+    and merges the result into write_database_name.write_collection_name, which needs a unique index on timestamp
+    '''
+    return [
+        {"$match": {"first_timestamp": {"$gte": range_start, "$lt": range_end}}},
+        {"$project": {
+            "configuration_id": 1,
+            "sample": {"$zip": {"inputs": ["$timestamp", "$x_position", "$y_position"]}}
+            }},
+        {"$unwind": "$sample"},
+        {"$project": {
+            "configuration_id": 1,
+            "timestamp": timestamp_bin({"$arrayElemAt": ["$sample", 0]}),
+            "x": {"$arrayElemAt": ["$sample", 1]},
+            "y": {"$arrayElemAt": ["$sample", 2]}
+            }},
+        # average the samples of a vehicle that fall in the same bin
+        {"$group": {
+            "_id": {"id": "$_id", "timestamp": "$timestamp"},
+            "configuration_id": {"$first": "$configuration_id"},
+            "x": {"$avg": "$x"},
+            "y": {"$avg": "$y"}
+            }},
+        {"$group": {
+            "_id": "$_id.timestamp",
+            "configuration_id": {"$first": "$configuration_id"},
+            "id": {"$push": "$_id.id"},
+            "position": {"$push": ["$x", "$y"]}
+            }},
+        {"$project": {"_id": 0, "timestamp": "$_id", "configuration_id": 1, "id": 1, "position": 1}},
+        {"$merge": {
+            "into": {"db": write_database_name, "coll": write_collection_name},
+            "on": "timestamp",
+            "whenMatched": [
+                # [id, position] of the vehicles that are not in the document yet
+                {"$set": {"_new": {"$filter": {
+                    "input": {"$zip": {"inputs": ["$$new.id", "$$new.position"]}},
+                    "cond": {"$not": [{"$in": [{"$arrayElemAt": ["$$this", 0]}, "$id"]}]}
+                    }}}},
+                {"$set": {
+                    "id": {"$concatArrays": ["$id", {"$map": {"input": "$_new", "in": {"$arrayElemAt": ["$$this", 0]}}}]},
+                    "position": {"$concatArrays": ["$position", {"$map": {"input": "$_new", "in": {"$arrayElemAt": ["$$this", 1]}}}]}
+                    }},
+                {"$unset": "_new"}
+                ],
+            "whenNotMatched": "insert"
+            }}
+        ]
+
+
+def supports_aggregate(client, collection):
+    '''
+    True if the aggregate engine can transform collection: the server supports $merge and
+    the trajectories are RECONCILED (length is a number, see Transformation.determine_mode)
+    '''
+    version = tuple(client.server_info()["versionArray"][:2])
+    first_doc = collection.find_one({}, {"length": 1})
+    return version >= (4, 2) and first_doc is not None and not isinstance(first_doc.get("length"), list)
+
+
+def transform_aggregate(client, config, chunk_size=60, resume=True):
+    '''
+    Transform config["read_collection_name"] to config["write_collection_name"] with reconciled_pipeline,
+    one aggregation per [chunk_size] sec of first_timestamp
+    The write collection is reset, like in BatchUpdate, unless a job with the same parameters stopped partway and
+    resume is True: then only the ranges it did not complete are aggregated (see job_manifest.py)
+    '''
+    from_collection = client[config["read_database_name"]][config["read_collection_name"]]
+    to_collection = client[config["write_database_name"]][config["write_collection_name"]]
+    manifest = JobManifest(client[config["write_database_name"]], config["write_collection_name"])
+    params = {"transform": "transform", "engine": "aggregate", "read_database_name": config["read_database_name"],
+              "read_collection_name": config["read_collection_name"], "chunk_size": chunk_size}
+    job = manifest.resumable(params) if resume else None
+
+    if job is not None:
+        start, end = job["grid"]["start"], job["grid"]["end"]
+        done = set(job["chunks"].get("aggregate", []))
+        print("Resume, {} ranges are done".format(len(done)))
+    else:
+        to_collection.drop()
+        first_doc = from_collection.find_one({}, {"first_timestamp": 1}, sort=[("first_timestamp", pymongo.ASCENDING)])
+        if first_doc is None:
+            return
+        start = first_doc["first_timestamp"]
+        end = from_collection.find_one({}, {"first_timestamp": 1}, sort=[("first_timestamp", pymongo.DESCENDING)])["first_timestamp"]
+        manifest.start(params, grid={"start": start, "end": end})
+        done = set()
+    to_collection.create_index("timestamp", unique=True)
+
+    for i, s in enumerate(decimal_range(start, end, chunk_size)):
+        if i in done:
+            continue
+        print("In progress (approx) {:.1f} %".format((s-start)/max(end-start, 1e-9)*100), end='\r')
+        pipeline = reconciled_pipeline(s, s+chunk_size, config["write_database_name"], config["write_collection_name"])
+        from_collection.aggregate(pipeline, allowDiskUse=True)
+        manifest.commit_chunk("aggregate", i)
+    manifest.complete()
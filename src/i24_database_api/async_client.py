@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio counterpart of DBClient on motor, for event-loop based services: queries and writes are awaited instead
+of blocking the loop. Range windows are iterated with `async for`, or fetched concurrently with gather_range.
+motor is an optional dependency: pip install i24_database_api[async]
+"""
+
+import asyncio
+import warnings
+import pymongo
+
+from .projections import resolve_projection
+from .range_query import range_windows, window_filter
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+
+def _sort_fields(query_sort):
+    if query_sort is None:
+        return None
+    sort_fields = []
+    for sort_field, sort_dir in query_sort:
+        if sort_dir.upper() in ('ASC', 'ASCENDING'):
+            sort_fields.append((sort_field, pymongo.ASCENDING))
+        elif sort_dir.upper() in ('DSC', 'DESCENDING'):
+            sort_fields.append((sort_field, pymongo.DESCENDING))
+        else:
+            raise ValueError("Invalid direction for sort. Use 'ASC'/'ASCENDING' or 'DSC'/'DESCENDING'.")
+    return sort_fields
+
+
+class AsyncDBClient:
+    """
+    MongoDB client on motor, specific to a collection in the database, see DBClient.
+    Nothing is sent to the server on construction; `async with AsyncDBClient(...)` (or await connect()) tests the connection.
+    """
+
+    def __init__(self, host=None, port=27017, username=None, password=None, database_name=None, collection_name=None,
+                 max_concurrency=8, **client_kwargs):
+        """
+        :param host, port, username, password, database_name, collection_name: see DBClient
+        :param max_concurrency: default number of windows read at the same time by gather_range
+        :param client_kwargs: passed to motor's AsyncIOMotorClient, e.g., maxPoolSize
+        """
+        if AsyncIOMotorClient is None:
+            raise ImportError("AsyncDBClient requires motor. Install it with pip install i24_database_api[async]")
+        self.client = AsyncIOMotorClient(host=host, port=port, username=username, password=password,
+                                         connectTimeoutMS=5000, **client_kwargs)
+        self.max_concurrency = max_concurrency
+        self.database_name = database_name
+        self.collection_name = collection_name
+        self.db = self.client[database_name] if database_name is not None else None
+        self.collection = self.db[collection_name] if self.db is not None and collection_name else None
+
+    async def connect(self):
+        try:
+            await self.client.admin.command('ping')
+        except pymongo.errors.ConnectionFailure:
+            warnings.warn("Server not available")
+            raise ConnectionError("Could not connect to MongoDB.")
+        return self
+
+    def close(self):
+        self.client.close()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def get_latest_collection(self):
+        '''
+        name of the collection whose first document was created last, empty collections are dropped (like DBClient)
+        '''
+        latest, latest_time = None, None
+        for col in await self.db.list_collection_names():
+            doc = await self.db[col].find_one({}, {"_id": 1})
+            if doc is None:
+                await self.db[col].drop()
+                continue
+            gen_time = doc["_id"].generation_time
+            if latest_time is None or gen_time >= latest_time:
+                latest, latest_time = col, gen_time
+        return latest
+
+    def read_query(self, query_filter, query_sort=None, limit=0, projection=None, batch_size=0, hint=None,
+                   max_time_ms=None):
+        """
+        Executes a read query against the database collection, see DBClient.read_query
+        :return: motor cursor, use `async for doc in cursor` or `await cursor.to_list(None)`
+        """
+        return self.collection.find(filter=query_filter or {}, projection=resolve_projection(projection), limit=limit,
+                                    sort=_sort_fields(query_sort), batch_size=batch_size, hint=hint,
+                                    max_time_ms=max_time_ms)
+
+    async def read_window(self, query_filter, query_sort=None, limit=0, projection=None, batch_size=0, hint=None,
+                          max_time_ms=None, columnar=False):
+        """
+        read_query, materialized: a list of documents, or numpy arrays if columnar (see DBClient.read_query)
+        """
+        projection = resolve_projection(projection)
+        if columnar:
+            from .columnar import decode_columnar, projected_fields, RAW_CODEC_OPTIONS
+            collection = self.collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+        else:
+            collection = self.collection
+        cursor = collection.find(filter=query_filter or {}, projection=projection, limit=limit,
+                                 sort=_sort_fields(query_sort), batch_size=batch_size, hint=hint, max_time_ms=max_time_ms)
+        docs = await cursor.to_list(None)
+        if columnar:
+            return decode_columnar(docs, projected_fields(projection))
+        return docs
+
+    async def _range_bound(self, range_parameter, direction):
+        doc = await self.collection.find_one({range_parameter: {"$exists": True}}, {range_parameter: 1},
+                                             sort=[(range_parameter, direction)])
+        return doc[range_parameter] if doc is not None else None
+
+    async def _windows(self, range_parameter, range_greater_than, range_greater_equal, range_less_than,
+                       range_less_equal, range_increment):
+        if range_greater_equal is not None:
+            start, start_closed = range_greater_equal, True
+        elif range_greater_than is not None:
+            start, start_closed = range_greater_than, False
+        else:
+            start, start_closed = await self._range_bound(range_parameter, pymongo.ASCENDING), True
+        if range_less_equal is not None:
+            stop, stop_closed = range_less_equal, True
+        elif range_less_than is not None:
+            stop, stop_closed = range_less_than, False
+        else:
+            stop, stop_closed = await self._range_bound(range_parameter, pymongo.DESCENDING), True
+        if start is None or stop is None: # empty collection
+            return []
+        return list(range_windows(start, stop, range_increment, start_closed, stop_closed))
+
+    def read_query_range(self, range_parameter, range_greater_than=None, range_greater_equal=None,
+                         range_less_than=None, range_less_equal=None, range_increment=None, query_sort=None,
+                         limit=0, query_filter=None, projection=None, batch_size=0, hint=None, max_time_ms=None,
+                         columnar=False):
+        """
+        Iterate across a query range in portions, see DBClient.read_query_range
+        Usage:
+        ```
+            async for window in dbc.read_query_range(range_parameter='t', range_greater_equal=0, range_less_than=100,
+                                                     range_increment=10):
+                print(len(window))
+        ```
+        :return: if range_increment is None, a motor cursor over the whole range. Otherwise an async iterator of
+            the windows, each a list of documents (or numpy arrays if columnar)
+        """
+        options = {"query_sort": query_sort, "limit": limit, "projection": projection, "batch_size": batch_size,
+                   "hint": hint, "max_time_ms": max_time_ms}
+        if range_increment is None:
+            bounds = (range_greater_than, range_greater_equal, range_less_than, range_less_equal)
+            return self.read_query(window_filter(range_parameter, bounds, query_filter), **options)
+        return AsyncDBReadRangeIterator(self, range_parameter, (range_greater_than, range_greater_equal,
+                                        range_less_than, range_less_equal), range_increment, query_filter,
+                                        dict(options, columnar=columnar))
+
+    async def gather_range(self, range_parameter, range_increment, range_greater_than=None, range_greater_equal=None,
+                           range_less_than=None, range_less_equal=None, query_filter=None, max_concurrency=None,
+                           **options):
+        """
+        Read all windows of read_query_range at once, at most max_concurrency (default self.max_concurrency) at a time
+        :param options: query_sort, limit, projection, batch_size, hint, max_time_ms, columnar, see read_query_range
+        :return: list of the windows, in range order
+        """
+        windows = await self._windows(range_parameter, range_greater_than, range_greater_equal, range_less_than,
+                                      range_less_equal, range_increment)
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+
+        async def read(bounds):
+            async with semaphore:
+                return await self.read_window(window_filter(range_parameter, bounds, query_filter), **options)
+
+        return list(await asyncio.gather(*(read(bounds) for bounds in windows)))
+
+    async def insert_one_schema_validation(self, collection, document):
+        """
+        insert_one, and insert anyways bypassing the validation if the schema is violated (see DBClient)
+        """
+        try:
+            await collection.insert_one(document, bypass_document_validation=False)
+        except pymongo.errors.WriteError as e: # schema violated
+            warnings.warn("Schema violated. Insert anyways. Full error: {}".format(e), UserWarning)
+            await collection.insert_one(document, bypass_document_validation=True)
+
+    async def write_one_trajectory(self, collection_name=None, **kwargs):
+        """
+        Write an arbitrary document specified in kwargs to a specified collection, see DBClient.write_one_trajectory
+        Concurrent writes: await asyncio.gather(*(dbc.write_one_trajectory(**traj) for traj in trajs))
+        """
+        col = self.db[collection_name] if collection_name is not None else self.collection
+        await self.insert_one_schema_validation(col, dict(kwargs))
+
+
+class AsyncDBReadRangeIterator:
+    """
+    Async iterator of the windows of AsyncDBClient.read_query_range. Holds its own query, so any number of them
+    can run on one client.
+    """
+
+    def __init__(self, db_client, range_parameter, bounds, range_increment, query_filter, options):
+        self._client = db_client
+        self._range_parameter = range_parameter
+        self._bounds = bounds
+        self._range_increment = range_increment
+        self._query_filter = query_filter
+        self._options = options
+        self._windows = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._windows is None: # resolve missing bounds on the first window
+            gt, gte, lt, lte = self._bounds
+            self._windows = iter(await self._client._windows(self._range_parameter, gt, gte, lt, lte,
+                                                             self._range_increment))
+        try:
+            bounds = next(self._windows)
+        except StopIteration:
+            raise StopAsyncIteration
+        return await self._client.read_window(window_filter(self._range_parameter, bounds, self._query_filter),
+                                              **self._options)
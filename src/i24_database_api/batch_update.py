@@ -4,43 +4,93 @@ Created on Thu Jun 23
 
 """
 from sys import breakpointhook
-from pymongo import MongoClient, UpdateOne
+from pymongo import UpdateOne
 from pymongo.errors import BulkWriteError
 from sqlite3 import OperationalError
 from multiprocessing import Queue
 from pprint import pprint
 from typing import Dict
+from collections import deque
 import pymongo
 import queue
 import json
+import math
 import time
 
+from .time_index_writer import insert_closed, TimestampAccumulator
+from .transformation import transform_trajectory
+from .transport import unpack_trajectories
+from .connections import get_client
+from .job_manifest import JobManifest
+from .change_stream_reader import FileTokenStore, RESUME_TOKEN
+
 class BatchUpdate:
-    def __init__(self, config, staleness_threshold=50):
+    def __init__(self, config, max_cache_size=None, write_mode=None, streaming=None, allowed_lateness=None,
+                 idle_timeout=None, token_store=None):
         """
-        :param staleness_threshold: Number of new documents read that do not update a time until that
-        time is inserted to the transformed collection
+        :param max_cache_size: Maximum number of open timestamps in the cache. If exceeded, the earliest ones are
+            written before they are complete, and merged with the rest later. Defaults to config["max_cache_size"]
+            if exists, otherwise no limit
+        :param write_mode: "upsert": closed timestamps are written with UpdateOne(upsert=True)
+            "insert": closed timestamps are inserted with insert_many as complete documents
+            Defaults to config["write_mode"] if exists, otherwise "upsert"
+        :param streaming: run until a None arrives on the queue instead of exiting when it is idle, and close
+            timestamps by event time (dynamic collection). Defaults to config["streaming"] if exists, otherwise False
+        :param allowed_lateness: streaming, in sec: timestamps are closed once a trajectory that ends this much later
+            arrived. Defaults to config["allowed_lateness"] if exists, otherwise 60
+        :param idle_timeout: streaming, in sec: when no document arrived for this long, the watermark follows the
+            wall clock from the latest trajectory end, so that timestamps are written with bounded latency.
+            Defaults to config["idle_timeout"] if exists, otherwise 1
+        :param token_store: FileTokenStore or CollectionTokenStore. The change stream resume tokens that arrive after
+            their batch ({"kind": RESUME_TOKEN, "token": token}) are saved to it once every timestamp of the batch is
+            written, along with the latest timestamp received before it. A restarted process keeps the timestamps
+            up to it and writes the later ones again from the replayed batches.
+            Defaults to a FileTokenStore of config["resume_token_file"] if exists
+        Timestamps are closed by watermark: documents arrive sorted by first_timestamp (static collection), so
+        timestamps before the first timestamp of the latest document are complete. In streaming mode, documents
+        arrive when the trajectory ends, so the watermark is the latest last timestamp minus allowed_lateness.
+        Pieces that arrive for a timestamp that is written already (late fragments) are merged into it with upserts.
+        If config["job_id"] is specified (static collection), the watermark is recorded in the job manifest every
+        config["checkpoint_interval"] sec (default 10): every timestamp below it is written completely.
+        A job that resumes from config["resume_from"] keeps the timestamps below it and drops its pieces of them.
+        Once a write failed, neither the manifest nor the resume token advance anymore, and main_loop raises at the
+        end, so that the job is run again from the last checkpoint.
         """
 
         '''
-        schema for _cache_data dictionary if MODE == 'RAW':
+        schema for _cache_data entries if MODE == 'RAW':
             {
                 time1: [configuration_id,   [id1,           id2,            id3,        ...], 
                                             [(x1,y1),       (x2,y2),        (x3,y3),    ...],
                                             [(l1,w1,h1),    (l2,w2,h2),     (l3,w3,h3), ...]],
                 time2: ...
             }
-        schema for _cache_data dictionary if MODE == 'RECONCILED':
+        schema for _cache_data entries if MODE == 'RECONCILED':
             {
                 time1: [configuration_id,   [id1,           id2,            id3,        ...], 
                                             [(x1,y1),       (x2,y2),        (x3, y3),   ...]
                 time2: ...
             }
         '''
-        self._cache_data={}
-        self._staleness={}
-        self.staleness_threshold=staleness_threshold
+        self._cache_data=TimestampAccumulator(max_cache_size or config.get("max_cache_size"))
+        self.write_mode=write_mode or config.get("write_mode", "upsert")
+        self.streaming=streaming if streaming is not None else config.get("streaming", False)
+        self.allowed_lateness=allowed_lateness if allowed_lateness is not None else config.get("allowed_lateness", 60)
+        self.idle_timeout=idle_timeout if idle_timeout is not None else config.get("idle_timeout", 1)
+        self.num_late=0 # pieces merged into timestamps that were written already
+        self.num_failed=0 # documents that could not be written
+        self._latest_event=None # latest trajectory end seen (streaming)
+        self._latest_arrival=None # wall clock time it arrived
+        self.resume_from=config.get("resume_from")
+        self.checkpoint_interval=config.get("checkpoint_interval", 10)
+        self._last_checkpoint=time.time()
+        if token_store is None and config.get("resume_token_file"):
+            token_store = FileTokenStore(config["resume_token_file"])
+        self.token_store=token_store
+        self._max_key=-math.inf # latest timestamp received
+        self._pending_tokens=deque() # (latest timestamp received before the token, token)
         self.connect_to_db(config)
+        self.manifest=JobManifest(self._database, config["job_id"]) if config.get("job_id") and not self.streaming else None
     
     def connect_to_db(self, config_params):
         """
@@ -63,16 +113,21 @@ class BatchUpdate:
         database=config_params['write_database_name']
         collection=config_params['write_collection_name']
 
-        self.client=MongoClient(host=client_host,
-                    port=client_port,
-                    username=client_username,
-                    password=client_password,
-                    connect=True,
-                    connectTimeoutMS=5000)
+        self.client=get_client(host=client_host, port=client_port, username=client_username, password=client_password)
     
         self._database=self.client[database]
-        # reset collection
-        self._database[collection].drop()
+        committed_until = self.token_store.committed_until() if self.token_store is not None else None
+        if config_params.get("resume_from") is not None:
+            # resume: timestamps below resume_from are complete, the rest is written again
+            self._database[collection].delete_many({"timestamp": {"$gte": config_params["resume_from"]}})
+        elif committed_until is not None:
+            # change stream restart: the batches after the saved token are replayed, and only they have pieces
+            # after committed_until
+            self._database[collection].delete_many({"timestamp": {"$gt": committed_until}})
+            self._max_key = committed_until
+        else:
+            # reset collection
+            self._database[collection].drop()
         self._collection=self._database[collection]
         
         # create timestamp index
@@ -87,69 +142,67 @@ class BatchUpdate:
     def write_to_mongo(self, staled_timestamps):
         """
         Performs bulk write to write all commands in staled_timestamps to MongoDB
-        :params staled_timestamps: a list of MongoDB UpdateOne() commands (upsert = True)
+        :params staled_timestamps: a list of MongoDB UpdateOne() commands (upsert = True),
+        and complete timestamp documents (closed timestamps, see make_document) which are inserted instead
         """
+        closed_docs = [cmd for cmd in staled_timestamps if isinstance(cmd, dict)]
+        update_cmds = [cmd for cmd in staled_timestamps if not isinstance(cmd, dict)]
+        try:
+            if closed_docs:
+                insert_closed(self._collection, closed_docs, self.merge_command)
+        except BulkWriteError as bwe:
+            self.write_failed(bwe)
+        if not update_cmds:
+            return
         try:
-            self._collection.bulk_write(staled_timestamps,ordered=False)
+            self._collection.bulk_write(update_cmds,ordered=False)
         except BulkWriteError as bwe:
-            pprint(bwe.details)
+            self.write_failed(bwe)
         # print("[BatchUpdate] inserted batch at time {}".format(str(time.time())))
 
-    def clear_cache(self, MODE):
+    def write_failed(self, bwe):
         """
-        Returns a list of MongoDB commands from the remaining timestamps inside of _staleness dictionary
-        :returns batch: a list of MongoDB UpdateOne() commands (upsert = True)
+        Report a failed bulk write, from now on nothing is checkpointed (see checkpoint, save_token)
         """
-        batch=[]
-        temp_list = list(self._staleness)
-        if MODE.value=="RAW":
-            for key in temp_list:
-                batch.append(
-                    UpdateOne(
-                        {'timestamp':key}, 
-                        {
-                            "$set":
-                                {
-                                    'timestamp':key,
-                                    "configuration_id":self._cache_data[key][0]
-                                }, 
-                            "$push":
-                                {
-                                    'id':{'$each':self._cache_data[key][1]},
-                                    'position':{'$each':self._cache_data[key][2]},
-                                    'dimensions':{'$each':self._cache_data[key][3]}
-                                }
-                        }, upsert=True)
-                    )
+        pprint(bwe.details)
+        self.num_failed += len(bwe.details["writeErrors"])
 
-                # print("[BatchUpdate] clearing from cache the timestamp: {}".format(key))
-                self._staleness.pop(key)
-                self._cache_data.pop(key)
+    def make_document(self, MODE, key, entry):
+        """
+        Assemble the complete document of a closed timestamp from its _cache_data entry
+        """
+        doc = {
+                'timestamp':key,
+                'configuration_id':entry[0],
+                'id':entry[1],
+                'position':entry[2]
+              }
+        if MODE.value == "RAW":
+            doc['dimensions'] = entry[3]
+        return doc
 
-        elif MODE.value =="RECONCILED":
-            for key in temp_list:
-                batch.append(
-                    UpdateOne(
-                        {'timestamp':key},
+    def merge_command(self, doc):
+        """
+        UpdateOne that pushes the content of a timestamp document into an existing one of the same timestamp
+        """
+        return UpdateOne(
+                {'timestamp':doc['timestamp']},
+                {
+                    "$set":
                         {
-                            "$set":
-                                {
-                                    'timestamp':key,
-                                    "configuration_id":self._cache_data[key][0]
-                                }, 
-                            "$push":
-                                {
-                                    'id':{'$each':self._cache_data[key][1]},
-                                    'position':{'$each':self._cache_data[key][2]}
-                                }
-                        }, upsert=True)
-                    )
-                
-                # print("[BatchUpdate] clearing from cache the timestamp: {}".format(key))
-                self._staleness.pop(key)
-                self._cache_data.pop(key)
+                            'timestamp':doc['timestamp'],
+                            'configuration_id':doc['configuration_id']
+                        },
+                    "$push":
+                        {key:{'$each':doc[key]} for key in ['id', 'position', 'dimensions'] if key in doc}
+                }, upsert=True)
 
-        return batch
+    def clear_cache(self, MODE):
+        """
+        Returns a list of MongoDB commands from the remaining timestamps inside of _cache_data
+        :returns batch: a list of MongoDB UpdateOne() commands (upsert = True)
+        """
+        return [self.merge_command(self.make_document(MODE, key, entry)) for key, entry in self._cache_data.pop_all()]
 
     def add_to_cache(self, MODE, timestamp_dict: Dict = None):
         """
@@ -169,133 +222,134 @@ class BatchUpdate:
                     'id': [id1, id2, ...],
                     'position': [(x1,y1), (x2,y2), ...]
                 }
+        Returns the commands that write the timestamps closed by this document, see write_to_mongo
         """
-        staled_timestamps=[]
-        subdoc_keys = list(timestamp_dict)
-
         if MODE.value == "RAW":
-            for key in list(self._staleness):
-                if key in timestamp_dict:
-                    # insert & update
-                    # timestamp_dict[key][0] is configuration_id -- skip
-                    self._cache_data[key][1].append(timestamp_dict[key][1]) #object id
-                    self._cache_data[key][2].append(timestamp_dict[key][2]) # (x, y)
-                    self._cache_data[key][3].append(timestamp_dict[key][3]) # (l, w, h)
-                    self._staleness[key] = 0
-                    subdoc_keys.remove(key)
-                else:
-                    # current key does not exist in subdoc_key, so 
-                    # increment its staleness
-                    self._staleness[key] += 1
-                    if(self._staleness[key]>=self.staleness_threshold and key <= next(iter(self._staleness))):
-                        staled_timestamps.append(
-                            UpdateOne(
-                                {'timestamp':key},
-                                {
-                                    "$set":
-                                        {
-                                            'timestamp':key,
-                                            'configuration_id':self._cache_data[key][0]
-                                        }, 
-                                    "$push":
-                                        {
-                                            'id':{'$each':self._cache_data[key][1]},
-                                            'position':{'$each':self._cache_data[key][2]},
-                                            'dimensions':{'$each':self._cache_data[key][3]}
-                                        }
-                                }, upsert=True)
-                            )
-                        # print("[BatchUpdate] Automatically removing staled timestamp: {}".format(key))
-                        self._staleness.pop(key)
-                        self._cache_data.pop(key)
-            # new keys that are in subdoc but not in staleness
-            # ... add to cache data
-            for key in subdoc_keys:
-                self._cache_data[key]=[]
-                self._cache_data[key].append(timestamp_dict[key][0]) #config id
-                self._cache_data[key].append([timestamp_dict[key][1]]) #object id
-                self._cache_data[key].append([timestamp_dict[key][2]]) #x, y
-                self._cache_data[key].append([timestamp_dict[key][3]]) #l,w,h
-                self._staleness[key]=0
-        
+            num_fields = 3 # object id, (x, y), (l, w, h)
         elif MODE.value == "RECONCILED":
-            for key in list(self._staleness):
-                if key in timestamp_dict:
-                    # insert & update
-                    # timestamp_dict[key][0] is configuration_id -- skip
-                    self._cache_data[key][1].append(timestamp_dict[key][1]) # object id
-                    self._cache_data[key][2].append(timestamp_dict[key][2]) #x, y
-                    self._staleness[key] = 0
-                    subdoc_keys.remove(key)
-                else:
-                    # current key does not exist in subdoc_key, so 
-                    # increment its staleness
-                    self._staleness[key] += 1
-                    if(self._staleness[key]>=self.staleness_threshold and key <= next(iter(self._staleness))):
-                        staled_timestamps.append(
-                            UpdateOne(
-                                {'timestamp':key},
-                                {
-                                    "$set":
-                                        {
-                                            'timestamp':key,
-                                            'configuration_id':self._cache_data[key][0]
-                                        },
-                                    "$push":
-                                        {
-                                            'id':{'$each':self._cache_data[key][1]},
-                                            'position':{'$each':self._cache_data[key][2]}
-                                        }
-                                },upsert=True)
-                            )
-                        # print("[BatchUpdate] Automatically removing staled timestamp: {}".format(key))
-                        self._staleness.pop(key)
-                        self._cache_data.pop(key)
-            # new keys that are in subdoc but not in staleness
-            # ... add to cache data
-            for key in subdoc_keys:
-                self._cache_data[key]=[]
-                self._cache_data[key].append(timestamp_dict[key][0]) #config id
-                self._cache_data[key].append([timestamp_dict[key][1]]) #object id
-                self._cache_data[key].append([timestamp_dict[key][2]]) #x, y
-                self._staleness[key]=0
+            num_fields = 2 # object id, (x, y)
         else:
             raise ValueError("Invalid MODE, must be either 'RAW' or 'RECONCILED'")
-            
+
+        if self.resume_from is not None:
+            timestamp_dict = {key: val for key, val in timestamp_dict.items() if key >= self.resume_from}
+        if not timestamp_dict:
+            return []
+        self._max_key = max(self._max_key, max(timestamp_dict))
+        staled_timestamps = []
+        for key, val in timestamp_dict.items():
+            if key < self._cache_data.watermark:
+                # late fragment, the timestamp is written already
+                self.num_late += 1
+                staled_timestamps.append(self.merge_command(self.make_document(MODE, key, [val[0]] + [[val[i]] for i in range(1, num_fields+1)])))
+                continue
+            # val[0] is configuration_id -- set once
+            entry = self._cache_data.setdefault(key, [val[0]] + [[] for _ in range(num_fields)])
+            for i in range(1, num_fields+1):
+                entry[i].append(val[i])
+
+        if self.streaming:
+            # documents arrive when their trajectory ends
+            self._latest_event = max(self._latest_event or -math.inf, max(timestamp_dict))
+            self._latest_arrival = time.time()
+            closed = self._cache_data.advance(self._latest_event - self.allowed_lateness)
+        else:
+            # documents arrive sorted by first_timestamp, so later ones start at or after the watermark
+            closed = self._cache_data.advance(min(timestamp_dict))
+        return staled_timestamps + self.closed_commands(MODE, closed + self._cache_data.spill())
+
+    def closed_commands(self, MODE, closed):
+        """
+        Commands that write the (timestamp, entry) pairs popped from _cache_data, see write_to_mongo
+        """
+        staled_timestamps = []
+        for key, entry in closed:
+            doc = self.make_document(MODE, key, entry)
+            staled_timestamps.append(doc if self.write_mode == "insert" else self.merge_command(doc))
         return staled_timestamps
 
+    def checkpoint(self, force=False):
+        """
+        Record in the job manifest that the timestamps below the watermark are written, at most every checkpoint_interval
+        """
+        if self.manifest is None or self.num_failed or self._cache_data.watermark == -math.inf:
+            return
+        if force or time.time() - self._last_checkpoint >= self.checkpoint_interval:
+            self.manifest.commit_until(self._cache_data.watermark)
+            self._last_checkpoint = time.time()
+
+    def save_token(self):
+        """
+        Save the latest resume token whose batch is written: the cache holds nothing up to the latest timestamp
+        received before it, and everything else is written as soon as it leaves the cache
+        """
+        if self.num_failed: # the batches after the failed write are read again
+            return
+        earliest_open = self._cache_data.earliest()
+        token = None
+        while self._pending_tokens and self._pending_tokens[0][0] < earliest_open:
+            max_key, token = self._pending_tokens.popleft()
+        if token is not None and self.token_store is not None:
+            self.token_store.save(token, committed_until=max_key if max_key > -math.inf else None)
+
+    def advance_idle(self, MODE):
+        """
+        Streaming: no document arrived for idle_timeout, advance the watermark as if event time went on with the
+        wall clock since the latest document, and return the commands that write the timestamps it closes
+        """
+        if self._latest_arrival is None:
+            return []
+        event_time = self._latest_event + time.time() - self._latest_arrival
+        return self.closed_commands(MODE, self._cache_data.advance(event_time - self.allowed_lateness))
+
     def main_loop(self, MODE, batch_update_connection: Queue):
         """
         Checks to see if any documents has been not updated for a threshold time
         and arranges the document to be inserted, then inserts them through bulk update
+        A None on batch_update_connection ends the loop, which is the only way it stops: the transformation can take
+        any time between documents (the caller puts the None once the transformation process is done)
         """
 
         while (True):
             # print('getting from batch update')
             try:
-                obj_from_transformation = batch_update_connection.get(timeout=5)
+                obj_from_transformation = batch_update_connection.get(timeout=self.idle_timeout if self.streaming else None)
             except queue.Empty:
-                if batch_update_connection.empty() and len(self._cache_data)>0:
-                    self.write_to_mongo(self.clear_cache(MODE))
-                    print('emptied cache')
-                    break
+                # streaming: no document for idle_timeout
+                staled_timestamps = self.advance_idle(MODE)
+                if staled_timestamps:
+                    self.write_to_mongo(staled_timestamps)
+                    self.save_token()
+                continue
+            if obj_from_transformation is None: # end of stream
+                self.checkpoint(force=True)
+                self.write_to_mongo(self.clear_cache(MODE))
+                self.save_token()
+                print('emptied cache')
+                break
+            if obj_from_transformation.get("kind") == RESUME_TOKEN:
+                self._pending_tokens.append((self._max_key, obj_from_transformation["token"]))
+                self.save_token()
                 continue
             # print("mode in batch_udpate"+obj_from_transformation)
             
-            staled_timestamps = self.add_to_cache(MODE, obj_from_transformation)
-            # is_cache_emptied = False
-            if staled_timestamps:
-                self.write_to_mongo(staled_timestamps)
+            if obj_from_transformation.get("kind") == "trajectories":
+                # columnar batch of resampled trajectories, transform them here
+                timestamp_dicts = [transform_trajectory(MODE, traj) for traj in unpack_trajectories(obj_from_transformation)]
+            else:
+                timestamp_dicts = [obj_from_transformation]
+            
+            for timestamp_dict in timestamp_dicts:
+                staled_timestamps = self.add_to_cache(MODE, timestamp_dict)
+                # is_cache_emptied = False
+                if staled_timestamps:
+                    self.write_to_mongo(staled_timestamps)
+                    self.checkpoint()
+                    self.save_token()
+        if self.num_failed:
+            raise RuntimeError("{} documents could not be written, see the errors above. The job is checkpointed "
+                               "until the first one".format(self.num_failed))
 
-    def __del__(self):
-        """
-        Upon DBWriter deletion, close the client/connection.
-        :return: None
-        """
-        try:
-            self.client.close()
-        except:
-            pass
 
 def run(config, MODE, batch_update_connection):
     batch_update_obj = BatchUpdate(config)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk copy and export of collections as raw BSON: documents are read as RawBSONDocument and written as they are,
+so they are never decoded to python dictionaries and encoded again.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .columnar import RAW_CODEC_OPTIONS
+
+
+def range_filter(query_filter=None, first_timestamp_range=None):
+    '''
+    query_filter with first_timestamp in [start, end) added if first_timestamp_range = (start, end) is specified
+    either bound can be None
+    '''
+    query_filter = dict(query_filter) if query_filter else {}
+    if first_timestamp_range is not None:
+        start, end = first_timestamp_range
+        bounds = {op: val for op, val in [("$gte", start), ("$lt", end)] if val is not None}
+        if bounds:
+            query_filter["first_timestamp"] = bounds
+    return query_filter
+
+
+def iter_raw_batches(collection, query_filter=None, batch_size=1000):
+    '''
+    yields lists of RawBSONDocument of [batch_size] documents that match query_filter
+    '''
+    cursor = collection.with_options(codec_options=RAW_CODEC_OPTIONS).find(query_filter or {}, batch_size=batch_size)
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_raw(from_collection, to_collection, query_filter=None, batch_size=1000, num_threads=4,
+             bypass_document_validation=False):
+    '''
+    Copy the documents of from_collection that match query_filter to to_collection without decoding them
+    batches are written with insert_many(ordered=False) from [num_threads] threads, while the next ones are read
+    :returns: number of documents copied
+    '''
+    count = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for batch in iter_raw_batches(from_collection, query_filter, batch_size):
+            if len(pending) >= 2*num_threads: # hold back reading when writes are behind
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(to_collection.insert_many, batch, ordered=False,
+                                        bypass_document_validation=bypass_document_validation))
+            count += len(batch)
+        for future in pending:
+            future.result()
+    return count
+
+
+def export_raw(collection, file_path, query_filter=None, batch_size=1000):
+    '''
+    Write the documents of collection that match query_filter to file_path as concatenated BSON (the format of mongodump,
+    readable with bson.decode_file_iter or mongorestore)
+    :returns: number of documents exported
+    '''
+    count = 0
+    with open(file_path, "wb") as f:
+        for batch in iter_raw_batches(collection, query_filter, batch_size):
+            f.write(b"".join(doc.raw for doc in batch))
+            count += len(batch)
+    return count
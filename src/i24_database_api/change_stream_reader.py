@@ -2,12 +2,150 @@
 Created on Thu Jun 23
 @author: lisaliuu
 
+Change stream consumer: events are drained in batches (try_next with a max await time) and forwarded downstream
+as lists of documents. The resume token is checkpointed after every batch, to a file or a MongoDB collection
+(FileTokenStore, CollectionTokenStore), so that a restarted process continues where the last one stopped.
+In the transform pipeline, the token is passed downstream after its batch instead (forward_tokens), and
+batch_update saves it once every timestamp of the batch is written.
+When the stream fails, it is reopened from the last token after an exponential backoff.
 """
 
 from sqlite3 import OperationalError
 from multiprocessing import Queue
+import datetime
+import os
+import time
 import pymongo
 import json
+from bson import json_util
+from pymongo.write_concern import WriteConcern
+
+from .connections import get_client
+
+# change stream errors that a resume cannot recover from, e.g., the token fell off the oplog
+NON_RESUMABLE_ERRORS = {280, 286} # ChangeStreamFatalError, ChangeStreamHistoryLost
+
+RESUME_TOKEN = "resume_token" # kind of the token message, {"kind": RESUME_TOKEN, "token": token}
+
+PROJECTION = {"$project":{"fullDocument._id":1,"fullDocument.timestamp":1,"fullDocument.x_position":1,"fullDocument.y_position":1,"fullDocument.configuration_id":1,"fullDocument.length":1,'fullDocument.width':1,'fullDocument.height':1}}
+
+
+class FileTokenStore:
+    """
+    Resume token in a json file {resume_token, committed_until}, replaced atomically on save
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                doc = json_util.loads(f.read())
+        except FileNotFoundError:
+            return {}
+        return doc if "resume_token" in doc else {"resume_token": doc} # a bare token
+
+    def load(self):
+        return self._read().get("resume_token")
+
+    def committed_until(self):
+        return self._read().get("committed_until")
+
+    def save(self, token, committed_until=None):
+        """
+        :param committed_until: every timestamp up to it is written in the output collection (see batch_update)
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json_util.dumps({"resume_token": token, "committed_until": committed_until}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class CollectionTokenStore:
+    """
+    Resume token in a document {_id: stream_name, resume_token, committed_until, updated_at} of a MongoDB
+    collection, written with journaled majority write concern
+    """
+    def __init__(self, collection, stream_name):
+        self.collection = collection.with_options(write_concern=WriteConcern(w="majority", j=True))
+        self.stream_name = stream_name
+
+    def load(self):
+        doc = self.collection.find_one({"_id": self.stream_name})
+        return doc["resume_token"] if doc is not None else None
+
+    def committed_until(self):
+        doc = self.collection.find_one({"_id": self.stream_name})
+        return doc.get("committed_until") if doc is not None else None
+
+    def save(self, token, committed_until=None):
+        self.collection.update_one({"_id": self.stream_name},
+                                   {"$set": {"resume_token": token, "committed_until": committed_until,
+                                             "updated_at": datetime.datetime.utcnow()}},
+                                   upsert=True)
+
+
+def consume_change_stream(collection, sink, pipeline=None, token_store=None, resume_after=None, batch_size=1000,
+                          max_await_ms=1000, initial_backoff=1, max_backoff=60, max_retries=None, stop=None,
+                          forward_tokens=False):
+    """
+    Watch collection and call sink(batch) with lists of up to batch_size fullDocuments, in stream order.
+    The resume token is saved to token_store after sink returns, so a batch is replayed on restart
+    unless sink completed (at-least-once).
+    :param sink: callable, or a queue whose put() receives the batch
+    :param pipeline: change stream pipeline
+    :param token_store: FileTokenStore or CollectionTokenStore. The stream resumes from its token if any
+    :param resume_after: resume token to start from if token_store has none
+    :param max_await_ms: how long to wait for new events before forwarding a partial batch
+    :param initial_backoff, max_backoff: seconds to wait before reopening a failed stream, doubled after each failure
+    :param max_retries: reopen the stream at most this many times in a row, unlimited if None
+    :param stop: threading or multiprocessing Event, the stream is closed when it is set
+    :param forward_tokens: if True, the resume token of each batch is put downstream after it as
+        {"kind": RESUME_TOKEN, "token": token} instead of being saved here, and the consumer saves it once the batch
+        is written (see batch_update.BatchUpdate). token_store is only read from then
+    """
+    forward = sink.put if hasattr(sink, "put") else sink
+    resume_token = token_store.load() if token_store is not None else None
+    if resume_token is None:
+        resume_token = resume_after
+    backoff = initial_backoff
+    retries = 0
+    while stop is None or not stop.is_set():
+        try:
+            with collection.watch(pipeline=pipeline, resume_after=resume_token, batch_size=batch_size,
+                                  max_await_time_ms=max_await_ms) as stream:
+                while stream.alive and (stop is None or not stop.is_set()):
+                    batch = []
+                    while len(batch) < batch_size:
+                        change = stream.try_next() # None if nothing arrived in max_await_ms
+                        backoff, retries = initial_backoff, 0 # the stream works again
+                        if change is None:
+                            break
+                        batch.append(change["fullDocument"])
+                    if batch:
+                        forward(batch)
+                        resume_token = stream.resume_token
+                        if forward_tokens:
+                            forward({"kind": RESUME_TOKEN, "token": resume_token})
+                        if hasattr(sink, "flush"): # the batch has to be in the channel before it is checkpointed
+                            sink.flush()
+                        if token_store is not None and not forward_tokens:
+                            token_store.save(resume_token)
+        except pymongo.errors.PyMongoError as e:
+            if isinstance(e, pymongo.errors.OperationFailure) and e.code in NON_RESUMABLE_ERRORS:
+                raise
+            retries += 1
+            if max_retries is not None and retries > max_retries:
+                raise
+            print("stream failed ({}), restarting in {}s".format(e, backoff))
+            if stop is not None:
+                stop.wait(backoff)
+            else:
+                time.sleep(backoff)
+            backoff = min(2*backoff, max_backoff)
+
 
 class ChangeStreamReader:
     def __init__(self, config):
@@ -35,9 +173,11 @@ class ChangeStreamReader:
         :param database: Name of database to connect to (do not confuse with collection name).
         :param collection: Name of collection to connect to.
         """
+        self.config_params = {}
         if config:
             with open('config.json') as f:
                 config_params = json.load(f)
+                self.config_params = config_params
                 client_host=config_params['host']
                 client_username=config_params['username']
                 client_password=config_params['password']
@@ -45,12 +185,7 @@ class ChangeStreamReader:
                 database=config_params['read_database_name']
                 collection=config_params['read_collection_name']
 
-        self.client=pymongo.MongoClient(host=client_host,
-                    port=client_port,
-                    username=client_username,
-                    password=client_password,
-                    connect=True,
-                    connectTimeoutMS=5000)
+        self.client=get_client(host=client_host, port=client_port, username=client_username, password=client_password)
     
         self._database=self.client[database]
         self._collection=self._database[collection]
@@ -63,34 +198,35 @@ class ChangeStreamReader:
 
     def listen_stream(self, change_stream_connection : Queue, resume_after=None):
         """
-        Listens to MongoDB stream via change stream and resamples document to send to 
+        Listens to MongoDB stream via change stream and sends the documents one by one to 
         change_stream_connection ready to be read by transformation.py
         :params change_stream_connection: a multiprocessing Queue
         :params resume_after: stream token to resume listening from change stream if cursor failed
         """
-        pipeline = [{"$project":{"fullDocument._id":1,"fullDocument.timestamp":1,"fullDocument.x_position":1,"fullDocument.y_position":1,"fullDocument.configuration_id":1,"fullDocument.length":1,'fullDocument.width':1,'fullDocument.height':1}}]
         print("change stream being listened")
-        try:
-            with self._collection.watch(pipeline=pipeline,resume_after=resume_after) as stream:
-                for insert_change in stream:
-                    # print("[ChangeStreamReader] Read document {}".format(insert_change['fullDocument']['_id'])) #SEND
-                    change_stream_connection.put(insert_change['fullDocument']) 
-                    resume_token = stream.resume_token
-        except pymongo.errors.PyMongoError:
-            print('stream restarting')
-        # The ChangeStream encountered an unrecoverable error or the
-        # resume attempt failed to recreate the cursor.
-        if resume_token is None:
-            # There is no usable resume token because there was a
-            # failure during ChangeStream initialization.
-            raise Exception('change stream cursor failed and is unrecoverable')
-        else:
-            # Use the interrupted ChangeStream's resume token to create
-            # a new ChangeStream. The new stream will continue from the
-            # last seen insert change without missing any events.
-            print('stream restarted')
-            self.listen_stream(change_stream_connection, resume_token)
-
-def run(change_stream_connection):
+        def put_each(batch):
+            for doc in batch:
+                change_stream_connection.put(doc)
+        consume_change_stream(self._collection, put_each, pipeline=[PROJECTION], resume_after=resume_after)
+
+    def listen_batches(self, change_stream_connection, token_store=None, **kwargs):
+        """
+        Listens to MongoDB stream via change stream and sends lists of documents to change_stream_connection,
+            see consume_change_stream
+        :params change_stream_connection: a multiprocessing Queue, or a callable
+        :params token_store: FileTokenStore or CollectionTokenStore to checkpoint resume tokens to
+        :params kwargs: batch_size, max_await_ms, initial_backoff, max_backoff, max_retries, stop, forward_tokens
+        """
+        print("change stream being listened")
+        consume_change_stream(self._collection, change_stream_connection, pipeline=[PROJECTION], token_store=token_store,
+                              **kwargs)
+
+def run(change_stream_connection, token_file=None):
+    """
+    Listen in the transform pipeline: the resume tokens are forwarded, and saved by batch_update
+    :param token_file: json file of the resume tokens, defaults to resume_token_file in config.json if any
+    """
     chg_stream_reader_obj = ChangeStreamReader("config.json")
-    chg_stream_reader_obj.listen_stream(change_stream_connection)
+    token_file = token_file or chg_stream_reader_obj.config_params.get("resume_token_file")
+    token_store = FileTokenStore(token_file) if token_file else None
+    chg_stream_reader_obj.listen_batches(change_stream_connection, token_store=token_store, forward_tokens=True)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar results for range reads: a cursor of raw BSON documents is decoded straight into numpy arrays,
+without building a python dict and a python float per array element.
+Array fields (e.g., timestamp, x_position) are stored ragged, i.e., one flat float64 array for all documents and
+offsets such that the values of document i are values[offsets[i]:offsets[i+1]]
+result:
+    {
+        "_id": list, one per document,
+        scalar field: float64 array if numeric, otherwise list, one per document,
+        array field: flat float64 array,
+        "offsets": {array field: int64 array of len(documents)+1}
+    }
+Missing values are nan (numeric) or None. Arrays of doubles are read with numpy directly from the BSON bytes,
+other arrays (e.g., with int or null elements) fall back to the bson decoder.
+"""
+
+import struct
+import numpy as np
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+BSON_DOUBLE = 0x01
+BSON_ARRAY = 0x04
+
+# size in bytes of the value of fixed-size BSON element types
+_FIXED_SIZE = {0x01: 8, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0, 0xFF: 0}
+# types whose value starts with an int32 size: string, document, array, binary, code, symbol, code with scope
+_SIZED = {0x02: 4, 0x03: 0, 0x04: 0, 0x05: 5, 0x0D: 4, 0x0E: 4, 0x0F: 0}
+
+
+_element_ends = np.zeros(1, dtype=np.int64)
+
+
+def _double_array_layout(n):
+    '''
+    ends[j]: offset of the end of element j-1 from the first element, in a BSON array of at least n doubles
+    keys are "0", "1", ..., so an element takes 1 (type) + len(key) + 1 (\0) + 8 bytes
+    '''
+    global _element_ends
+    if len(_element_ends) <= n:
+        size = max(n+1, 2*len(_element_ends))
+        digits = np.array([len(str(j)) for j in range(size-1)], dtype=np.int64)
+        _element_ends = np.concatenate([[0], np.cumsum(10 + digits)])
+    return _element_ends
+
+
+def decode_arrays(buf, starts, sizes):
+    '''
+    decode BSON arrays to a single flat float64 array
+    arrays of doubles, the usual case, are gathered from the bytes with numpy all together,
+    the others (e.g., with int or null elements) are decoded with bson one by one
+    :param buf: bytes
+    :param starts: int64 array, the array documents are buf[starts[i]:starts[i]+sizes[i]]
+    :param sizes: int64 array
+    :returns: values, offsets such that values[offsets[i]:offsets[i+1]] is array i
+    '''
+    num_arrays = len(starts)
+    body = sizes - 5 # int32 size and trailing \0
+    ends = _double_array_layout(int(body.max()) // 11 if num_arrays else 0) # an element takes at least 11 bytes
+    n = np.minimum(np.searchsorted(ends, body), len(ends)-1)
+    doubles = ends[n] == body # size matches an array of doubles
+    n[~doubles] = 0
+
+    # byte positions of the type and the value of every element
+    local = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    first = np.repeat(starts + 4, n)
+    data = np.frombuffer(buf, dtype=np.uint8)
+    is_double = data[first + ends[local]] == BSON_DOUBLE
+    if len(data) >= 8:
+        rows = np.lib.stride_tricks.as_strided(data, shape=(len(data)-7, 8), strides=(1, 1))
+        values = rows[first + ends[local+1] - 8].view("<f8").reshape(-1)
+    else:
+        values = np.empty(0)
+    if not is_double.all():
+        doubles[np.repeat(np.arange(num_arrays), n)[~is_double]] = False
+
+    lengths = n.copy()
+    if not doubles.all():
+        offsets = np.concatenate([[0], np.cumsum(n)])
+        pieces = []
+        for i in range(num_arrays):
+            if doubles[i]:
+                pieces.append(values[offsets[i]:offsets[i+1]])
+            else:
+                array = bson.decode(buf[starts[i]:starts[i]+sizes[i]])
+                pieces.append(np.array([np.nan if val is None else val for val in array.values()], dtype=np.float64))
+                lengths[i] = len(pieces[-1])
+        values = np.concatenate(pieces) if pieces else np.empty(0)
+    return values, np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+def _element_size(raw, pos, etype):
+    '''
+    size in bytes of the value of a BSON element of type etype that starts at raw[pos]
+    '''
+    if etype in _FIXED_SIZE:
+        return _FIXED_SIZE[etype]
+    if etype in _SIZED:
+        return struct.unpack_from("<i", raw, pos)[0] + _SIZED[etype]
+    if etype == 0x0B: # regex: two cstrings
+        end = raw.index(b"\x00", raw.index(b"\x00", pos)+1)
+        return end + 1 - pos
+    if etype == 0x0C: # DBPointer
+        return struct.unpack_from("<i", raw, pos)[0] + 4 + 12
+    raise ValueError("Unknown BSON element type {}".format(etype))
+
+
+def iter_elements(raw):
+    '''
+    yields (key, type, start, end) of the top-level elements of a BSON document, where raw[start:end] is the value
+    '''
+    pos, end_of_doc = 4, len(raw) - 1
+    while pos < end_of_doc:
+        etype = raw[pos]
+        key_end = raw.index(b"\x00", pos+1)
+        key = raw[pos+1:key_end].decode()
+        start = key_end + 1
+        end = start + _element_size(raw, start, etype)
+        yield key, etype, start, end
+        pos = end
+
+
+def _decode_scalar(raw, etype, start, end):
+    if etype == BSON_DOUBLE:
+        return struct.unpack_from("<d", raw, start)[0]
+    # wrap the element in a document and let bson decode it
+    element = bytes([etype]) + b"v\x00" + raw[start:end]
+    return bson.decode(struct.pack("<i", len(element)+5) + element + b"\x00")["v"]
+
+
+def decode_columnar(raw_docs, fields=None):
+    '''
+    Decode raw BSON documents to a columnar result, see module docstring
+    :param raw_docs: iterable of RawBSONDocument (e.g., a cursor with RAW_CODEC_OPTIONS) or bytes
+    :param fields: fields to decode, None for every field that appears in any document.
+        Fields that are in no document are left out, unless there are no documents at all
+    '''
+    raws = [doc.raw if isinstance(doc, RawBSONDocument) else doc for doc in raw_docs]
+    buf = b"".join(raws)
+    num_docs = len(raws)
+
+    scalars = {} # key: field, val: list of values, one per document
+    arrays = {} # key: field, val: (starts, sizes) in buf, one per document, -1 if missing
+    base = 0
+    for i, raw in enumerate(raws):
+        for key, etype, start, end in iter_elements(raw):
+            if fields is not None and key not in fields:
+                continue
+            if etype == BSON_ARRAY:
+                try:
+                    starts, sizes = arrays[key]
+                except KeyError:
+                    starts, sizes = arrays[key] = np.full(num_docs, -1, dtype=np.int64), np.full(num_docs, -1, dtype=np.int64)
+                starts[i], sizes[i] = base + start, end - start
+            else:
+                try:
+                    column = scalars[key]
+                except KeyError:
+                    column = scalars[key] = [None] * num_docs
+                column[i] = _decode_scalar(raw, etype, start, end)
+        base += len(raw)
+
+    result = {"offsets": {}}
+    for key, column in scalars.items():
+        if key != "_id" and all(val is None or (isinstance(val, (int, float)) and not isinstance(val, bool)) for val in column):
+            result[key] = np.array([np.nan if val is None else val for val in column], dtype=np.float64)
+        else:
+            result[key] = column
+    for key, (starts, sizes) in arrays.items():
+        present = starts >= 0
+        values, offsets = decode_arrays(buf, starts[present], sizes[present])
+        if not present.all(): # missing arrays are empty
+            lengths = np.zeros(num_docs, dtype=np.int64)
+            lengths[present] = np.diff(offsets)
+            offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        result[key], result["offsets"][key] = values, offsets
+    if num_docs == 0 and fields is not None: # empty result of every field, either scalar or array
+        for key in fields:
+            result[key], result["offsets"][key] = np.empty(0), np.zeros(1, dtype=np.int64)
+    return result
+
+
+def projected_fields(projection):
+    '''
+    the fields that a pymongo inclusion projection returns, None if not known (no projection or exclusion only)
+    '''
+    if isinstance(projection, dict):
+        fields = [key for key, val in projection.items() if val]
+        if fields:
+            return fields + ["_id"] if projection.get("_id", 1) else fields
+    elif projection is not None:
+        return list(projection) + ["_id"]
+    return None
+
+
+def split(result, field):
+    '''
+    the arrays of an array field in a columnar result, one per document
+    '''
+    offsets = result["offsets"][field]
+    return [result[field][offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
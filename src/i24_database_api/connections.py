@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of MongoClients: every DBClient, DBWriter, BatchUpdate, ChangeStreamReader and transform
+worker that connects with the same parameters shares one client, and with it one connection pool.
+MongoClient is thread-safe but not fork-safe, so clients are per process: a forked child starts with an empty registry.
+Clients connect lazily (connect=False) and stay open until close_all(), which runs at exit.
+Pool sizes are pymongo options, either for every client: set_default_options(maxPoolSize=50),
+or per call: get_client(host, port, maxPoolSize=50)
+"""
+
+import atexit
+import os
+import threading
+import pymongo
+
+DEFAULT_OPTIONS = {"connectTimeoutMS": 5000}
+
+_clients = {} # key: connection parameters and options, val: MongoClient
+_lock = threading.Lock()
+
+
+def set_default_options(**options):
+    '''
+    pymongo options of the clients created from now on, e.g., maxPoolSize, minPoolSize, maxIdleTimeMS
+    '''
+    DEFAULT_OPTIONS.update(options)
+
+
+def get_client(host=None, port=27017, username=None, password=None, **options):
+    '''
+    The shared MongoClient of this process for these connection parameters and options (None options are left out),
+    created on the first call
+    '''
+    options = dict(DEFAULT_OPTIONS, **{key: val for key, val in options.items() if val is not None})
+    key = repr((os.getpid(), host, port, username, password, sorted(options.items())))
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = pymongo.MongoClient(host=host, port=port, username=username, password=password, connect=False,
+                                         **options)
+            _clients[key] = client
+    return client
+
+
+def num_clients():
+    return len(_clients)
+
+
+def close_all():
+    '''
+    Close every client of the registry
+    '''
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+def _reset_after_fork():
+    # clients of the parent must not be used (or closed) in the child
+    global _lock
+    _lock = threading.Lock()
+    _clients.clear()
+
+
+atexit.register(close_all)
+if hasattr(os, "register_at_fork"): # python >= 3.7
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,5 +1,8 @@
 import pymongo
-from threading import Thread
+from threading import Thread, RLock
+from .group_writer import GroupCommitWriter
+from .connections import get_client
+from .schema_validator import compile_schema, flag_violations
 import json
 import warnings
 import sys
@@ -11,8 +14,12 @@ class DBWriter:
     """
 
     def __init__(self, default_param, host=None, port=None, username=None, password=None, database_name=None, collection_name=None,
-                 server_id=None, session_config_id=None, max_idle_time_ms = None, schema_file = None):
+                 server_id=None, session_config_id=None, max_idle_time_ms = None, schema_file = None,
+                 write_batch_size=1000, write_delay_ms=50, write_queue_size=10000, schema_validation="server",
+                 shared=True, lazy=True):
         """
+        The connection test, collection creation and validator update run on first use of self.collection if lazy
+        (see _setup), like in DBClient.
         :param host: Database connection host name.
         :param port: Database connection port number.
         :param username: Database authentication username.
@@ -23,7 +30,14 @@ class DBWriter:
         :param process_id: ID value for the process this writer is attached to (writing from).
         :param session_config_id: Configuration ID value that was assigned to this run/session of data processing.
         :param schema_file: json file path
+        :param write_batch_size, write_delay_ms, write_queue_size: threaded writes are inserted in batches,
+            see group_writer.GroupCommitWriter
+        :param schema_validation: "server" or "client", see DBClient
+        :param shared: if True (default), use the process-wide client of these connection parameters, see DBClient
+        :param lazy: if True (default), defer the connection test and collection setup until first use
         """
+        if schema_validation not in ["server", "client"]:
+            raise ValueError("schema_validation must be 'server' or 'client', got {}".format(schema_validation))
         if not isinstance(default_param, dict): # convert to dictionary first
             default_param = default_param.__dict__
             
@@ -47,44 +61,78 @@ class DBWriter:
         self.server_id = server_id
         self.session_config_id = session_config_id
 
-        # Connect immediately upon instantiation.
-        self.client = pymongo.MongoClient(host=host, port=port, username=username, 
-                                          password=password,
-                                          connect=True, 
-                                          maxIdleTimeMS = max_idle_time_ms,
-                                          connectTimeoutMS = 5000,
-                                          )
-        try:
-            self.client.admin.command('ping')
-        except pymongo.errors.ConnectionFailure:
-            raise ConnectionError("Could not connect to MongoDB using pymongo.")
+        self.shared = shared
+        if shared:
+            self.client = get_client(host=host, port=port, username=username, password=password,
+                                     maxIdleTimeMS = max_idle_time_ms)
+        else:
+            self.client = pymongo.MongoClient(host=host, port=port, username=username, 
+                                              password=password,
+                                              connect=not lazy, 
+                                              maxIdleTimeMS = max_idle_time_ms,
+                                              connectTimeoutMS = 5000,
+                                              )
+        self._ready = False
+        self._setup_lock = RLock()
             
         self.db = self.client[database_name]
-        
-        try: 
-            self.db.create_collection(collection_name)
-        except:
-            print(f"{collection_name} already exists upon constructing DBWriter")
-            pass
-        
-        self.collection = self.db[collection_name]
+        self._collection = self.db[collection_name]
         self.collection_name = collection_name
         
-    
-        # check for schema. If exists a schema json file, update the collection validator. Otherwise remove the validator        
-        if schema_file: # add validator
+        # check for schema. If exists a schema json file, update the collection validator (in _setup). Otherwise remove the validator
+        if schema_file:
             f = open(schema_file)
             collection_schema = json.load(f)
             self.schema = collection_schema
             f.close()
-            self.db.command("collMod", collection_name, validator=collection_schema)
-    
-        else: # remove validator
-            warnings.warn("No schema rule is specified, remove the validator in collection {}".format(collection_name), UserWarning)
-            self.db.command("collMod", collection_name, validator={})
+            self.validator = compile_schema(collection_schema) if schema_validation == "client" else None
+        else:
             self.schema = None
+            self.validator = None
+            
+        self.write_batch_size = write_batch_size
+        self.write_delay_ms = write_delay_ms
+        self.write_queue_size = write_queue_size
+        self.group_writer = None # started on the first threaded write
         
+        if not lazy:
+            self._setup()
+        
+    def _setup(self):
+        """
+        Test the connection, create the collection and update its validator.
+        Runs once, upon instantiation or, if lazy, on first use of self.collection
+        """
+        with self._setup_lock:
+            if self._ready:
+                return
+            try:
+                self.client.admin.command('ping')
+            except pymongo.errors.ConnectionFailure:
+                raise ConnectionError("Could not connect to MongoDB using pymongo.")
+            
+            try: 
+                self.db.create_collection(self.collection_name)
+            except:
+                print(f"{self.collection_name} already exists upon constructing DBWriter")
+                pass
+            
+            if self.schema: # add validator
+                self.db.command("collMod", self.collection_name, validator=self.schema)
+            else: # remove validator
+                warnings.warn("No schema rule is specified, remove the validator in collection {}".format(self.collection_name), UserWarning)
+                self.db.command("collMod", self.collection_name, validator={})
+            self._ready = True
+    
+    @property
+    def collection(self):
+        if not self._ready:
+            self._setup()
+        return self._collection
     
+    @collection.setter
+    def collection(self, collection):
+        self._collection = collection
      
     def mark_safe(self, col_list):
         '''
@@ -138,6 +186,9 @@ class DBWriter:
         A wrapper around pymongo insert_one, which is a thread-safe operation
         bypass_document_validation = True: enforce schema
         """
+        if self.client_validated(collection, document):
+            collection.insert_one(document, bypass_document_validation = True)
+            return
         try:
             collection.insert_one(document, bypass_document_validation = False)
         except Exception as e: # schema violated
@@ -145,6 +196,18 @@ class DBWriter:
             collection.insert_one(document, bypass_document_validation = True)
             
         
+    def client_validated(self, collection, document):
+        """
+        With schema_validation="client", validate document locally and flag the violations, see DBClient.client_validated
+        :return: True if server validation can be bypassed
+        """
+        if self.validator is None or collection.name != self.collection_name:
+            return False
+        errors = flag_violations(self.validator, document)
+        if errors:
+            warnings.warn("Schema violated. Insert anyways with flags. First error: {}".format(errors[0]), UserWarning)
+        return True
+        
     def write_one_trajectory(self, thread = True, collection_name = None, **kwargs):
         """
         Write an arbitrary document specified in kwargs to a specified collection. No schema enforcment.
@@ -177,30 +240,65 @@ class DBWriter:
         if not thread:
             self.insert_one_schema_validation(col, doc)
         else:
-            # fire off a thread
-            t = Thread(target=self.insert_one_schema_validation, args=(col, doc,))
-            # self.threads.append(t)
-            t.daemon = True
-            t.start()   
+            # batched with other threaded writes
+            bypass = self.client_validated(col, doc)
+            self.get_group_writer().submit(col, doc, bypass_document_validation=bypass)
+            
+    def get_group_writer(self):
+        if self.group_writer is None:
+            self.group_writer = GroupCommitWriter(max_batch=self.write_batch_size, max_delay_ms=self.write_delay_ms,
+                                                  max_queue=self.write_queue_size)
+        return self.group_writer
+    
+    def flush(self, timeout=None):
+        """
+        Wait until all threaded writes issued so far are written
+        :param timeout: maximum time to wait in sec, None to wait until done
+        :return: False if writes are still pending after timeout, True otherwise
+        """
+        if self.group_writer is None:
+            return True
+        return self.group_writer.flush(timeout)
+    
+    def close(self, timeout=None):
+        """
+        Flush the threaded writes (see flush), stop the writer thread and close the client/connection if not shared.
+        Also called upon deletion, and when leaving a with block:
+            with DBWriter(default_param, collection_name=name) as dbw:
+                dbw.write_one_trajectory(**traj)
+        :return: see flush
+        """
+        flushed = self.group_writer.close(timeout) if self.group_writer is not None else True
+        if not self.shared:
+            self.client.close()
+        return flushed
+    
+    def write_stats(self):
+        """
+        Counters of threaded writes, in number of documents:
+            {"pending", "completed", "failed", "batches", "mean_batch_ms": mean duration of an insert_many}
+        """
+        if self.group_writer is None:
+            return {"pending": 0, "completed": 0, "failed": 0, "batches": 0, "mean_batch_ms": 0}
+        return self.group_writer.stats()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
             
     
-    # def join_threads(self):
-    #     """
-    #     For handling graceful shutdown. All threads for insert are joined
-    #     """
-    #     for t in self.threads:
-    #         t.join()
-        
     def count(self):
         return self.collection.count_documents({})
 
 
     def __del__(self):
         """
-        Upon DBWriter deletion, close the client/connection.
+        Upon DBWriter deletion, flush pending writes and close the client/connection.
         :return: None
         """
         try:
-            self.client.close()
+            self.close()
         except:
             pass
\ No newline at end of file
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Group-commit writer for threaded inserts: documents are put to a bounded queue and a few long-lived flusher threads
+write them with insert_many(ordered=False), once [max_batch] documents or [max_delay_ms] have accumulated,
+whichever comes first. When the queue is full, submit() blocks until the flushers catch up.
+flush() waits for the documents in flight, close() flushes and stops the flushers. Whatever is pending at exit
+is flushed before the process ends.
+"""
+
+import atexit
+import queue
+import time
+import warnings
+from threading import Thread, Condition
+from pymongo.errors import BulkWriteError, PyMongoError
+
+DOCUMENT_VALIDATION_FAILURE = 121
+
+
+def insert_batch(collection, documents, bypass_document_validation=False):
+    '''
+    insert_many(ordered=False) that inserts schema-violating documents anyways, like insert_one_schema_validation
+    :returns: number of documents that could not be inserted
+    '''
+    try:
+        collection.insert_many(documents, ordered=False, bypass_document_validation=bypass_document_validation)
+        return 0
+    except BulkWriteError as bwe:
+        errors = bwe.details["writeErrors"]
+        invalid = [documents[err["index"]] for err in errors if err["code"] == DOCUMENT_VALIDATION_FAILURE]
+        failed = len(errors) - len(invalid)
+        if failed:
+            warnings.warn("{} documents failed to insert. First error: {}".format(
+                failed, next(err for err in errors if err["code"] != DOCUMENT_VALIDATION_FAILURE)["errmsg"]), UserWarning)
+        if invalid:
+            warnings.warn("Schema violated for {} documents. Insert anyways. First error: {}".format(
+                len(invalid), next(err for err in errors if err["code"] == DOCUMENT_VALIDATION_FAILURE)["errmsg"]), UserWarning)
+            failed += insert_batch(collection, invalid, bypass_document_validation=True)
+        return failed
+    except PyMongoError as e:
+        warnings.warn("{} documents failed to insert. Full error: {}".format(len(documents), e), UserWarning)
+        return len(documents)
+
+
+class GroupCommitWriter:
+    """
+    Batches documents submitted from any thread into insert_many's, see module docstring
+    """
+    def __init__(self, max_batch=1000, max_delay_ms=50, max_queue=10000, num_flushers=1):
+        '''
+        :param max_batch: maximum number of documents per insert_many
+        :param max_delay_ms: maximum time a document waits for its batch to fill up
+        :param max_queue: maximum number of documents waiting in the queue, submit() blocks beyond that
+        :param num_flushers: number of flusher threads
+        '''
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        
+        # counters, in documents
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.num_batches = 0
+        self.write_seconds = 0 # total time spent in insert_many
+        
+        self._closed = False
+        self._done = Condition() # notified when a batch is written
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._flushers = [Thread(target=self._run, daemon=True) for _ in range(num_flushers)]
+        for t in self._flushers:
+            t.start()
+        atexit.register(self.close)
+
+    def submit(self, collection, document, bypass_document_validation=False, block=True, timeout=None):
+        '''
+        Queue document to be inserted to collection
+        blocks while the queue is full, or raises queue.Full if block=False or after timeout
+        '''
+        if self._closed:
+            raise RuntimeError("GroupCommitWriter is closed")
+        with self._done:
+            self.submitted += 1
+        try:
+            self._queue.put((collection, document, bypass_document_validation), block, timeout)
+        except queue.Full:
+            with self._done:
+                self.submitted -= 1
+            raise
+
+    @property
+    def pending(self):
+        '''
+        number of documents submitted but not written yet
+        '''
+        return self.submitted - self.completed - self.failed
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "batches": self.num_batches,
+            "mean_batch_ms": 1000 * self.write_seconds / self.num_batches if self.num_batches else 0,
+            }
+
+    def flush(self, timeout=None):
+        '''
+        Wait until every document submitted so far is written (or failed)
+        :returns: False if documents are still pending after timeout sec, True otherwise
+        '''
+        with self._done:
+            return self._done.wait_for(lambda: self.pending <= 0, timeout)
+
+    def close(self, timeout=None):
+        '''
+        Flush and stop the flusher threads, no more documents can be submitted
+        :returns: see flush
+        '''
+        if self._closed:
+            return self.pending <= 0
+        self._closed = True
+        atexit.unregister(self.close)
+        flushed = self.flush(timeout)
+        for _ in self._flushers:
+            try:
+                self._queue.put_nowait(None) # stop
+            except queue.Full:
+                break
+        for t in self._flushers:
+            t.join(timeout)
+        return flushed
+
+    def _next_batch(self):
+        '''
+        :returns: batch, and whether to stop after it
+        '''
+        item = self._queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write(self, batch):
+        groups = {} # key: (collection, bypass), val: documents
+        for collection, document, bypass in batch:
+            groups.setdefault((collection.full_name, bypass), (collection, bypass, []))[2].append(document)
+        return sum(insert_batch(collection, documents, bypass) for collection, bypass, documents in groups.values())
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if not batch:
+                self._queue.task_done()
+                continue
+            start = time.monotonic()
+            failed = len(batch)
+            try:
+                failed = self._write(batch)
+            except Exception as e:
+                warnings.warn("{} documents failed to insert. Full error: {}".format(len(batch), e), UserWarning)
+            finally:
+                with self._done:
+                    self.failed += failed
+                    self.completed += len(batch) - failed
+                    self.num_batches += 1
+                    self.write_seconds += time.monotonic() - start
+                    self._done.notify_all()
+                for _ in range(len(batch) + stop):
+                    self._queue.task_done()
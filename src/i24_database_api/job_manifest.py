@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of the transform jobs, so that a job that stopped partway resumes instead of starting over.
+The manifest of a job is a document of __JOBS__ in the write database, keyed by the write collection name:
+    {
+        _id: write_collection_name,
+        status: "running" or "complete",
+        params: {...}, the parameters of the job, a job only resumes with the same ones
+        chunks: {direction: [chunk index, ...]}, transform2: the first_timestamp chunks whose writes are all committed
+        committed_until: transform: every timestamp below is written completely, absent until the first checkpoint
+        started_at, updated_at: datetime
+    }
+A chunk or timestamp is recorded only after its writes are acknowledged by the server, and the writes of a chunk
+that was not recorded are repeated on resume, so the writes have to be idempotent.
+"""
+
+import datetime
+from pymongo.write_concern import WriteConcern
+
+JOBS_COLLECTION = "__JOBS__"
+
+
+class JobManifest:
+    """
+    The manifest of the transform job writing to database[job_id], see module docstring
+    """
+    def __init__(self, database, job_id):
+        self.collection = database[JOBS_COLLECTION].with_options(write_concern=WriteConcern(w="majority", j=True))
+        self.job_id = job_id
+
+    def load(self):
+        return self.collection.find_one({"_id": self.job_id})
+
+    def resumable(self, params):
+        '''
+        the manifest of a running job with the same params, None if the job has to start over
+        '''
+        job = self.load()
+        if job is None or job["status"] != "running":
+            return None
+        if job["params"] != params:
+            print("Job {} was started with different parameters, start over".format(self.job_id))
+            return None
+        return job
+
+    def start(self, params, **fields):
+        '''
+        start the job over, fields are stored with it (e.g., the chunk grid, which has to stay the same on resume)
+        '''
+        now = datetime.datetime.utcnow()
+        job = dict({"_id": self.job_id, "status": "running", "params": params, "chunks": {},
+                    "started_at": now, "updated_at": now}, **fields)
+        self.collection.replace_one({"_id": self.job_id}, job, upsert=True)
+
+    def commit_chunk(self, direction, chunk):
+        self.collection.update_one({"_id": self.job_id}, {"$addToSet": {"chunks." + direction: chunk},
+                                                          "$set": {"updated_at": datetime.datetime.utcnow()}})
+
+    def committed_chunks(self, direction):
+        job = self.load()
+        return set(job["chunks"].get(direction, [])) if job is not None else set()
+
+    def commit_until(self, timestamp):
+        self.collection.update_one({"_id": self.job_id}, {"$max": {"committed_until": timestamp},
+                                                          "$set": {"updated_at": datetime.datetime.utcnow()}})
+
+    def complete(self):
+        self.collection.update_one({"_id": self.job_id}, {"$set": {"status": "complete",
+                                                                   "updated_at": datetime.datetime.utcnow()}})
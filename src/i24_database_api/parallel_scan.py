@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel partitioned range scan: [start, stop] of a range parameter is split into equal partitions that are read
+concurrently, by threads sharing a client or by processes with their own connection.
+Each worker puts batches of documents to a bounded queue, so a worker that is ahead of the consumer waits.
+ordered=True: every partition is sorted by the range parameter and has its own queue, which are drained in range order.
+Since the partitions do not overlap, this is a k-way merge where each partition only follows the previous one.
+ordered=False: all workers share a queue, batches are yielded as they arrive.
+"""
+
+import queue
+import multiprocessing
+from threading import Thread, Event
+
+import pymongo
+
+from .range_query import window_filter
+
+PUT_TIMEOUT = 0.5 # sec, a blocked worker checks for stop this often
+
+
+def partition_ranges(start, stop, num_partitions):
+    '''
+    bounds (gt, gte, lt, lte) of num_partitions equal partitions of [start, stop], the last one is closed at stop
+    '''
+    step = (stop - start) / num_partitions
+    edges = [start + i*step for i in range(num_partitions)] + [stop]
+    return [(None, lower, None, upper) if i == num_partitions-1 else (None, lower, upper, None)
+            for i, (lower, upper) in enumerate(zip(edges[:-1], edges[1:]))]
+
+
+def _put(out, item, stop):
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def scan_partition(collection, range_parameter, bounds, query_filter, projection, batch_size, ordered, out, stop):
+    '''
+    put the documents of one partition to out in batches of [batch_size], then None
+    errors are put to out as RuntimeError, for the consumer to raise
+    '''
+    try:
+        sort = [(range_parameter, pymongo.ASCENDING)] if ordered else None
+        cursor = collection.find(window_filter(range_parameter, bounds, query_filter), projection,
+                                 sort=sort, batch_size=batch_size)
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                if not _put(out, batch, stop):
+                    return
+                batch = []
+        if batch and not _put(out, batch, stop):
+            return
+        _put(out, None, stop)
+    except Exception as e:
+        _put(out, RuntimeError("Partition {} of the scan failed: {!r}".format(bounds, e)), stop)
+
+
+def _scan_process(connection_params, database_name, collection_name, *args):
+    out, stop = args[-2:]
+    client = pymongo.MongoClient(**connection_params)
+    try:
+        scan_partition(client[database_name][collection_name], *args)
+    finally:
+        client.close()
+        if stop.is_set(): # batches nobody will read must not keep the process from exiting
+            out.cancel_join_thread()
+
+
+def _drain(out, num_workers):
+    done = 0
+    while done < num_workers:
+        item = out.get()
+        if item is None:
+            done += 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield from item
+
+
+def parallel_scan(collection, range_parameter, start, stop, num_partitions=4, ordered=True, processes=False,
+                  connection_params=None, query_filter=None, projection=None, batch_size=1000, max_buffered_batches=4):
+    '''
+    Generator of the documents of collection with range_parameter in [start, stop], read by num_partitions workers
+    :param processes: read with processes instead of threads, each with a MongoClient(**connection_params)
+    :param max_buffered_batches: maximum number of batches waiting in each partition's queue (shared queue: per worker)
+    see module docstring for the rest
+    '''
+    if processes:
+        Queue, Worker, stop_event = multiprocessing.Queue, multiprocessing.Process, multiprocessing.Event()
+    else:
+        Queue, Worker, stop_event = queue.Queue, Thread, Event()
+    partitions = partition_ranges(start, stop, num_partitions)
+    if ordered:
+        queues = [Queue(max_buffered_batches) for _ in partitions]
+    else:
+        queues = [Queue(max_buffered_batches * len(partitions))] * len(partitions)
+
+    workers = []
+    for bounds, out in zip(partitions, queues):
+        args = (range_parameter, bounds, query_filter, projection, batch_size, ordered, out, stop_event)
+        if processes:
+            workers.append(Worker(target=_scan_process, daemon=True,
+                                  args=(connection_params, collection.database.name, collection.name) + args))
+        else:
+            workers.append(Worker(target=scan_partition, args=(collection,) + args, daemon=True))
+    for worker in workers:
+        worker.start()
+
+    try:
+        if ordered:
+            for out in queues:
+                yield from _drain(out, 1)
+        else:
+            yield from _drain(queues[0], len(workers))
+    finally:
+        stop_event.set() # stops workers that are still running if the consumer stopped early
+        for worker in workers:
+            worker.join()
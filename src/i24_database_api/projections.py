@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Named projections for common access patterns of trajectory collections, so that queries only pull the fields
+they need instead of whole documents (raw_timestamp, camera_snapshots, flags arrays etc.)
+usage:
+    dbc.read_query(query_filter, projection="bounds")
+    register_projection("my_fields", {"_id": 1, "x_position": 1})
+"""
+
+PROJECTIONS = {
+    # trajectory extent only, no arrays
+    "bounds": {"_id": 1, "first_timestamp": 1, "last_timestamp": 1, "starting_x": 1, "ending_x": 1, "direction": 1},
+    # time-series of positions
+    "positions": {"_id": 1, "first_timestamp": 1, "last_timestamp": 1, "direction": 1,
+                  "timestamp": 1, "x_position": 1, "y_position": 1},
+    # whole documents
+    "full": None,
+}
+
+
+def register_projection(name, projection):
+    '''
+    Add or overwrite a named projection
+    :param projection: pymongo projection, i.e., a dict or a list of field names, or None for whole documents
+    '''
+    PROJECTIONS[name] = projection
+
+
+def resolve_projection(projection):
+    '''
+    Returns the pymongo projection of projection, which is either a name in PROJECTIONS or a pymongo projection itself
+    '''
+    if isinstance(projection, str):
+        try:
+            return PROJECTIONS[projection]
+        except KeyError:
+            raise ValueError("Unknown projection {}. Use one of {} or register_projection()".format(projection, list(PROJECTIONS)))
+    return projection
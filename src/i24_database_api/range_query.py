@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Range-segmented queries: the windows that a range iteration visits, and the query filter of each window.
+Windows are [start, start+increment), [start+increment, start+2*increment), ..., [..., stop],
+where the first window is open or closed at start and the last one, cut at stop, is open or closed at stop as requested.
+Adaptive windows instead hold about the same number of documents each: their edges are the bucket boundaries of a
+$bucketAuto histogram of the range parameter, computed on a sample for large ranges.
+"""
+
+import math
+from collections import namedtuple
+
+RANGE_OPERATORS = ["$gt", "$gte", "$lt", "$lte"]
+RANDOM_CURSOR_FRACTION = 0.05 # $sample of at most this fraction of a collection picks documents at random
+
+
+def range_windows(start, stop, increment, start_closed=True, stop_closed=False):
+    '''
+    yields the bounds (gt, gte, lt, lte) of each window, two of which are None
+    window edges are start + k*increment, so that float increments do not drift and leave an empty window
+    just below stop
+    '''
+    lower = start
+    first = True
+    k = 1
+    while True:
+        upper = start + k*increment
+        last = stop - upper <= increment * 1e-9
+        query_upper = stop if last else upper
+        if first and not start_closed:
+            gt, gte = lower, None
+        else:
+            gt, gte = None, lower
+        if last and stop_closed:
+            lt, lte = None, query_upper
+        else:
+            lt, lte = query_upper, None
+        yield gt, gte, lt, lte
+        if last:
+            return
+        first = False
+        lower = upper
+        k += 1
+
+
+class RangeQuery(namedtuple("RangeQuery", ["range_parameter", "start", "stop", "start_closed", "stop_closed",
+                                           "increment", "windows", "query_filter", "query_sort", "options", "prefetch"])):
+    """
+    Immutable specification of a range iteration (see DBClient.read_query_range): either fixed windows of
+    [increment] between start and stop, or explicit window bounds (e.g., adaptive_windows)
+    """
+    __slots__ = ()
+
+    def iter_windows(self):
+        if self.windows is not None:
+            return iter(self.windows)
+        return range_windows(self.start, self.stop, self.increment, self.start_closed, self.stop_closed)
+
+
+def window_filter(range_parameter, bounds, query_filter=None):
+    '''
+    query_filter with range_parameter restricted to bounds = (gt, gte, lt, lte), None bounds are left out
+    '''
+    window = dict(query_filter) if query_filter else {}
+    condition = dict(window.get(range_parameter, {}))
+    for operator, value in zip(RANGE_OPERATORS, bounds):
+        if value is not None:
+            condition[operator] = value
+    if condition:
+        window[range_parameter] = condition
+    return window
+
+
+def edge_windows(start, stop, edges, start_closed=True, stop_closed=False):
+    '''
+    like range_windows, with windows between consecutive edges (sorted, strictly between start and stop)
+    '''
+    lowers, uppers = [start] + list(edges), list(edges) + [stop]
+    for i, (lower, upper) in enumerate(zip(lowers, uppers)):
+        gt, gte = (lower, None) if i == 0 and not start_closed else (None, lower)
+        lt, lte = (None, upper) if i == len(uppers)-1 and stop_closed else (upper, None)
+        yield gt, gte, lt, lte
+
+
+def histogram_edges(collection, range_parameter, start, stop, num_windows, query_filter=None, sample_size=None,
+                    count=None):
+    '''
+    boundaries that split the documents with range_parameter in [start, stop] into num_windows buckets of about
+    equal count ($bucketAuto), estimated on about sample_size random documents if specified
+    MongoDB only samples with a random cursor (without reading every document) if $sample is the first stage and
+    takes less than RANDOM_CURSOR_FRACTION of the collection. So given the count of matching documents, $sample goes
+    first and takes sample_size * (documents in the collection) / count, of which about sample_size match.
+    If that is too many, the matching documents are all read and sampled after $match.
+    '''
+    match = {"$match": window_filter(range_parameter, (None, start, None, stop), query_filter)}
+    project = {"$project": {"_id": 0, range_parameter: 1}}
+    pipeline = [match, project]
+    if sample_size:
+        total = collection.estimated_document_count() if count else 0
+        size = math.ceil(sample_size * total / count) if count else None
+        if size is not None and size <= RANDOM_CURSOR_FRACTION * total:
+            pipeline = [{"$sample": {"size": size}}, match, project]
+        else:
+            pipeline.append({"$sample": {"size": sample_size}})
+    pipeline.append({"$bucketAuto": {"groupBy": "$" + range_parameter, "buckets": num_windows}})
+    edges = sorted(bucket["_id"]["min"] for bucket in collection.aggregate(pipeline))[1:] # first one is the min
+    return [edge for edge in edges if start < edge < stop]
+
+
+def adaptive_windows(collection, range_parameter, start, stop, docs_per_window, start_closed=True, stop_closed=False,
+                     query_filter=None, sample_size=10000):
+    '''
+    bounds (gt, gte, lt, lte) of windows of [start, stop] with about docs_per_window documents each
+    the histogram is estimated on sample_size documents if the range has more than that
+    '''
+    count = collection.count_documents(window_filter(range_parameter, (None, start, None, stop), query_filter))
+    num_windows = math.ceil(count / docs_per_window)
+    edges = []
+    if num_windows > 1:
+        edges = histogram_edges(collection, range_parameter, start, stop, num_windows, query_filter,
+                                sample_size if count > sample_size else None, count)
+    return list(edge_windows(start, stop, edges, start_closed, stop_closed))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized resampling of trajectory time-series to the 25Hz grid, numpy only.
+Reproduces the pandas resample/groupby/asfreq/interpolate chain in transform2
+without building a DataFrame per trajectory.
+"""
+
+import numpy as np
+
+dt = 0.04
+NS_PER_SEC = 1000000000
+DT_NS = 40000000 # dt in nanoseconds
+
+
+def decimal_range(start, stop, increment):
+    while start <= stop: # and not math.isclose(start, stop): Py>3.5
+        yield start
+        start += increment
+
+
+def to_ns(timestamp):
+    '''
+    Convert float seconds to int64 nanoseconds, rounding exactly as pd.to_timedelta(unit='s') does:
+    integer part is truncated, fractional part is rounded to 9 digits
+    '''
+    timestamp = np.asarray(timestamp, dtype=np.float64)
+    base = timestamp.astype(np.int64)
+    frac = np.round(timestamp - base, 9)
+    return base * NS_PER_SEC + (frac * NS_PER_SEC).astype(np.int64)
+
+
+def interpolate_nans(values):
+    '''
+    Equivalent of pd.Series.interpolate(method='linear') on a uniform grid:
+    nans between valid samples are filled linearly, trailing nans hold the last valid value,
+    leading nans are left blank
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    if valid.all() or not valid.any():
+        return values
+    pos = np.arange(len(values))
+    return np.interp(pos, pos[valid], values[valid], left=np.nan)
+
+
+def resample_trajectory(timestamp, data, interpolate=False, origin="start", clamp_to=None):
+    '''
+    Resample a single trajectory, see resample_batch for the parameters
+    :param timestamp: 1d array-like of sample times in seconds
+    :param data: dict of field_name: 1d array-like of the same length as timestamp
+    :return: t, resampled
+        t: 1d array of grid times in seconds
+        resampled: dict of field_name: 1d array aligned with t
+    '''
+    t, resampled, _ = resample_batch([timestamp], {key: [val] for key, val in data.items()},
+                                     interpolate=interpolate, origin=origin, clamp_to=clamp_to)
+    return t, resampled
+
+
+def resample_batch(timestamps, data, interpolate=False, origin="start", clamp_to=None):
+    '''
+    Bin the time-series of many trajectories onto the dt grid in a single pass, and average within each bin.
+    Empty bins between the first and last sample of a trajectory are nans.
+    :param timestamps: ragged list of 1d array-like of sample times in seconds, one per trajectory. None can be empty.
+    :param data: dict of field_name: ragged list of 1d array-like, aligned with timestamps
+    :param interpolate: fill the nan gaps linearly (see interpolate_nans)
+    :param origin: "start": bins are [t0+k*dt, t0+(k+1)*dt) and labeled by the floor of their left edge,
+        which is what df.resample(dt).mean() followed by groupby(floor) does in transform_beta
+        "epoch": bins are the dt grid itself, i.e., groupby(df.index.floor(dt)) as in transformation.resample
+    :param clamp_to: field name. If specified, do not extrapolate more than 1 sec beyond the valid range
+        of this field, and do not go outside of [min(timestamp), max(timestamp)] of each trajectory
+    :return: t, resampled, offsets
+        t: flat 1d array of grid times in seconds of all trajectories
+        resampled: dict of field_name: flat 1d array aligned with t
+        offsets: trajectory i is t[offsets[i]:offsets[i+1]]
+    '''
+    lengths = np.array([len(ts) for ts in timestamps], dtype=np.int64)
+    if len(lengths) == 0:
+        return np.empty(0), {key: np.empty(0) for key in data}, np.zeros(1, dtype=np.int64)
+    if (lengths == 0).any():
+        raise ValueError("Cannot resample a trajectory without timestamps")
+    
+    seg = np.repeat(np.arange(len(lengths)), lengths)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    timestamp = np.concatenate([np.asarray(ts, dtype=np.float64) for ts in timestamps])
+    ns = to_ns(timestamp)
+    
+    t0 = np.minimum.reduceat(ns, starts)
+    first_label = t0 - t0 % DT_NS
+    if origin == "start":
+        local_bins = (ns - t0[seg]) // DT_NS
+    elif origin == "epoch":
+        local_bins = (ns - first_label[seg]) // DT_NS
+    else:
+        raise ValueError("origin must be either 'start' or 'epoch'")
+    
+    # lay out the grid of every trajectory back to back
+    nbins = np.maximum.reduceat(local_bins, starts) + 1
+    offsets = np.concatenate([[0], np.cumsum(nbins)])
+    out_seg = np.repeat(np.arange(len(nbins)), nbins)
+    pos = np.arange(offsets[-1])
+    local_pos = pos - offsets[out_seg]
+    t = (first_label[out_seg] + local_pos * DT_NS) * 1e-9
+    bins = offsets[seg] + local_bins
+    
+    resampled = {}
+    for key, val in data.items():
+        val = np.concatenate([np.asarray(v, dtype=np.float64) for v in val])
+        valid = ~np.isnan(val)
+        total = np.bincount(bins[valid], weights=val[valid], minlength=offsets[-1])
+        count = np.bincount(bins[valid], minlength=offsets[-1])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / count
+        mean[count == 0] = np.nan
+        if interpolate:
+            mean = _interpolate_segments(mean, pos, offsets[out_seg], offsets[out_seg+1])
+        resampled[key] = mean
+        
+    if clamp_to is not None:
+        # valid range of clamp_to in each trajectory
+        clamp_valid = ~np.isnan(resampled[clamp_to])
+        first_valid = np.full(len(nbins), np.inf)
+        last_valid = np.full(len(nbins), -np.inf)
+        np.minimum.at(first_valid, out_seg[clamp_valid], t[clamp_valid])
+        np.maximum.at(last_valid, out_seg[clamp_valid], t[clamp_valid])
+        first_time = np.maximum(np.minimum.reduceat(timestamp, starts), first_valid-1)
+        last_time = np.minimum(np.maximum.reduceat(timestamp, starts), last_valid+1)
+        keep = (t >= first_time[out_seg]) & (t <= last_time[out_seg])
+        
+        t = t[keep]
+        resampled = {key: val[keep] for key, val in resampled.items()}
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(out_seg[keep], minlength=len(nbins)))])
+
+    return t, resampled, offsets
+
+
+def _interpolate_segments(values, pos, seg_start, seg_end):
+    '''
+    interpolate_nans applied to each segment [seg_start, seg_end) of values independently
+    :param pos: arange(len(values))
+    :param seg_start, seg_end: start and end position of the segment each value belongs to
+    '''
+    valid = ~np.isnan(values)
+    if valid.all():
+        return values
+    prev = np.maximum.accumulate(np.where(valid, pos, -1))
+    nxt = np.minimum.accumulate(np.where(valid, pos, len(values))[::-1])[::-1]
+    has_prev = prev >= seg_start
+    has_next = nxt < seg_end
+    
+    out = np.full(len(values), np.nan)
+    hold = has_prev & ~has_next # trailing nans hold the last valid value
+    out[hold] = values[prev[hold]]
+    fill = has_prev & has_next
+    lo, hi = prev[fill], nxt[fill]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = (values[hi] - values[lo]) / (hi - lo)
+    out[fill] = np.where(hi == lo, values[lo], slope * (pos[fill] - lo) + values[lo])
+    return out
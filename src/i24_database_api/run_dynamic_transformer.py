@@ -5,10 +5,11 @@ Created on Thu Jun 23, 2022
 """
 
 # from i24_database_api.DBReader import DBReader
-from multiprocessing import Process, Queue, Manager
-import transformation 
-import change_stream_reader 
-import batch_update
+from multiprocessing import Process, Manager
+import json
+# the modules use package-relative imports, run as a module: python -m i24_database_api.run_dynamic_transformer
+from i24_database_api import transformation, change_stream_reader, batch_update
+from i24_database_api.transport import make_transport
 from ctypes import c_char_p
 
 if __name__=="__main__":
@@ -23,8 +24,17 @@ if __name__=="__main__":
     # initialize Queue for multiprocessing
     # - change_stream_reader pushes trajectories to this queue, which transform would listen from
     # - transform pushes mongoDB operation requests to this queue, which batch_update would listen from
-    change_stream_connection = Queue()
-    batch_update_connection = Queue()
+    # - both are bounded: a full queue holds back the process that puts to it (batch_update_connection can spill
+    #   instead, config "backpressure"). Resume tokens follow their batch through both queues, and batch_update
+    #   saves them once the batch is written (config "resume_token_file")
+    # streaming: run until stopped, timestamps are written once the event time watermark passes them
+    # (see batch_update.BatchUpdate: allowed_lateness, idle_timeout)
+    with open("config.json") as f:
+        config = json.load(f)
+    config.setdefault("streaming", True)
+    change_stream_connection = make_transport("queue", maxsize=16) # batches of up to 1000 documents
+    batch_update_connection = make_transport("queue", maxsize=config.get("max_queue_size"),
+                                             backpressure=config.get("backpressure", "block"))
 
     manager=Manager()
     mode = manager.Value(c_char_p,"")
@@ -35,13 +45,15 @@ if __name__=="__main__":
     proc_change_stream.start()
     
     print("[Main] Starting Transformation process...")
-    proc_transform = Process(target=transformation.run, args=(mode, change_stream_connection, batch_update_connection, ))
+    proc_transform = Process(target=transformation.run, args=(config, mode, change_stream_connection, batch_update_connection, ))
     proc_transform.start()
 
     print("[Main] Starting Batch Update process...")
-    proc_batch_update = Process(target=batch_update.run, args=(mode, batch_update_connection, ))
+    proc_batch_update = Process(target=batch_update.run, args=(config, mode, batch_update_connection, ))
     proc_batch_update.start()
     
     proc_change_stream.join()
     proc_transform.join()
-    proc_batch_update.join()
\ No newline at end of file
+    proc_batch_update.join()
+    print("[Main] change stream queue: " + change_stream_connection.stats())
+    print("[Main] batch update queue: " + batch_update_connection.stats())
\ No newline at end of file
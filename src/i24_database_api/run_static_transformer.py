@@ -5,10 +5,11 @@ Created on Thu Jun 23, 2022
 """
 
 # from i24_database_api.DBReader import DBReader
-from multiprocessing import Process, Queue, Value, Manager
-import transformation 
-import change_stream_reader 
-import batch_update
+from multiprocessing import Process, Value, Manager
+import json
+# the modules use package-relative imports, run as a module: python -m i24_database_api.run_static_transformer
+from i24_database_api import transformation, change_stream_reader, batch_update
+from i24_database_api.transport import make_transport
 from ctypes import c_char_p
 import sys
 
@@ -26,19 +27,25 @@ if __name__=="__main__":
     
     # initialize Queue for multiprocessing
     # - transform pushes mongoDB operation requests to this queue, which batch_update would listen from
-    batch_update_connection = Queue()
+    # - bounded (config "max_queue_size"), when it is full transform waits or spills (config "backpressure")
+    with open("config.json") as f:
+        config = json.load(f)
+    batch_update_connection = make_transport("queue", maxsize=config.get("max_queue_size"),
+                                             backpressure=config.get("backpressure", "block"))
     
     # start 2 child processes
     print("[Main] Starting Transformation process...")
-    proc_transform = Process(target=transformation.run, args=(mode, None, batch_update_connection, ))
+    proc_transform = Process(target=transformation.run, args=(config, mode, None, batch_update_connection, ))
     proc_transform.start()
 
     print("[Main] Starting Batch Update process...")
-    proc_batch_update = Process(target=batch_update.run, args=(mode, batch_update_connection, ))
+    proc_batch_update = Process(target=batch_update.run, args=(config, mode, batch_update_connection, ))
     proc_batch_update.start()
     
     proc_transform.join()
+    batch_update_connection.put(None) # batch_update runs until it gets a None
     proc_batch_update.join()
+    print("[Main] batch update queue: " + batch_update_connection.stats())
     print("[Main] joined processes. Exit")
     # sys.exit(0)
 
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Client-side $jsonSchema validation: a schema (e.g., config/raw_schema.json) is compiled once to a python function,
+so that documents are checked locally before they are written, instead of by the server one insert at a time.
+Element types of arrays are checked with set(map(type, array)) rather than element by element in python.
+Subclasses count as their base type, as pymongo encodes them (e.g., numpy.float64 is a double), except bool and
+Int64, which are encoded to their own BSON types although they are subclasses of int.
+
+Supported keywords: bsonType, required, properties, additionalProperties (bool), items (single schema), enum,
+minimum, maximum, minItems, maxItems, minLength, maxLength, title, description.
+Other keywords raise ValueError at compile time, so that a compiled validator never accepts what the server rejects.
+"""
+
+import datetime
+from collections import OrderedDict
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from bson.son import SON
+
+INT32_MIN, INT32_MAX = -2**31, 2**31-1
+
+# python types that pymongo encodes to each BSON type, and their subclasses. int is int32 if in range, otherwise long
+BSON_TYPES = {
+    "double": (float,),
+    "int": (int,),
+    "long": (int, Int64),
+    "number": (float, int, Int64, Decimal128),
+    "decimal": (Decimal128,),
+    "string": (str,),
+    "objectId": (ObjectId,),
+    "bool": (bool,),
+    "array": (list, tuple),
+    "object": (dict, SON, OrderedDict),
+    "null": (type(None),),
+    "date": (datetime.datetime,),
+    "binData": (bytes, Binary),
+}
+OWN_TYPES = (bool, Int64) # subclasses of int that are encoded to their own BSON type
+
+SUPPORTED = {"bsonType", "required", "properties", "additionalProperties", "items", "enum", "minimum", "maximum",
+             "minItems", "maxItems", "minLength", "maxLength", "title", "description"}
+
+NUMBER_TYPES = BSON_TYPES["number"]
+
+
+def _is_type(value_type, python_types):
+    '''
+    value_type is one of python_types or a subclass of one, see OWN_TYPES
+    '''
+    for own_type in OWN_TYPES:
+        if issubclass(value_type, own_type):
+            return own_type in python_types
+    return issubclass(value_type, python_types)
+
+
+def _int_range_ok(bson_types, values):
+    '''
+    python ints are int32 or long depending on their value, check that against bson_types
+    '''
+    ints = [v for v in values if isinstance(v, int) and not isinstance(v, OWN_TYPES)]
+    if not ints:
+        return True
+    in_int32 = INT32_MIN <= min(ints) and max(ints) <= INT32_MAX
+    out_int32 = min(ints) < INT32_MIN or max(ints) > INT32_MAX
+    if in_int32 and not bson_types & {"int", "number"}:
+        return False
+    if out_int32 and not bson_types & {"long", "number"}:
+        return False
+    return True
+
+
+def _type_check(bson_type, path):
+    bson_types = {bson_type} if isinstance(bson_type, str) else set(bson_type)
+    unknown = bson_types - set(BSON_TYPES)
+    if unknown:
+        raise ValueError("Unsupported bsonType {} at {}".format(unknown, path or "document"))
+    allowed = tuple(set().union(*(BSON_TYPES[t] for t in bson_types)))
+    message = "{}: expected bsonType {}".format(path or "document", bson_type)
+
+    def check_one(value):
+        if not _is_type(type(value), allowed) or not _int_range_ok(bson_types, [value]):
+            return [message + ", got {}".format(type(value).__name__)]
+        return []
+
+    def check_many(values):
+        # element types of an array at once
+        types = set(map(type, values))
+        if not all(_is_type(t, allowed) for t in types) or not _int_range_ok(bson_types, values):
+            return [message + " for every item, got {}".format(sorted(t.__name__ for t in types))]
+        return []
+
+    return check_one, check_many
+
+
+def compile_schema(schema, path=""):
+    '''
+    Compile a $jsonSchema (with or without the "$jsonSchema" key) to validate(value), which returns
+    a list of violations, empty if value is valid
+    '''
+    if "$jsonSchema" in schema:
+        schema = schema["$jsonSchema"]
+    unsupported = set(schema) - SUPPORTED
+    if unsupported:
+        raise ValueError("Unsupported $jsonSchema keywords {} at {}".format(unsupported, path or "document"))
+
+    checks = []
+    if "bsonType" in schema:
+        checks.append(_type_check(schema["bsonType"], path)[0])
+
+    if "enum" in schema:
+        enum = schema["enum"]
+        checks.append(lambda value: [] if value in enum else ["{}: not in enum".format(path)])
+
+    for keyword, applies, compare in [("minimum", NUMBER_TYPES, lambda v, b: v >= b), ("maximum", NUMBER_TYPES, lambda v, b: v <= b),
+                                      ("minItems", BSON_TYPES["array"], lambda v, b: len(v) >= b),
+                                      ("maxItems", BSON_TYPES["array"], lambda v, b: len(v) <= b),
+                                      ("minLength", {str}, lambda v, b: len(v) >= b), ("maxLength", {str}, lambda v, b: len(v) <= b)]:
+        if keyword in schema:
+            bound, message = schema[keyword], "{}: violates {} {}".format(path, keyword, schema[keyword])
+            checks.append(lambda value, applies=applies, compare=compare, bound=bound, message=message:
+                          [message] if _is_type(type(value), applies) and not compare(value, bound) else [])
+
+    if "items" in schema:
+        item_schema = schema["items"]
+        if not isinstance(item_schema, dict):
+            raise ValueError("Unsupported items (tuple validation) at {}".format(path))
+        item_path = path + ".items"
+        if set(item_schema) - {"bsonType", "description", "title"}:
+            validate_item = compile_schema(item_schema, item_path)
+            check_items = lambda values: [err for value in values for err in validate_item(value)]
+        elif "bsonType" in item_schema:
+            check_items = _type_check(item_schema["bsonType"], item_path)[1]
+        else:
+            check_items = None
+        if check_items is not None:
+            checks.append(lambda value: check_items(value) if _is_type(type(value), BSON_TYPES["array"]) else [])
+
+    if "properties" in schema or "required" in schema or schema.get("additionalProperties") is False:
+        properties = {key: compile_schema(sub, "{}.{}".format(path, key) if path else key)
+                      for key, sub in schema.get("properties", {}).items()}
+        required = schema.get("required", [])
+        additional = schema.get("additionalProperties", True)
+        if not isinstance(additional, bool):
+            raise ValueError("Unsupported additionalProperties schema at {}".format(path))
+
+        def check_object(value):
+            if not _is_type(type(value), BSON_TYPES["object"]):
+                return []
+            errors = ["{}: missing required field".format("{}.{}".format(path, key) if path else key)
+                      for key in required if key not in value]
+            for key, val in value.items():
+                try:
+                    errors.extend(properties[key](val))
+                except KeyError:
+                    if not additional and key != "_id":
+                        errors.append("{}: additional field not allowed".format("{}.{}".format(path, key) if path else key))
+            return errors
+        checks.append(check_object)
+
+    def validate(value):
+        errors = []
+        for check in checks:
+            errors.extend(check(value))
+        return errors
+    return validate
+
+
+def flag_violations(validate, document):
+    '''
+    Validate document, and add every violation to its "flags" array
+    :returns: list of violations, empty if document is valid
+    '''
+    errors = validate(document)
+    if errors:
+        flags = document.get("flags")
+        if not isinstance(flags, list):
+            flags = [] if flags is None else [str(flags)]
+        document["flags"] = flags + ["schema violation: " + err for err in errors]
+    return errors
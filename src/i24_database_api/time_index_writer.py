@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Write timestamp-indexed documents with inserts instead of per-timestamp upserts.
+A timestamp is closed once no trajectory that is still to be processed can touch it. Closed timestamp documents
+are assembled completely in memory and written with insert_many(ordered=False) in large batches.
+Upserts are kept only for the timestamps that are still open when they have to be written.
+"""
+
+import heapq
+import math
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY = 11000
+
+
+def insert_closed(collection, docs, merge, batch_size=1000):
+    '''
+    insert_many fully assembled timestamp documents in batches, ordered=False
+    a document that collides with an existing timestamp (duplicate key) is merged into it with merge(doc) instead,
+    other write errors are raised (BulkWriteError) once the duplicates are merged
+    :param collection: pymongo collection with a unique index on timestamp
+    :param docs: list of timestamp documents
+    :param merge: function that returns an UpdateOne(upsert=True) to merge a document into an existing one
+    :param batch_size: number of documents per insert_many
+    '''
+    for i in range(0, len(docs), batch_size):
+        batch = docs[i:i+batch_size]
+        try:
+            collection.insert_many(batch, ordered=False, bypass_document_validation=True)
+        except BulkWriteError as bwe:
+            duplicates = [err["index"] for err in bwe.details["writeErrors"] if err["code"] == DUPLICATE_KEY]
+            others = [err for err in bwe.details["writeErrors"] if err["code"] != DUPLICATE_KEY]
+            if duplicates:
+                collection.bulk_write([merge(batch[idx]) for idx in duplicates], ordered=False)
+            if others:
+                raise BulkWriteError(dict(bwe.details, writeErrors=others))
+
+
+class TimestampAccumulator:
+    """
+    Holds the timestamp documents (or their pieces) that are still open, keyed by timestamp.
+    Timestamps are closed by a watermark instead of a staleness count: when trajectories are processed in order of
+    first_timestamp, the minimum first timestamp among the unprocessed ones is a bound below which nothing can be
+    added anymore. Open timestamps are kept in a heap, so advancing the watermark costs O(log n) per closed timestamp
+    and nothing for the ones that stay open.
+    If max_size is specified, spill() pops the earliest timestamps that are over the limit even though they are
+    still open. Those have to be written such that they merge with whatever is added to the same timestamp later.
+    """
+    def __init__(self, max_size=None):
+        '''
+        :param max_size: maximum number of open timestamps kept in memory, None for no limit
+        '''
+        self.max_size = max_size
+        self.watermark = -math.inf
+        self.num_spilled = 0
+        self._entries = {} # key: timestamp, val: entry
+        self._heap = [] # the keys of _entries
+
+    def setdefault(self, timestamp, default):
+        '''
+        Return the entry of timestamp, insert default first if timestamp is not open
+        '''
+        try:
+            return self._entries[timestamp]
+        except KeyError:
+            heapq.heappush(self._heap, timestamp)
+            self._entries[timestamp] = default
+            return default
+
+    def advance(self, watermark):
+        '''
+        Move the watermark forward, and pop the timestamps below it
+        :returns: list of (timestamp, entry) in timestamp order
+        '''
+        self.watermark = max(self.watermark, watermark)
+        return self._pop_until(self.watermark)
+
+    def spill(self):
+        '''
+        Pop the earliest open timestamps until at most max_size are left
+        :returns: list of (timestamp, entry) in timestamp order
+        '''
+        if self.max_size is None or len(self._entries) <= self.max_size:
+            return []
+        spilled = [self._pop() for _ in range(len(self._entries) - self.max_size)]
+        self.num_spilled += len(spilled)
+        return spilled
+
+    def pop_all(self):
+        return self._pop_until(math.inf)
+
+    def earliest(self):
+        '''
+        the earliest open timestamp, inf if none
+        '''
+        return self._heap[0] if self._heap else math.inf
+
+    def _pop(self):
+        timestamp = heapq.heappop(self._heap)
+        return timestamp, self._entries.pop(timestamp)
+
+    def _pop_until(self, watermark):
+        popped = []
+        while self._heap and self._heap[0] < watermark:
+            popped.append(self._pop())
+        return popped
+
+    def __contains__(self, timestamp):
+        return timestamp in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TimeIndexWriter:
+    """
+    Assembles the timestamp documents of transform2 from the subdocuments sent by each direction.
+    Each direction reports a watermark: it will not send anything for a timestamp below its watermark anymore.
+    Timestamps below the watermark of every direction are closed and inserted, the rest stays in memory until
+    flush(), which upserts whatever is still open. If more than max_open are open, the earliest ones are upserted
+    right away, and whatever arrives for them later is merged in.
+    schema:
+        {
+            "timestamp": t,
+            "eb": {str(id): [centerx, centery, l, w, dir, v, a, cls, videonode], ...},
+            "wb": {...}
+        }
+    """
+    def __init__(self, collection, directions=("eb", "wb"), batch_size=1000, use_insert=True, max_open=None):
+        '''
+        :param collection: write collection, should have a unique index on timestamp
+        :param directions: names of the subdocuments, each is expected to advance its own watermark
+        :param batch_size: number of documents per insert_many or bulk_write
+        :param use_insert: if False, closed documents are upserted as well (e.g., no unique timestamp index)
+        :param max_open: maximum number of open documents kept in memory, None for no limit
+        '''
+        self.collection = collection
+        self.directions = directions
+        self.batch_size = batch_size
+        self.use_insert = use_insert
+
+        self._docs = TimestampAccumulator(max_open) # documents being assembled
+        self._watermark = dict.fromkeys(directions, -math.inf)
+        self._closed_until = -math.inf # every timestamp below is written already
+        self._closed = []
+        self._late = []
+
+    def add(self, direction, timestamp, subdoc):
+        '''
+        Merge a direction's subdocument {str(id): row} into the document of timestamp
+        '''
+        if timestamp < self._closed_until:
+            # the document is written already, merge this piece in with an upsert
+            self._late.append(self.upsert({"timestamp": timestamp, direction: subdoc}))
+            if len(self._late) >= self.batch_size:
+                self.write_late()
+            return
+
+        doc = self._docs.setdefault(timestamp, {"timestamp": timestamp})
+        try:
+            doc[direction].update(subdoc)
+        except KeyError:
+            doc[direction] = dict(subdoc)
+
+        # over max_open: upsert the earliest, a later document of the same timestamp is merged into it on insert
+        self._late.extend(self.upsert(doc) for _, doc in self._docs.spill())
+        if len(self._late) >= self.batch_size:
+            self.write_late()
+
+    def advance(self, direction, watermark):
+        '''
+        Move the watermark of direction forward, and write the timestamps that are closed for every direction
+        '''
+        self._watermark[direction] = max(self._watermark[direction], watermark)
+        closed_until = min(self._watermark.values())
+        if closed_until <= self._closed_until:
+            return
+
+        self._closed_until = closed_until
+        self._closed.extend(doc for _, doc in self._docs.advance(closed_until))
+        if len(self._closed) >= self.batch_size:
+            self.write_closed()
+
+    @property
+    def closed_until(self):
+        '''
+        every timestamp below is closed: in the write collection, or in the batch of closed documents to insert
+        '''
+        return self._closed_until
+
+    def upsert(self, doc):
+        '''
+        UpdateOne that merges doc into the document of the same timestamp
+        '''
+        update = {direction+"."+key: val for direction in self.directions if direction in doc
+                  for key, val in doc[direction].items()}
+        return UpdateOne(filter={"timestamp": doc["timestamp"]}, update={"$set": update}, upsert=True)
+
+    def write_closed(self):
+        if not self._closed:
+            return
+        if self.use_insert:
+            insert_closed(self.collection, self._closed, self.upsert, self.batch_size)
+        else:
+            self.collection.bulk_write([self.upsert(doc) for doc in self._closed], ordered=False)
+        self._closed = []
+
+    def write_late(self):
+        if self._late:
+            self.collection.bulk_write(self._late, ordered=False)
+            self._late = []
+
+    def flush(self):
+        '''
+        Write everything: closed documents with inserts, open ones with upserts, since a direction may still add to them
+        '''
+        self.write_closed()
+        self.write_late()
+        open_docs = [self.upsert(doc) for _, doc in self._docs.pop_all()]
+        for i in range(0, len(open_docs), self.batch_size):
+            self.collection.bulk_write(open_docs[i:i+self.batch_size], ordered=False)
+
+    def __len__(self):
+        return len(self._docs) + len(self._closed)
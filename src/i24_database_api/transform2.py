@@ -6,13 +6,18 @@ Created on Fri Oct 21 11:39:27 2022
 @author: yanbing_wang
 """
 
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import pymongo
 from pymongo import UpdateOne
-import queue
-import time
+import math
+
+from .resample import resample_batch, decimal_range
+from .time_index_writer import TimeIndexWriter, TimestampAccumulator
+from .transport import TimestampBatcher, iter_timestamps, flush_channel
+from .connections import get_client
+from .job_manifest import JobManifest
 
 dt = 0.04
 class LRUCache:
@@ -46,16 +51,229 @@ class LRUCache:
         self.cache.move_to_end(key)   
     
 
-def decimal_range(start, stop, increment):
-    while start <= stop: # and not math.isclose(start, stop): Py>3.5
-        yield start
-        start += increment
+def time_series(traj, dir):
+    '''
+    Get the time-series fields to be resampled from a trajectory document
+    length and width are broadcasted to time-series, velocity and acceleration are computed by finite difference if not present
+    '''
+    time_series_field = ["timestamp", "x_position", "y_position", "length", "width"]
+    l, w = traj["length"], traj["width"]
+    n = len(traj["x_position"])
+    
+    if isinstance(l, float):
+        l,w = [l]*n, [w]*n # make length and width time-seriesc
+        
+    elif len(l)==1:
+        l,w = l*n, w*n
+        
+    try:
+        velocity = traj["velocity"]
+    except KeyError:
+        velocity = list(dir*np.diff(traj["x_position"])/dt)
+        velocity.append(velocity[-1])
+
+    # finite difference twice to get acceleration
+    accel = list(np.diff(traj["x_position"], n=2)/(dt**2))
+    last_accel = accel[-1]
+    accel.extend([last_accel,last_accel]) 
+    
+    data = {key:traj[key] for key in time_series_field}
+    data["velocity"] = velocity
+    data["acceleration"] = accel
+    data["length"] = l
+    data["width"] = w
+    return data
+
+
+def resample_pandas(traj, dir, interpolate=False):
+    '''
+    Resample a trajectory document to 1/dt hz using pandas
+    returns timestamps and the corresponding rows of [centerx, centery, l, w, dir, v, a, cls, videonode]
+    '''
+    data = time_series(traj, dir)
+    ccls, node = traj["coarse_vehicle_class"], traj["compute_node_id"]
+    
+    df = pd.DataFrame(data, columns=data.keys()) 
+    index = pd.to_timedelta(df["timestamp"], unit='s')
+    df = df.set_index(index)
+    df = df.drop(columns = "timestamp")
+    
+    # leave nans blank
+    freq = str(dt)+"S"
+    df = df.resample(freq).mean() # leave nans
+    df.index = df.index.values.astype('datetime64[ns]')#.astype('int64')*1e-9
+    df=df.groupby(df.index.floor(str(dt)+"S")).mean().resample(str(dt)+"S").asfreq()
+    df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
+
+    # fill nans
+    if interpolate:
+        try:
+            df = df.interpolate(method='linear')
+        except:
+            pass
+    
+    # do not extrapolate for more than 1 sec
+    first_valid_time = pd.Series.first_valid_index(df['x_position'])
+    last_valid_time = pd.Series.last_valid_index(df['x_position'])
+    first_time = max(min(traj['timestamp']), first_valid_time-1)
+    last_time = min(max(traj['timestamp']), last_valid_time+1)
+    df=df[first_time:last_time]
+    
+    rows = []
+    for t in df.index:
+        # [centerx, centery, l ,w, dir, v]
+        rows.append([df["x_position"][t] + dir*0.5*df["length"][t],
+                    df["y_position"][t],
+                    df["length"][t],
+                    df["width"][t], 
+                    dir,
+                    df["velocity"][t],
+                    df["acceleration"][t],
+                    ccls,
+                    node]) # dir, v, a, cls, videonode],
+    return list(df.index), rows
+
+
+def resample_numpy(traj, dir, interpolate=False):
+    '''
+    Same as resample_pandas, but binned and interpolated on whole arrays (see resample.resample_batch)
+    '''
+    return resample_numpy_batch([traj], dir, interpolate)[0]
+
+
+def resample_pandas_batch(trajs, dir, interpolate=False):
+    return [resample_pandas(traj, dir, interpolate) for traj in trajs]
+
+
+def resample_numpy_batch(trajs, dir, interpolate=False):
+    '''
+    Resample a list of trajectory documents in a single vectorized pass
+    returns a list of (timestamps, rows) aligned with trajs, same as resample_pandas
+    '''
+    if not trajs:
+        return []
+    series = [time_series(traj, dir) for traj in trajs]
+    fields = ["x_position", "y_position", "length", "width", "velocity", "acceleration"]
+    t, df, offsets = resample_batch([data["timestamp"] for data in series],
+                                    {key: [data[key] for data in series] for key in fields},
+                                    interpolate=interpolate, origin="start", clamp_to="x_position")
+    
+    features = np.column_stack([df["x_position"] + dir*0.5*df["length"],
+                                df["y_position"],
+                                df["length"],
+                                df["width"],
+                                df["velocity"],
+                                df["acceleration"]]).tolist()
+    t = t.tolist()
+    
+    result = []
+    for i, traj in enumerate(trajs):
+        ccls, node = traj["coarse_vehicle_class"], traj["compute_node_id"]
+        lo, hi = offsets[i], offsets[i+1]
+        rows = [f[:4] + [dir] + f[4:] + [ccls, node] for f in features[lo:hi]]
+        result.append((t[lo:hi], rows))
+    return result
+
+
+RESAMPLE_ENGINES = {"pandas": resample_pandas_batch,
+                    "numpy": resample_numpy_batch}
+
+
+RESAMPLE_BATCH_SIZES = {"pandas": 1, # resamples trajectory by trajectory, batching would only delay the results
+                        "numpy": 1000}
+
+
+def resample_cursor(cursor, dir, interpolate=False, engine="pandas", batch_size=None):
+    '''
+    Iterate over a cursor of trajectory documents and resample them [batch_size] documents at a time
+    (defaults to RESAMPLE_BATCH_SIZES of the engine)
+    yields (traj, (timestamps, rows)) in the order of the cursor
+    '''
+    resample_trajs = RESAMPLE_ENGINES[engine]
+    batch_size = batch_size or RESAMPLE_BATCH_SIZES[engine]
+    batch = []
+    for traj in cursor:
+        batch.append(traj)
+        if len(batch) >= batch_size:
+            yield from zip(batch, resample_trajs(batch, dir, interpolate))
+            batch = []
+    if batch:
+        yield from zip(batch, resample_trajs(batch, dir, interpolate))
         
         
+def transform_chunk(from_collection, direction, chunk_start, chunk_end, send, interpolate=False, engine="pandas", time_range=None,
+                    max_open=None, query_filter=None):
+    '''
+    Resample the trajectories of direction that start in [chunk_start, chunk_end), and send(t, subdoc) for each timestamp,
+    where subdoc is {str(id): [centerx, centery, l, w, dir, v, a, cls, videonode], ...}
+    time_range: (start, end) if specified, only timestamps in [start, end) are sent
+    max_open: maximum number of open timestamps in memory. If exceeded, the earliest ones are sent before they are
+        complete, and another subdoc of the same timestamp may be sent later
+    query_filter: if specified, only the trajectories that match it are resampled (e.g., high_water_filter)
+    returns the latest timestamp sent, -inf if none
+    '''
+    dir = 1 if direction=="eb" else -1
+    
+    open_timestamps = TimestampAccumulator(max_open) # key: timestamp, val: subdoc
+    attr_lru = LRUCache(1000)
+    last = -math.inf
+    
+    query = {"direction":dir, "first_timestamp": {"$gte": chunk_start, "$lt": chunk_end}}
+    if query_filter:
+        query = {"$and": [query_filter, query]}
+    all_trajs = from_collection.find(query).sort("first_timestamp",1)
+    
+    # resample to 1/dt hz, in batches of trajectories
+    for traj, (timestamps, rows) in resample_cursor(all_trajs, dir, interpolate, engine):
+        
+        _id, node, ccls = traj["_id"], traj["compute_node_id"], traj["coarse_vehicle_class"] 
+        attr_lru.put(_id, [ccls,node])
         
-def transform_beta(direction, config_params, bulk_write_que, chunk_size=50, interpolate=False):
+        # trajectories are sorted by first_timestamp, so the rest cannot add to timestamps before this one starts
+        closed = open_timestamps.advance(traj["first_timestamp"]-dt)
+        
+        # add to result dictionary
+        for t, row in zip(timestamps, rows):
+            if time_range is not None and not time_range[0] <= round(t,2) < time_range[1]:
+                continue # owned by another shard
+            open_timestamps.setdefault(t, {})[str(_id)] = row
+            
+        # update db
+        for t, d in closed + open_timestamps.spill():
+            send(t, d)
+            last = max(last, t)
+            
+    # write the rest to database
+    for t, d in open_timestamps.pop_all():
+        send(t, d)
+        last = max(last, t)
+    return last
+
+
+def update_command(direction, t, d):
+    '''
+    UpdateOne that sets the subdocument d of direction in the document of timestamp t
+    '''
+    # change d to value.objectid: array, so that it does not reset the value field, but only update it
+    query = {"timestamp": t}
+    update = {"$set": {direction+"."+key: val for key,val in d.items()}}
+    return UpdateOne(filter=query, update=update, upsert=True)
+
+
+def transform_beta(direction, config_params, bulk_write_que, chunk_size=50, interpolate=False, engine="pandas",
+                   write_mode="upsert", transport="queue"):
     '''
     direction: eb or wb
+    engine: resampling engine, "pandas" or "numpy" (see RESAMPLE_ENGINES)
+    write_mode: "upsert": put an UpdateOne(upsert=True) per timestamp to bulk_write_que
+        "insert": put ("add", direction, timestamp, subdoc) per timestamp, and ("advance", direction, watermark)
+        once a chunk is done, so that batch_write can insert closed timestamps (see TimeIndexWriter)
+    transport: "queue": put one item per timestamp as above
+        "chunked" or "shared_memory": put columnar batches of timestamps instead (see transport.TimestampBatcher),
+        batch_write builds the UpdateOne's or the documents
+    If config_params["job_id"] is specified, the chunks committed in the job manifest are skipped, and every other
+    chunk is put between ("chunk", direction, index) and ("commit", direction, index, latest timestamp), for batch_write
+    to commit it once it is written. The chunks are those of config_params["chunk_start"], ["chunk_end"] if specified
     query trajectories that starts in range [start_time, end_time)
     if they are specified. Otherwise from the b
     ** for static from_collection only **
@@ -107,164 +325,63 @@ def transform_beta(direction, config_params, bulk_write_que, chunk_size=50, inte
     client_password=config_params['password']
     client_port=config_params['port']
 
-    client=pymongo.MongoClient(host=client_host,
-        port=client_port,
-        username=client_username,
-        password=client_password,
-        connect=True,
-        connectTimeoutMS=5000)
+    client=get_client(host=client_host, port=client_port, username=client_username, password=client_password)
 
 
     from_collection = client[config_params['read_database_name']][config_params['read_collection_name']]
     
-    time_series_field = ["timestamp", "x_position", "y_position", "length", "width"]
-      
-    stale_thresh = 500 # if a timestamp is not updated for [stale_thresh] times, then update to database. stale_thresh~=#veh on roadway simulataneously
-    # last_poped_t = 0
+    batcher = TimestampBatcher(bulk_write_que, direction) if transport != "queue" else None
     
-    dir = 1 if direction=="eb" else -1
-    start = from_collection.find_one(sort=[("first_timestamp", 1)])["first_timestamp"]-1
-    end = from_collection.find_one(sort=[("first_timestamp", -1)])["first_timestamp"]+1
+    def send(t, d):
+        if batcher is not None:
+            batcher.add(round(t,2), d)
+        elif write_mode == "insert":
+            bulk_write_que.put(("add", direction, round(t,2), d))
+        else:
+            bulk_write_que.put(update_command(direction, round(t,2), d))
+    
+    query_filter = config_params.get("query_filter") or {}
+    if config_params.get("chunk_start") is not None:
+        start, end = config_params["chunk_start"], config_params["chunk_end"]
+    else:
+        start = from_collection.find_one(query_filter, {"first_timestamp": 1}, sort=[("first_timestamp", 1)])["first_timestamp"]-1
+        end = from_collection.find_one(query_filter, {"first_timestamp": 1}, sort=[("first_timestamp", -1)])["first_timestamp"]+1
     if not chunk_size:
         chunk_size = end-start # query the entire collection
+    
+    manifest = None
+    if config_params.get("job_id"):
+        manifest = JobManifest(client[config_params["write_database_name"]], config_params["job_id"])
+    committed = manifest.committed_chunks(direction) if manifest is not None else set()
       
     # specify query - iterative ranges
-    for s in decimal_range(start, end, chunk_size):
+    for chunk, s in enumerate(decimal_range(start, end, chunk_size)):
+        if chunk in committed:
+            if write_mode == "insert":
+                bulk_write_que.put(("advance", direction, s+chunk_size-dt))
+            continue
+        if manifest is not None:
+            bulk_write_que.put(("chunk", direction, chunk))
         
         # print(f"range start {s}, range end {s+chunk_size}, start {start}, end {end}")
         print("{} In progress (approx) {:.1f} %".format(direction, (s-start)/(end-start)*100), end='\r')
         # print("\r", f"..progress..: {count} / {total}", 
         #       end="", flush=True)
         
-        lru = OrderedDict()
-        attr_lru = LRUCache(1000)
-        stale = defaultdict(int) # key: timestamp, val: number of timestamps that it hasn't been updated
-        
-        all_trajs = from_collection.find({"direction":dir, "first_timestamp": {"$gte": s, "$lt": s+chunk_size}}).sort("first_timestamp",1)
-        
-        for traj in all_trajs:
-            
-            _id, l,w,node, ccls = traj["_id"], traj["length"], traj["width"], traj["compute_node_id"], traj["coarse_vehicle_class"] 
-            attr_lru.put(_id, [ccls,node])
-            n = len(traj["x_position"])
-            
-            if isinstance(l, float):
-                l,w = [l]*n, [w]*n # make length and width time-seriesc
-                
-            elif len(l)==1:
-                l,w = l*n, w*n
-                
-            try:
-                velocity = traj["velocity"]
-            except KeyError:
-                velocity = list(dir*np.diff(traj["x_position"])/dt)
-                velocity.append(velocity[-1])
-        
-            # finite difference twice to get acceleration
-            accel = list(np.diff(traj["x_position"], n=2)/(dt**2))
-            last_accel = accel[-1]
-            accel.extend([last_accel,last_accel]) 
-            
-            # increment stale
-            for k in stale:
-                stale[k] += 1
+        last = transform_chunk(from_collection, direction, s, s+chunk_size, send, interpolate, engine,
+                               max_open=config_params.get("max_cache_size"), query_filter=query_filter)
             
-            # resample to 1/dt hz
-            data = {key:traj[key] for key in time_series_field}
-            data["velocity"] = velocity
-            data["acceleration"] = accel
-            data["length"] = l
-            data["width"] = w
-            
-            # try:
-            df = pd.DataFrame(data, columns=data.keys()) 
-            # except ValueError:
-                # print(len(l),len(w),len(velocity),len(accel))
-                # print(l, w)
-            index = pd.to_timedelta(df["timestamp"], unit='s')
-            df = df.set_index(index)
-            df = df.drop(columns = "timestamp")
-            
-            # leave nans blank
-            freq = str(dt)+"S"
-            df = df.resample(freq).mean() # leave nans
-            df.index = df.index.values.astype('datetime64[ns]')#.astype('int64')*1e-9
-            df=df.groupby(df.index.floor(str(dt)+"S")).mean().resample(str(dt)+"S").asfreq()
-            df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-
-            # fill nans
-            if interpolate:
-                try:
-                    df = df.interpolate(method='linear')
-                except:
-                    pass
-            
-            # assemble in traj
-            # do not extrapolate for more than 1 sec
-            first_valid_time = pd.Series.first_valid_index(df['x_position'])
-            last_valid_time = pd.Series.last_valid_index(df['x_position'])
-            first_time = max(min(traj['timestamp']), first_valid_time-1)
-            last_time = min(max(traj['timestamp']), last_valid_time+1)
-            df=df[first_time:last_time]
-
-            traj["first_timestamp"] = df.index.values[0]
-            traj["last_timestamp"] = df.index.values[-1]
-            traj["starting_x"] = df['x_position'].values[0]
-            traj["ending_x"] = df['x_position'].values[-1]
-    
-            
-            # add to result dictionary
-            for t in df.index:
-                # [centerx, centery, l ,w, dir, v]
-                ccls, node = attr_lru.get(_id)
-                try:
-                    lru[t][str(_id)] = [df["x_position"][t] + dir*0.5*df["length"][t],
-                                        df["y_position"][t],
-                                        df["length"][t],
-                                        df["width"][t], 
-                                        dir,
-                                        df["velocity"][t],
-                                        df["acceleration"][t],
-                                        ccls,
-                                        node] # dir, v, a, cls, videonode],
-                except: # t does not exists in lru yet
-                    # if t <= last_poped_t:
-                    #     # meaning t was poped pre-maturely
-                    #     print("t was poped prematurely from LRU in transform_queue. Increase stale")
-                        
-                    lru[t] = {str(_id): [df["x_position"][t] + dir*0.5*df["length"][t],
-                                        df["y_position"][t],
-                                        df["length"][t],
-                                        df["width"][t], 
-                                        dir,
-                                        df["velocity"][t],
-                                        df["acceleration"][t],
-                                        ccls,
-                                        node] }
-                lru.move_to_end(t, last=True)
-                stale[t] = 0 # reset staleness
-                
-            # update db from lru
-            while stale[next(iter(lru))] > stale_thresh:
-                t, d = lru.popitem(last=False) # pop first
-                # last_poped_t = t
-                stale.pop(t)
-                # change d to value.objectid: array, so that it does not reset the value field, but only update it
-                query = {"timestamp": round(t,2)}
-                update = {"$set": {direction+"."+key: val for key,val in d.items()}}
-                bulk_write_que.put(UpdateOne(filter=query, update=update, upsert=True))
-            
-                
-        # write the rest of lru to database
-        # print("Flush out the rest in LRU cache")
-        while len(lru) > 0:
-            t, d = lru.popitem(last=False) # pop first
-            # d={direction+"."+key: val for key,val in d.items()}
-            # pool.apply_async(thread_update_one, (to_collection, {"timestamp": round(t,2)},{"$set": d},))
-            query = {"timestamp": round(t,2)}
-            update = {"$set": {direction+"."+key: val for key,val in d.items()}}
-            bulk_write_que.put(UpdateOne(filter=query, update=update, upsert=True))
+        if batcher is not None:
+            batcher.flush()
+        # trajectories in the next chunks start at or after s+chunk_size, so earlier timestamps are closed for this direction
+        if write_mode == "insert":
+            bulk_write_que.put(("advance", direction, s+chunk_size-dt))
+        if manifest is not None:
+            bulk_write_que.put(("commit", direction, chunk, round(last, 2)))
             
+    if write_mode == "insert":
+        bulk_write_que.put(("advance", direction, math.inf))
+    flush_channel(bulk_write_que)
 
     del from_collection
     return 
@@ -272,74 +389,248 @@ def transform_beta(direction, config_params, bulk_write_que, chunk_size=50, inte
 
 
 
-def batch_write(config_params, bulk_write_queue, write_meta = False):
-    
-    time.sleep(10)
+def shard_ranges(start, end, num_shards):
+    '''
+    Partition [start, end) into num_shards consecutive time ranges of equal length
+    boundaries are rounded to 2 digits like the timestamps, so that every timestamp is owned by exactly one shard
+    '''
+    bounds = [round(start + (end-start)*i/num_shards, 2) for i in range(num_shards)] + [math.inf]
+    bounds[0] = -math.inf
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def transform_shard(config_params, shard_start, shard_end, halo, chunk_size=None, interpolate=False, engine="numpy",
+                    write_mode="insert", shard_index=None):
+    '''
+    Transform the timestamps in [shard_start, shard_end) of both directions and write them to the transformed collection.
+    A shard owns its timestamps, so shards can run in parallel with no coordination and each writes its documents directly.
+    Trajectories that start up to [halo] sec before the shard are read as well, since they can run into the shard,
+    i.e., halo should be no shorter than the longest trajectory. Timestamps outside of the shard are dropped.
+    If config_params["job_id"] is specified, the shard is committed as ("shards", shard_index) in the job manifest
+    once it is written.
+    '''
     client_host=config_params['host']
     client_username=config_params['username']
     client_password=config_params['password']
     client_port=config_params['port']
 
-    client=pymongo.MongoClient(host=client_host,
-        port=client_port,
-        username=client_username,
-        password=client_password,
-        connect=True,
-        connectTimeoutMS=5000)
+    client=get_client(host=client_host, port=client_port, username=client_username, password=client_password)
+
+    from_collection = client[config_params['read_database_name']][config_params['read_collection_name']]
+    to_collection = client[config_params["write_database_name"]][config_params["write_collection_name"]]
+    use_insert = create_timestamp_index(to_collection, unique=True) if write_mode == "insert" else False
+    writer = TimeIndexWriter(to_collection, directions=("eb", "wb"), use_insert=use_insert,
+                             max_open=config_params.get("max_cache_size"))
+    
+    # read range of first_timestamp
+    query_filter = config_params.get("query_filter") or {}
+    start = max(shard_start-halo, from_collection.find_one(query_filter, {"first_timestamp": 1}, sort=[("first_timestamp", 1)])["first_timestamp"])
+    end = min(shard_end, from_collection.find_one(query_filter, {"first_timestamp": 1}, sort=[("first_timestamp", -1)])["first_timestamp"]+1)
+    manifest = None
+    if config_params.get("job_id"):
+        manifest = JobManifest(client[config_params["write_database_name"]], config_params["job_id"])
+    if end <= start:
+        if manifest is not None:
+            manifest.commit_chunk("shards", shard_index)
+        return
+    if not chunk_size:
+        chunk_size = end-start
+    
+    for s in decimal_range(start, end, chunk_size):
+        for direction in ["eb", "wb"]:
+            send = lambda t, d: writer.add(direction, round(t,2), d)
+            transform_chunk(from_collection, direction, s, min(s+chunk_size, end), send, interpolate, engine,
+                            time_range=(shard_start, shard_end), max_open=config_params.get("max_cache_size"),
+                            query_filter=query_filter)
+            # trajectories in the next chunks start at or after s+chunk_size
+            writer.advance(direction, s+chunk_size-dt)
+            
+    writer.flush()
+    if manifest is not None:
+        manifest.commit_chunk("shards", shard_index)
+    del from_collection
+    return
+
 
+def create_timestamp_index(to_collection, unique=False):
+    '''
+    Create the timestamp index on the transformed collection
+    returns True if the index is unique, i.e., timestamp documents can be inserted without duplicating a timestamp
+    '''
+    if not unique:
+        to_collection.create_index("timestamp")
+        return False
+    try:
+        to_collection.create_index("timestamp", unique=True)
+        return True
+    except pymongo.errors.OperationFailure:
+        # an existing non-unique index, inserts could duplicate timestamps
+        print("timestamp index is not unique in {}, upsert closed timestamps instead".format(to_collection.name))
+        return False
 
+
+def write_metadata(client, config_params):
+    '''
+    Write the information of the read collection to __METADATA__ in the write database
+    '''
     from_collection = client[config_params['read_database_name']][config_params['read_collection_name']]
+    meta_col = client[config_params["write_database_name"]]["__METADATA__"]
+    # project to the field, so that whole trajectories are not read
+    start_time = from_collection.find_one({}, {"first_timestamp": 1}, sort=[("first_timestamp", 1)])["first_timestamp"]
+    end_time = from_collection.find_one({}, {"last_timestamp": 1}, sort=[("last_timestamp", -1)])["last_timestamp"]
+    start_x = from_collection.find_one({}, {"starting_x": 1}, sort=[("starting_x", 1)])["starting_x"]
+    end_x = from_collection.find_one({}, {"ending_x": 1}, sort=[("ending_x", -1)])["ending_x"]
+    
+    meta_doc = {
+        "_id": config_params['write_collection_name'],
+        "name": "",
+        "description": "",
+        "start_time": start_time,
+        "end_time": end_time,
+        "num_objects": from_collection.estimated_document_count(),
+        "duration": end_time-start_time,
+        "start_x": start_x,
+        "end_x": end_x, 
+        "road_segment_length": abs(start_x-end_x)
+        }
+    try:
+        meta_col.insert_one(meta_doc, bypass_document_validation=True)
+    except:
+        _id = config_params['write_collection_name']
+        meta_doc.pop("_id")
+        meta_col.update_one({"_id": _id}, {"$set": meta_doc}, upsert=True)
+        
+        
+    print("Collection information is written to __METADATA__")
+
+
+def high_water_filter(field, after, until):
+    '''
+    Query of the trajectories with after < field <= until, i.e., the ones added since the high-water mark after
+    (None if there is none yet) up to until
+    '''
+    bounds = {"$lte": until}
+    if after is not None:
+        bounds["$gt"] = after
+    return {field: bounds}
+
+
+def read_high_water_mark(client, config_params, field):
+    '''
+    The high-water mark of the write collection in __METADATA__ of the write database, None if it has none
+    Raises ValueError if the mark is of another field, since it cannot be compared
+    '''
+    meta_col = client[config_params["write_database_name"]]["__METADATA__"]
+    meta_doc = meta_col.find_one({"_id": config_params["write_collection_name"]}) or {}
+    if meta_doc.get("high_water_mark") is None:
+        return None
+    if meta_doc["high_water_field"] != field:
+        raise ValueError("The high-water mark of {} is on {}, not {}".format(config_params["write_collection_name"],
+                                                                           meta_doc["high_water_field"], field))
+    return meta_doc["high_water_mark"]
+
+
+def write_high_water_mark(client, config_params, field, value):
+    '''
+    Record in __METADATA__ of the write database that the trajectories up to field = value are transformed
+    '''
+    meta_col = client[config_params["write_database_name"]]["__METADATA__"]
+    meta_col.update_one({"_id": config_params["write_collection_name"]},
+                        {"$set": {"high_water_field": field, "high_water_mark": value}}, upsert=True)
+    print("High-water mark {} = {} is written to __METADATA__".format(field, value))
+
+
+def batch_write(config_params, bulk_write_queue, write_meta = False, write_mode = "upsert"):
+    '''
+    Listen to bulk_write_queue and write to the transformed collection, until a None arrives (transform2 puts it
+    once the transform processes are done, i.e., after everything they sent)
+    write_mode: "upsert": commands are UpdateOne's, written with bulk_write in batches
+        "insert": commands are ("add", direction, timestamp, subdoc) and ("advance", direction, watermark) from transform_beta.
+        Documents are assembled in memory and inserted once closed for both directions (see TimeIndexWriter)
+    Columnar batches of timestamps (transport "chunked" or "shared_memory") are unpacked to either of the above
+    ("chunk", direction, index) and ("commit", direction, index, latest timestamp) surround the commands of a chunk
+    (see transform_beta). Once they are all written, the chunk is committed in the job manifest, unless this process
+    did not receive the beginning of the chunk, e.g., it replaced a batch_write that failed.
+    '''
+    client_host=config_params['host']
+    client_username=config_params['username']
+    client_password=config_params['password']
+    client_port=config_params['port']
+
+    client=get_client(host=client_host, port=client_port, username=client_username, password=client_password)
+
+
     to_collection = client[config_params["write_database_name"]][config_params["write_collection_name"]]
-    to_collection.create_index("timestamp")
+    if write_mode == "insert":
+        writer = TimeIndexWriter(to_collection, directions=("eb", "wb"), use_insert=create_timestamp_index(to_collection, unique=True),
+                                 max_open=config_params.get("max_cache_size"))
+    else:
+        create_timestamp_index(to_collection)
     
     # add schema to the meta collection
     if write_meta:
-        meta_col = client[config_params["write_database_name"]]["__METADATA__"]
-        start_time = from_collection.find_one(sort=[("first_timestamp", 1)])["first_timestamp"]
-        end_time = from_collection.find_one(sort=[("last_timestamp", -1)])["last_timestamp"]
-        start_x = from_collection.find_one(sort=[("starting_x", 1)])["starting_x"]
-        end_x = from_collection.find_one(sort=[("ending_x", -1)])["ending_x"]
-        
-        meta_doc = {
-            "_id": config_params['write_collection_name'],
-            "name": "",
-            "description": "",
-            "start_time": start_time,
-            "end_time": end_time,
-            "num_objects": from_collection.estimated_document_count(),
-            "duration": end_time-start_time,
-            "start_x": start_x,
-            "end_x": end_x, 
-            "road_segment_length": abs(start_x-end_x)
-            }
-        try:
-            meta_col.insert_one(meta_doc, bypass_document_validation=True)
-        except:
-            _id = config_params['write_collection_name']
-            meta_doc.pop("_id")
-            meta_col.update_one({"_id": _id}, {"$set": meta_doc}, upsert=True)
-            
-            
-        print("Collection information is written to __METADATA__")
+        write_metadata(client, config_params)
 
+    manifest = None
+    if config_params.get("job_id"):
+        manifest = JobManifest(client[config_params["write_database_name"]], config_params["job_id"])
+    begun = set() # (direction, chunk) whose commands all went to this process
+    pending = [] # (direction, chunk, latest timestamp) to commit once written
+    
     bulk_write_cmd = []
     
     while True:
-        try:
-            cmd = bulk_write_queue.get(timeout = 5)
-            bulk_write_cmd.append(cmd)
-            
-        except queue.Empty:
-            # print("Getting from bulk_write_queue reaches timeout.")
+        cmd = bulk_write_queue.get()
+        if cmd is None: # end
             break
         
+        if isinstance(cmd, UpdateOne):
+            bulk_write_cmd.append(cmd)
+        elif isinstance(cmd, dict): # columnar batch from TimestampBatcher
+            for direction, t, d in iter_timestamps(cmd):
+                if write_mode == "insert":
+                    writer.add(direction, t, d)
+                else:
+                    bulk_write_cmd.append(update_command(direction, t, d))
+        elif cmd[0] == "add":
+            writer.add(*cmd[1:])
+        elif cmd[0] == "advance":
+            writer.advance(*cmd[1:])
+        elif cmd[0] == "chunk":
+            begun.add(cmd[1:])
+        elif cmd[0] == "commit":
+            if cmd[1:3] in begun:
+                pending.append(cmd[1:])
+        
         if len(bulk_write_cmd) > 500:
             to_collection.bulk_write(bulk_write_cmd, ordered=False)
             bulk_write_cmd = []
         
+        if pending:
+            if write_mode == "insert":
+                # the documents of a chunk are written once both directions are past its latest timestamp
+                ready = [p for p in pending if p[2] < writer.closed_until]
+                if ready:
+                    writer.write_closed()
+                    writer.write_late()
+            else:
+                ready = pending
+                if bulk_write_cmd:
+                    to_collection.bulk_write(bulk_write_cmd, ordered=False)
+                    bulk_write_cmd = []
+            for direction, chunk, _ in ready:
+                manifest.commit_chunk(direction, chunk)
+                begun.discard((direction, chunk))
+            pending = [p for p in pending if p not in ready]
         
     if len(bulk_write_cmd) > 0:
         to_collection.bulk_write(bulk_write_cmd, ordered=False)
+        
+    # upsert what is still open, a restarted batch_write merges the rest into them
+    if write_mode == "insert":
+        writer.flush()
+    for direction, chunk, _ in pending:
+        manifest.commit_chunk(direction, chunk)
     
     return
 
@@ -5,12 +5,16 @@ Created on Thu Jun 23, 2022
 """
 
 import multiprocessing
-import pandas as pd
 import pymongo
 import math
 import json
 import queue
 
+from .resample import resample_batch
+from .transport import pack_trajectories, flush_channel
+from .connections import get_client
+from .change_stream_reader import RESUME_TOKEN
+
 
 def round_and_truncate(number, digits) -> float:
     '''
@@ -32,66 +36,103 @@ def resample(car, MODE):
     leave nans for missing data
     :param car: car document from MongoDB, containing field 'timestamp', 'x_position', 'y_position'
     '''
+    return resample_cars([car], MODE)[0]
+
 
+def resample_cars(cars, MODE):
+    '''
+    resample a list of car documents to 25Hz in a single vectorized pass (see resample.resample_batch)
+    time-series are binned on the 0.04s grid, averaged and linearly interpolated
+    :param cars: list of car documents from MongoDB, containing field 'timestamp', 'x_position', 'y_position'
+    '''
     # Select time series only
     if MODE.value == "RAW":
-        try:
-            time_series_field = ["timestamp", "x_position", "y_position", "length", "width", "height"]
-            data = {key: car[key] for key in time_series_field}
-
-            # Read to dataframe and resample
-            df = pd.DataFrame(data, columns=data.keys()) 
-            index = pd.to_timedelta(df["timestamp"], unit='s')
-            df = df.set_index(index)
-            df = df.drop(columns = "timestamp")
-            # df = df.resample('0.04s').mean() # close to 25Hz
-            df=df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq()
-            df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-            df = df.interpolate(method='linear')
-
-            car['x_position'] = df['x_position'].values
-            car['y_position'] = df['y_position'].values
-            car['length'] = df['length'].values
-            car['width'] = df['width'].values
-            car['height'] = df['height'].values
-            car['timestamp'] = df.index.values
-        except Exception as e:
-            print("error resampling: {}".format(e))
-        return car
-
+        time_series_field = ["x_position", "y_position", "length", "width", "height"]
     elif MODE.value == "RECONCILED":
-        try:
-            time_series_field = ["timestamp", "x_position", "y_position"]
-            data = {key: car[key] for key in time_series_field}
-
-            # Read to dataframe and resample
-            df = pd.DataFrame(data, columns=data.keys()) 
-            index = pd.to_timedelta(df["timestamp"], unit='s')
-            df = df.set_index(index)
-            df = df.drop(columns = "timestamp")
-            # df = df.resample('0.04s').mean() # close to 25Hz
-            df=df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq()
-            df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
-            df = df.interpolate(method='linear')
-
-            car['x_position'] = df['x_position'].values
-            car['y_position'] = df['y_position'].values
-            car['timestamp'] = df.index.values
-        except Exception as e:
-            print("error resampling: {}".format(e))
-        return car
+        time_series_field = ["x_position", "y_position"]
+    else:
+        raise Exception("Unable to determine whether data is RAW or RECONCILED trajectories. Aborting program")
     
+    try:
+        _resample_in_place(cars, time_series_field)
+    except Exception:
+        # a malformed trajectory fails the whole batch, resample one by one so that only it is left as is
+        for car in cars:
+            try:
+                _resample_in_place([car], time_series_field)
+            except Exception as e:
+                print("error resampling {}: {}".format(car.get("_id"), e))
+    return cars
+
+
+def _resample_in_place(cars, time_series_field):
+    t, data, offsets = resample_batch([car["timestamp"] for car in cars],
+                                      {key: [car[key] for car in cars] for key in time_series_field},
+                                      interpolate=True, origin="epoch")
+    for i, car in enumerate(cars):
+        lo, hi = offsets[i], offsets[i+1]
+        for key in time_series_field:
+            car[key] = data[key][lo:hi]
+        car['timestamp'] = t[lo:hi]
+
+
+def transform_trajectory(MODE, traj):
+    """
+    Accepts MODE and trajectory document as parameters
+    Returns a dictionary of timestamps with the following schema: 
+        If MODE is RAW:
+            {
+                time : [config_id, vehicle_ObjectID, (x, y), (l, w, h)],
+                time : [config_id, vehicle_ObjectID, (x, y), (l, w, h)],
+                ...
+            }
+        If MODE is RECONCILED:
+            {
+                time : [config_id, vehicle_ObjectID, (x, y)],
+                time : [config_id, vehicle_ObjectID, (x, y)],
+                ...
+            }
+    """
+    vehicle_id = traj["_id"]
+    configuration_id = traj["configuration_id"]
+    batch_operations = {}
+    if MODE.value == "RAW":
+        # transform raw data
+        for i in range(len(traj["timestamp"])):
+            time = round_and_truncate(traj["timestamp"][i], 5)
+            # print(len(traj["timestamp"]), len(traj["x_position"]), len(traj["y_position"]), len(traj["length"]), len(traj["width"]), len(traj["height"]))
+            x = traj["x_position"][i]
+            y = traj["y_position"][i]
+            l = traj["length"][i]
+            w = traj["width"][i]
+            h = traj["height"][i]
+            batch_operations[time] = [configuration_id, vehicle_id, (x, y), (l, w, h)]
+    elif MODE.value == "RECONCILED":
+        # transform reconciled data
+        for i in range(len(traj["timestamp"])):
+            time = round_and_truncate(traj["timestamp"][i], 5)
+            x = traj["x_position"][i]
+            y = traj["y_position"][i]
+            batch_operations[time] = [configuration_id, vehicle_id, (x, y)]
     else:
         raise Exception("Unable to determine whether data is RAW or RECONCILED trajectories. Aborting program")
+    
+    return batch_operations
 
 
 class Transformation:
     
-    def __init__(self, config, is_collection_dynamic, sample_rate = 25):
+    def __init__(self, config, is_collection_dynamic, sample_rate = 25, resample_batch_size = 1000):
         self._is_collection_dynamic = is_collection_dynamic
         # sample rate per second (must be a positive factor of 30)
         self.SAMPLE_RATE = sample_rate
         self.config = config
+        # number of trajectories resampled together in one vectorized pass (static collection only)
+        self.resample_batch_size = resample_batch_size
+        # see transport.TRANSPORTS
+        self.transport = config.get("transport", "queue")
+        # dynamic collection: keep listening until a None arrives instead of exiting after 3 sec without documents
+        self.streaming = config.get("streaming", False)
     
     def read_static_collection(self, num_of_docs = None):
         client=None
@@ -104,20 +145,17 @@ class Transformation:
         database=config_params['read_database_name']
         collection=config_params['read_collection_name']
 
-        client=pymongo.MongoClient(host=client_host,
-            port=client_port,
-            username=client_username,
-            password=client_password,
-            connect=True,
-            connectTimeoutMS=5000)
+        client=get_client(host=client_host, port=client_port, username=client_username, password=client_password)
 
         _database=client[database]
         _collection=_database[collection]
 
+        # resumed job: the timestamps before resume_from are written already
+        query = {"last_timestamp": {"$gte": config_params["resume_from"]}} if config_params.get("resume_from") is not None else {}
         if num_of_docs:
-            cursor= _collection.find({},{"_id":1,"timestamp":1,"x_position":1,"y_position":1, "configuration_id":1,"length":1,"width":1,"height":1}).sort([("first_timestamp",pymongo.ASCENDING),("last_timestamp",pymongo.ASCENDING)]).limit(num_of_docs)
+            cursor= _collection.find(query,{"_id":1,"timestamp":1,"x_position":1,"y_position":1, "configuration_id":1,"length":1,"width":1,"height":1}).sort([("first_timestamp",pymongo.ASCENDING),("last_timestamp",pymongo.ASCENDING)]).limit(num_of_docs)
         else:
-            cursor= _collection.find({},{"_id":1,"timestamp":1,"x_position":1,"y_position":1,"configuration_id":1,"length":1,"width":1,"height":1}).sort([("first_timestamp",pymongo.ASCENDING),("last_timestamp",pymongo.ASCENDING)])
+            cursor= _collection.find(query,{"_id":1,"timestamp":1,"x_position":1,"y_position":1,"configuration_id":1,"length":1,"width":1,"height":1}).sort([("first_timestamp",pymongo.ASCENDING),("last_timestamp",pymongo.ASCENDING)])
         
         return cursor
 
@@ -135,51 +173,29 @@ class Transformation:
         
     def transform_trajectory(self, MODE, traj):
         """
-        Accepts MODE and trajectory document as parameters
-        Returns a dictionary of timestamps with the following schema: 
-            If MODE is RAW:
-                {
-                    time : [config_id, vehicle_ObjectID, (x, y), (l, w, h)],
-                    time : [config_id, vehicle_ObjectID, (x, y), (l, w, h)],
-                    ...
-                }
-            If MODE is RECONCILED:
-                {
-                    time : [config_id, vehicle_ObjectID, (x, y)],
-                    time : [config_id, vehicle_ObjectID, (x, y)],
-                    ...
-                }
+        see transform_trajectory
         """
-        vehicle_id = traj["_id"]
-        configuration_id = traj["configuration_id"]
-        batch_operations = {}
-        if MODE.value == "RAW":
-            # transform raw data
-            for i in range(len(traj["timestamp"])):
-                time = round_and_truncate(traj["timestamp"][i], 5)
-                # print(len(traj["timestamp"]), len(traj["x_position"]), len(traj["y_position"]), len(traj["length"]), len(traj["width"]), len(traj["height"]))
-                x = traj["x_position"][i]
-                y = traj["y_position"][i]
-                l = traj["length"][i]
-                w = traj["width"][i]
-                h = traj["height"][i]
-                batch_operations[time] = [configuration_id, vehicle_id, (x, y), (l, w, h)]
-        elif MODE.value == "RECONCILED":
-            # transform reconciled data
-            for i in range(len(traj["timestamp"])):
-                time = round_and_truncate(traj["timestamp"][i], 5)
-                x = traj["x_position"][i]
-                y = traj["y_position"][i]
-                batch_operations[time] = [configuration_id, vehicle_id, (x, y)]
-        else:
-            raise Exception("Unable to determine whether data is RAW or RECONCILED trajectories. Aborting program")
-        
-        return batch_operations
+        return transform_trajectory(MODE, traj)
+
+    def transform_batch(self, MODE, trajs, batch_update_connection):
+        """
+        Resample a list of trajectories together and send the transformed dictionaries to batch_update one by one
+        If transport is "chunked" or "shared_memory", send the resampled arrays as a single columnar payload instead,
+        and batch_update transforms them on its side (see transport.pack_trajectories)
+        """
+        trajs = resample_cars(trajs, MODE)
+        if self.transport != "queue":
+            fields = ["x_position", "y_position", "length", "width", "height"] if MODE.value == "RAW" else ["x_position", "y_position"]
+            batch_update_connection.put(pack_trajectories(trajs, fields))
+            return
+        for traj in trajs:
+            batch_operations = self.transform_trajectory(MODE, traj)
+            batch_update_connection.put(batch_operations)
 
     def main_loop(self, MODE, change_stream_connection: multiprocessing.Queue, batch_update_connection: multiprocessing.Queue):
         """
         A child process for transformation. 
-        1. Listens to change_stream_connection for trajectory documents. 
+        1. Listens to change_stream_connection for trajectory documents, or lists of them. 
         2. Transforms the received trajectory into a dictionary of timestamps: 
             If MODE is RAW:
                 {
@@ -199,33 +215,45 @@ class Transformation:
             # Transformer is called from run_dynamic_transformer.py
             # ... collection is dynmaic, so we need to listen to the change stream
             
+            # change_stream_reader sends lists of documents (listen_batches) or single documents (listen_stream),
+            # and resume tokens, which go on to batch_update after the batch they follow
             # get first doc to determine MODE
-            first_doc = change_stream_connection.get()
-            MODE.value = self.determine_mode(first_doc)
-            batch_operations = self.transform_trajectory(MODE, resample(first_doc, MODE))
-            batch_update_connection.put(batch_operations)
-
-            while True:
+            item = change_stream_connection.get()
+            while item is not None:
+                batch = item if isinstance(item, list) else [item]
+                if isinstance(item, dict) and item.get("kind") == RESUME_TOKEN:
+                    batch_update_connection.put(item)
+                elif batch:
+                    if MODE.value == "":
+                        MODE.value = self.determine_mode(batch[0])
+                    self.transform_batch(MODE, batch, batch_update_connection)
                 try:
-                    traj_doc = change_stream_connection.get(timeout=3)
+                    item = change_stream_connection.get(timeout=None if self.streaming else 3)
                 except queue.Empty:
                     print("transformed all")
                     break
-                # print("[transformation] received doc")
-                batch_operations = self.transform_trajectory(MODE, resample(traj_doc, MODE))
-                batch_update_connection.put(batch_operations)
+            # end of stream (or nothing arrived for 3 sec), pass it on to batch_update
+            batch_update_connection.put(None)
+            flush_channel(batch_update_connection)
         else:
             # Transformer is called from run_static_transformer.py
             # ... collection is static, so we can just read the collection
+            # ... resample [resample_batch_size] documents at a time
             traj_doc = self.read_static_collection()
+            batch = []
             for doc in traj_doc:
                 if MODE.value == "":
                     MODE.value = self.determine_mode(doc)
                     # print('mode in transformation: '+MODE.value)
                 # print("inserting doc: {}".format(doc["_id"]))
-                batch_operations = self.transform_trajectory(MODE, resample(doc, MODE))
-                batch_update_connection.put(batch_operations)
+                batch.append(doc)
+                if len(batch) >= self.resample_batch_size:
+                    self.transform_batch(MODE, batch, batch_update_connection)
+                    batch = []
+            if batch:
+                self.transform_batch(MODE, batch, batch_update_connection)
                 # print('put into batch_update')
+            flush_channel(batch_update_connection)
 
 def run(config, MODE, change_stream_connection, batch_update_connection):
     if change_stream_connection == None:
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched, columnar inter-process transport for the transform pipelines.
+Producers send numpy arrays of timestamps, ids and feature rows in large batches instead of one pymongo operation
+or one dictionary per put, and the writer rebuilds the MongoDB documents on its side.
+
+transport kinds:
+    "queue": one item per put (legacy)
+    "chunked": columnar batches over a multiprocessing.Queue
+    "shared_memory": columnar batches, numpy arrays are copied through a ring of shared memory slots and only
+        a small header goes through the queue (python>=3.8)
+
+Channels are bounded (see BoundedChannel), so that a producer that is faster than the writer does not fill
+the memory: it either waits ("block" backpressure) or spills to disk ("spill").
+"""
+
+import multiprocessing
+import pickle
+import os
+import queue
+import tempfile
+import threading
+import numpy as np
+
+TRANSPORTS = ["queue", "chunked", "shared_memory"]
+BACKPRESSURE = ["block", "spill"]
+
+# default maximum number of items in a channel: single operations for "queue", batches of ~5000 rows otherwise
+DEFAULT_MAX_SIZE = {"queue": 10000, "chunked": 64, "shared_memory": 64}
+
+HIGH_WATER_SAMPLE = 16 # the size of the channel is sampled every this many puts, and on every put that waits or spills
+
+
+def make_transport(kind, manager=None, maxsize=None, backpressure="block", spill_dir=None):
+    '''
+    Create the queue-like channel between producer and writer processes for a transport kind
+    every channel supports put(item), get(timeout) (raises queue.Empty), empty() and flush(), see BoundedChannel
+    :param manager: multiprocessing.Manager, if specified the "queue" transport is a manager queue
+    :param maxsize: maximum number of items in the channel, defaults to DEFAULT_MAX_SIZE[kind], 0 for no limit
+    :param backpressure: "block" or "spill", see BoundedChannel
+    :param spill_dir: directory of the spill files, defaults to the system temporary directory
+    '''
+    if backpressure not in BACKPRESSURE:
+        raise ValueError("Invalid backpressure. Use one of {}".format(BACKPRESSURE))
+    if maxsize is None:
+        maxsize = DEFAULT_MAX_SIZE.get(kind, 0)
+    if kind == "queue":
+        channel = manager.Queue(maxsize) if manager is not None else multiprocessing.Queue(maxsize)
+    elif kind == "chunked":
+        channel = multiprocessing.Queue(maxsize)
+    elif kind == "shared_memory":
+        channel = SharedMemoryRing(maxsize=maxsize)
+    else:
+        raise ValueError("Invalid transport. Use one of {}".format(TRANSPORTS))
+    return BoundedChannel(channel, maxsize, backpressure, spill_dir)
+
+
+def flush_channel(channel):
+    '''
+    flush() a BoundedChannel, other queues have nothing to flush
+    '''
+    flush = getattr(channel, "flush", None)
+    if flush is not None:
+        flush()
+
+
+class SpillFile:
+    """
+    FIFO of pickled items in an anonymous temporary file, private to the process that created it
+    """
+    def __init__(self, spill_dir=None):
+        self._file = tempfile.TemporaryFile(dir=spill_dir)
+        self._read_pos = 0
+        self._count = 0
+
+    def append(self, item):
+        self._file.seek(0, os.SEEK_END)
+        pickle.dump(item, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._count += 1
+
+    def drain(self, put):
+        '''
+        put(item) the items in order until put raises queue.Full
+        :returns: True if the file is empty
+        '''
+        while self._count:
+            self._file.seek(self._read_pos)
+            item = pickle.load(self._file)
+            try:
+                put(item)
+            except queue.Full:
+                return False
+            self._read_pos = self._file.tell()
+            self._count -= 1
+        self._file.seek(0)
+        self._file.truncate()
+        self._read_pos = 0
+        return True
+
+    def __len__(self):
+        return self._count
+
+
+class BoundedChannel:
+    """
+    A channel of at most maxsize items, with backpressure on the producers when it is full:
+        "block": put() waits until the writer made room, which holds back the producer
+        "spill": put() does not wait, items that do not fit are appended to a spill file of the producer process
+            and sent, in order, as soon as the channel has room. Every producer (process or thread) has its own spill
+            file, and has to flush() when it is done.
+            Memory use is bounded as with "block", and the producer runs ahead at the cost of disk space.
+    high_water_mark and num_spilled are shared by every process that uses the channel, for the parent to report.
+    """
+    def __init__(self, channel, maxsize=0, backpressure="block", spill_dir=None):
+        self.channel = channel
+        self.maxsize = maxsize
+        self.backpressure = backpressure
+        self.spill_dir = spill_dir
+        self.high_water_mark = multiprocessing.Value("i", 0)
+        self.num_spilled = multiprocessing.Value("i", 0)
+        self._spills = {} # key: (pid, thread id), val: SpillFile
+        self._num_puts = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_spills"] = {} # spill files belong to the producer that wrote them
+        return state
+
+    def _producer(self):
+        return os.getpid(), threading.get_ident()
+
+    def _spill_file(self):
+        try:
+            return self._spills[self._producer()]
+        except KeyError:
+            spill = self._spills[self._producer()] = SpillFile(self.spill_dir)
+            return spill
+
+    def _put_nowait(self, item):
+        self.channel.put(item, False)
+
+    def put(self, item, block=True, timeout=None):
+        if self.backpressure == "spill" and block:
+            spill = self._spill_file()
+            if spill.drain(self._put_nowait):
+                try:
+                    self._put_nowait(item)
+                    self._sample(waited=False)
+                    return
+                except queue.Full:
+                    pass
+            spill.append(item)
+            with self.num_spilled.get_lock():
+                self.num_spilled.value += 1
+            self._sample(waited=True)
+            return
+        try:
+            self.channel.put(item, False)
+            waited = False
+        except queue.Full:
+            if not block:
+                raise
+            self.channel.put(item, True, timeout)
+            waited = True
+        self._sample(waited)
+
+    def flush(self):
+        '''
+        Send what this producer spilled, waiting for room in the channel
+        '''
+        spill = self._spills.get(self._producer())
+        if spill is not None:
+            spill.drain(self.channel.put)
+
+    def _sample(self, waited):
+        self._num_puts += 1
+        if not waited and self._num_puts % HIGH_WATER_SAMPLE:
+            return
+        try:
+            size = self.channel.qsize()
+        except NotImplementedError: # macOS
+            return
+        if size > self.high_water_mark.value:
+            with self.high_water_mark.get_lock():
+                self.high_water_mark.value = max(self.high_water_mark.value, size)
+
+    def get(self, block=True, timeout=None):
+        return self.channel.get(block, timeout)
+
+    def empty(self):
+        return self.channel.empty()
+
+    def qsize(self):
+        return self.channel.qsize()
+
+    def close(self):
+        if hasattr(self.channel, "close"):
+            self.channel.close()
+
+    def stats(self):
+        return "high water mark {} of {} items, {} spilled".format(self.high_water_mark.value, self.maxsize or "unlimited",
+                                                                   self.num_spilled.value)
+
+
+def _categorical(values):
+    '''
+    encode a list of repeated values (e.g., vehicle class, compute node) to int codes and a list of categories
+    '''
+    lookup = {}
+    codes = np.fromiter((lookup.setdefault(val, len(lookup)) for val in values), dtype=np.int32, count=len(values))
+    return codes, list(lookup)
+
+
+class TimestampBatcher:
+    """
+    Producer side of transform2: accumulates the (timestamp, {str(id): row}) pieces of one direction,
+    and puts them to the channel as a single columnar payload every batch_size rows
+    payload:
+        {
+            "kind": "timestamps",
+            "direction": "eb" or "wb",
+            "dir": 1 or -1,
+            "timestamp": float64 array, one per piece,
+            "offsets": int64 array, rows of piece i are [offsets[i], offsets[i+1]),
+            "id": str array, one per row,
+            "features": float64 array of [centerx, centery, l, w, v, a], one per row,
+            "cls", "node": int32 codes, one per row, and "cls_categories", "node_categories"
+        }
+    """
+    def __init__(self, channel, direction, batch_size=5000):
+        self.channel = channel
+        self.direction = direction
+        self.batch_size = batch_size
+        self._reset()
+
+    def _reset(self):
+        self._timestamp = []
+        self._offsets = [0]
+        self._id = []
+        self._features = []
+        self._cls = []
+        self._node = []
+
+    def add(self, timestamp, subdoc):
+        for _id, row in subdoc.items():
+            self._id.append(_id)
+            self._features.append(row[:4] + row[5:7])
+            self._cls.append(row[7])
+            self._node.append(row[8])
+        self._timestamp.append(timestamp)
+        self._offsets.append(len(self._id))
+        if len(self._id) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._timestamp:
+            return
+        cls, cls_categories = _categorical(self._cls)
+        node, node_categories = _categorical(self._node)
+        self.channel.put({
+            "kind": "timestamps",
+            "direction": self.direction,
+            "dir": 1 if self.direction == "eb" else -1,
+            "timestamp": np.array(self._timestamp, dtype=np.float64),
+            "offsets": np.array(self._offsets, dtype=np.int64),
+            "id": np.array(self._id, dtype=str),
+            "features": np.array(self._features, dtype=np.float64).reshape(-1, 6),
+            "cls": cls, "cls_categories": cls_categories,
+            "node": node, "node_categories": node_categories,
+            })
+        self._reset()
+
+
+def iter_timestamps(payload):
+    '''
+    Writer side of TimestampBatcher: yields (direction, timestamp, {str(id): [centerx, centery, l, w, dir, v, a, cls, node]})
+    '''
+    direction, dir = payload["direction"], payload["dir"]
+    ids = payload["id"].tolist()
+    features = payload["features"].tolist()
+    cls = [payload["cls_categories"][c] for c in payload["cls"].tolist()]
+    node = [payload["node_categories"][c] for c in payload["node"].tolist()]
+    offsets = payload["offsets"].tolist()
+    for i, t in enumerate(payload["timestamp"].tolist()):
+        subdoc = {}
+        for j in range(offsets[i], offsets[i+1]):
+            f = features[j]
+            subdoc[ids[j]] = f[:4] + [dir] + f[4:] + [cls[j], node[j]]
+        yield direction, t, subdoc
+
+
+def pack_trajectories(trajs, fields):
+    '''
+    Producer side of DBClient.transform: pack resampled trajectory documents into one columnar payload
+    :param fields: the time-series fields to pack, besides timestamp
+    payload:
+        {
+            "kind": "trajectories",
+            "_id", "configuration_id": lists, one per trajectory,
+            "offsets": int64 array, samples of trajectory i are [offsets[i], offsets[i+1]),
+            "timestamp" and each field: flat float64 arrays
+        }
+    '''
+    lengths = [len(traj["timestamp"]) for traj in trajs]
+    payload = {
+        "kind": "trajectories",
+        "_id": [traj["_id"] for traj in trajs],
+        "configuration_id": [traj["configuration_id"] for traj in trajs],
+        "offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        }
+    for key in ["timestamp"] + fields:
+        payload[key] = np.concatenate([np.asarray(traj[key], dtype=np.float64) for traj in trajs]) if trajs else np.empty(0)
+    return payload
+
+
+def unpack_trajectories(payload):
+    '''
+    Writer side of pack_trajectories: yields trajectory documents with the packed fields as numpy arrays
+    '''
+    fields = [key for key, val in payload.items() if isinstance(val, np.ndarray) and key != "offsets"]
+    offsets = payload["offsets"]
+    for i, (_id, configuration_id) in enumerate(zip(payload["_id"], payload["configuration_id"])):
+        lo, hi = offsets[i], offsets[i+1]
+        traj = {"_id": _id, "configuration_id": configuration_id}
+        for key in fields:
+            traj[key] = payload[key][lo:hi]
+        yield traj
+
+
+class SharedMemoryRing:
+    """
+    A channel that moves the numpy arrays of a payload through a ring of shared memory slots.
+    put() copies the arrays into a free slot and sends only a small header (slot, dtypes, shapes and the non-array
+    items) through a queue. get() copies the arrays out and hands the slot back. When all slots are in use put() blocks,
+    which holds back the producers. Items that are not dicts, or do not fit in a slot, go through the queue as they are.
+    """
+    def __init__(self, num_slots=8, slot_size=16*2**20, maxsize=0):
+        '''
+        :param maxsize: maximum number of items (in slots or inline) waiting in the ring, 0 for no limit
+        '''
+        from multiprocessing import shared_memory
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self._shm = shared_memory.SharedMemory(create=True, size=num_slots*slot_size)
+        self._free = multiprocessing.Queue()
+        self._ready = multiprocessing.Queue(maxsize)
+        for slot in range(num_slots):
+            self._free.put(slot)
+
+    def put(self, item, block=True, timeout=None):
+        if not isinstance(item, dict):
+            self._ready.put(("inline", item), block, timeout)
+            return
+        arrays = {key: np.ascontiguousarray(val) for key, val in item.items() if isinstance(val, np.ndarray)}
+        if sum(arr.nbytes for arr in arrays.values()) > self.slot_size:
+            self._ready.put(("inline", item), block, timeout)
+            return
+
+        try:
+            slot = self._free.get(block, timeout)
+        except queue.Empty:
+            raise queue.Full
+        base = slot * self.slot_size
+        layout = {}
+        for key, arr in arrays.items():
+            self._shm.buf[base:base+arr.nbytes] = arr.view(np.uint8).reshape(-1)
+            layout[key] = (base, arr.dtype.str, arr.shape)
+            base += arr.nbytes
+        header = {key: val for key, val in item.items() if key not in arrays}
+        try:
+            self._ready.put(("slot", slot, layout, header), block, timeout)
+        except queue.Full:
+            self._free.put(slot)
+            raise
+
+    def get(self, block=True, timeout=None):
+        msg = self._ready.get(block, timeout)
+        if msg[0] == "inline":
+            return msg[1]
+        _, slot, layout, item = msg
+        for key, (offset, dtype, shape) in layout.items():
+            count = int(np.prod(shape))
+            item[key] = np.frombuffer(self._shm.buf, dtype=dtype, count=count, offset=offset).reshape(shape).copy()
+        self._free.put(slot)
+        return item
+
+    def empty(self):
+        return self._ready.empty()
+
+    def qsize(self):
+        return self._ready.qsize()
+
+    def close(self):
+        '''
+        Release the shared memory, called by the process that created the ring once every process is done
+        '''
+        self._shm.close()
+        self._shm.unlink()
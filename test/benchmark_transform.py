@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the python and the aggregate engine of DBClient.transform on a RECONCILED collection:
+wall time of each, and whether they produce the same timestamp documents.
+Requires a MongoDB >= 4.2 instance, see config/db_param1.json
+usage: python benchmark_transform.py [database_name] [collection_name]
+"""
+from src.i24_database_api import DBClient
+import json
+import sys
+import time
+
+
+def summarize(collection):
+    '''
+    {timestamp: {id: (x, y)}} of a transformed collection, the order of id within a timestamp is not defined
+    '''
+    return {doc["timestamp"]: {str(i): tuple(round(v, 6) for v in pos) for i, pos in zip(doc["id"], doc["position"])}
+            for doc in collection.find({}, {"_id": 0, "timestamp": 1, "id": 1, "position": 1})}
+
+
+if __name__ == '__main__':
+    with open("config/db_param1.json") as f:
+        parameters = json.load(f)
+    if len(sys.argv) > 2:
+        parameters["database_name"], parameters["collection_name"] = sys.argv[1], sys.argv[2]
+
+    dbc = DBClient(**parameters)
+    print("collection: {}, number of trajectories: {}".format(dbc.collection_name, dbc.count()))
+
+    results = {}
+    for engine in ["python", "aggregate"]:
+        write_collection_name = "{}_{}".format(dbc.collection_name, engine)
+        t0 = time.time()
+        dbc.transform(write_database_name="transformed", write_collection_name=write_collection_name, engine=engine)
+        elapsed = time.time() - t0
+        results[engine] = summarize(dbc.client["transformed"][write_collection_name])
+        print("{:>10}: {:.2f} sec, {} timestamps".format(engine, elapsed, len(results[engine])))
+
+    print("same result: ", results["python"] == results["aggregate"])
+    for engine in ["python", "aggregate"]:
+        dbc.client["transformed"].drop_collection("{}_{}".format(dbc.collection_name, engine))
@@ -0,0 +1,193 @@
+from src.i24_database_api.aggregation import reconciled_pipeline, transform_aggregate
+from src.i24_database_api.resample import resample_batch
+from test_resample import make_traj
+from test_batch_update import FakeJobs
+from unittest import mock
+import numpy as np
+import math
+import unittest
+
+
+def get_path(doc, path):
+    for key in path.split("."):
+        doc = doc[key]
+    return doc
+
+
+def evaluate(expr, doc, variables):
+    '''
+    evaluate the aggregation expressions used by reconciled_pipeline on doc
+    '''
+    if isinstance(expr, str) and expr.startswith("$$"):
+        name, _, path = expr[2:].partition(".")
+        return get_path(variables[name], path) if path else variables[name]
+    if isinstance(expr, str) and expr.startswith("$"):
+        return get_path(doc, expr[1:])
+    if isinstance(expr, list):
+        return [evaluate(e, doc, variables) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) != 1 or not next(iter(expr)).startswith("$"):
+        return {key: evaluate(val, doc, variables) for key, val in expr.items()}
+
+    (op, arg), = expr.items()
+    if op == "$let":
+        inner = dict(variables, **{k: evaluate(v, doc, variables) for k, v in arg["vars"].items()})
+        return evaluate(arg["in"], doc, inner)
+    if op in ("$filter", "$map"):
+        items = evaluate(arg["input"], doc, variables)
+        if op == "$map":
+            return [evaluate(arg["in"], doc, dict(variables, this=item)) for item in items]
+        return [item for item in items if evaluate(arg["cond"], doc, dict(variables, this=item))]
+    if op == "$zip":
+        return [list(items) for items in zip(*evaluate(arg["inputs"], doc, variables))]
+    args = evaluate(arg, doc, variables)
+    if op == "$trunc":
+        return float(math.trunc(args))
+    if op == "$toLong":
+        return int(args)
+    if op == "$round":
+        return round(args[0], args[1])
+    if op == "$add":
+        return sum(args)
+    if op == "$subtract":
+        return args[0] - args[1]
+    if op == "$multiply":
+        return math.prod(args)
+    if op == "$mod":
+        return args[0] % args[1]
+    if op == "$arrayElemAt":
+        return args[0][args[1]]
+    if op == "$in":
+        return args[0] in args[1]
+    if op == "$not":
+        return not args[0]
+    if op == "$concatArrays":
+        return [item for array in args for item in array]
+    raise NotImplementedError(op)
+
+
+def run_pipeline(pipeline, docs, target):
+    '''
+    run reconciled_pipeline on docs in python, merging into target {timestamp: doc}
+    '''
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            field, bounds = next(iter(spec.items()))
+            docs = [doc for doc in docs if bounds["$gte"] <= doc[field] < bounds["$lt"]]
+        elif name == "$project":
+            projected = []
+            for doc in docs:
+                out = {} if spec.get("_id") == 0 else {"_id": doc["_id"]}
+                for key, val in spec.items():
+                    if key != "_id":
+                        out[key] = doc[key] if val == 1 else evaluate(val, doc, {})
+                projected.append(out)
+            docs = projected
+        elif name == "$unwind":
+            field = spec[1:]
+            docs = [dict(doc, **{field: item}) for doc in docs for item in doc[field]]
+        elif name == "$group":
+            groups = {}
+            for doc in docs:
+                key = evaluate(spec["_id"], doc, {})
+                group = groups.setdefault(repr(key), {"_id": key})
+                for field, acc in spec.items():
+                    if field == "_id":
+                        continue
+                    (op, expr), = acc.items()
+                    val = evaluate(expr, doc, {})
+                    if op == "$first":
+                        group.setdefault(field, val)
+                    else: # $avg and $push collect
+                        group.setdefault(field, []).append(val)
+            for group in groups.values():
+                for field, acc in spec.items():
+                    if "$avg" in acc:
+                        group[field] = sum(group[field]) / len(group[field])
+            docs = list(groups.values())
+        elif name == "$merge":
+            for doc in docs:
+                existing = target.get(doc["timestamp"])
+                if existing is None:
+                    target[doc["timestamp"]] = doc
+                    continue
+                for update in spec["whenMatched"]:
+                    (op, fields), = update.items()
+                    if op == "$set":
+                        existing.update({key: evaluate(val, existing, {"new": doc}) for key, val in fields.items()})
+                    else: # $unset
+                        existing.pop(fields)
+    return target
+
+
+class AggregateParityTest(unittest.TestCase):
+
+    def make_trajs(self, rng, num):
+        trajs = []
+        for i in range(num):
+            traj = make_traj(rng, 1.668e9 + rng.uniform(0, 10), int(rng.integers(20, 200)), gap=(i % 3 == 0))
+            traj.update(_id="traj{}".format(i), first_timestamp=traj["timestamp"][0], configuration_id=1)
+            trajs.append(traj)
+        return trajs
+
+    def test_parity_with_resample_batch(self):
+        '''
+        the pipeline gives the non-empty bins of resample_batch(interpolate=False), i.e., the python engine
+        without interpolation
+        '''
+        rng = np.random.default_rng(0)
+        trajs = self.make_trajs(rng, 12)
+        target = {}
+        for s in [1.668e9, 1.668e9+5]:
+            run_pipeline(reconciled_pipeline(s, s+5, "db", "col"), trajs, target)
+
+        t, data, offsets = resample_batch([traj["timestamp"] for traj in trajs],
+                                          {key: [traj[key] for traj in trajs] for key in ["x_position", "y_position"]},
+                                          interpolate=False, origin="epoch")
+        expected = {}
+        for i, traj in enumerate(trajs):
+            for j in range(offsets[i], offsets[i+1]):
+                if not np.isnan(data["x_position"][j]):
+                    expected[(round(t[j], 2), traj["_id"])] = (data["x_position"][j], data["y_position"][j])
+
+        result = {(doc["timestamp"], _id): tuple(pos) for doc in target.values()
+                  for _id, pos in zip(doc["id"], doc["position"])}
+        self.assertEqual(sorted(result), sorted(expected))
+        for key, pos in expected.items():
+            np.testing.assert_allclose(result[key], pos, rtol=1e-12)
+
+    def test_merge_again(self):
+        '''
+        a range that is merged twice (resumed after a failure) does not repeat its vehicles
+        '''
+        rng = np.random.default_rng(1)
+        trajs = self.make_trajs(rng, 6)
+        pipeline = reconciled_pipeline(1.668e9, 1.668e9+10, "db", "col")
+        once = run_pipeline(pipeline, trajs, {})
+        twice = run_pipeline(pipeline, trajs, run_pipeline(pipeline, trajs, {}))
+        self.assertEqual(twice, once)
+
+
+class TransformAggregateTest(unittest.TestCase):
+
+    def test_resume(self):
+        from_collection, to_collection = mock.MagicMock(), mock.MagicMock()
+        from_collection.find_one.side_effect = [{"first_timestamp": 0.0}, {"first_timestamp": 150.0}]
+        from_collection.aggregate.side_effect = [None, RuntimeError("connection lost")]
+        client = {"raw": {"col": from_collection}, "transformed": {"col": to_collection, "__JOBS__": FakeJobs()}}
+        config = {"read_database_name": "raw", "read_collection_name": "col",
+                  "write_database_name": "transformed", "write_collection_name": "col"}
+        with self.assertRaises(RuntimeError):
+            transform_aggregate(client, config)
+
+        from_collection.aggregate.reset_mock(side_effect=True)
+        transform_aggregate(client, config)
+        to_collection.drop.assert_called_once() # kept on resume
+        ranges = [call.args[0][0]["$match"]["first_timestamp"]["$gte"] for call in from_collection.aggregate.call_args_list]
+        self.assertEqual(ranges, [60.0, 120.0]) # the range that failed and the rest
+
+
+if __name__ == '__main__':
+    unittest.main()
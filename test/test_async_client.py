@@ -0,0 +1,87 @@
+from src.i24_database_api import async_client
+from src.i24_database_api.async_client import AsyncDBClient
+from unittest import mock
+import asyncio
+import unittest
+
+COMPARE = {"$gt": lambda v, b: v > b, "$gte": lambda v, b: v >= b, "$lt": lambda v, b: v < b, "$lte": lambda v, b: v <= b}
+
+
+def matches(doc, query_filter):
+    return all(COMPARE[op](doc[field], bound) for field, condition in query_filter.items()
+               for op, bound in condition.items())
+
+
+class FakeCursor:
+    def __init__(self, collection, docs):
+        self.collection = collection
+        self.docs = docs
+
+    async def to_list(self, length):
+        self.collection.active += 1
+        self.collection.max_active = max(self.collection.max_active, self.collection.active)
+        await asyncio.sleep(0.01) # the server is working on it
+        self.collection.active -= 1
+        return self.docs
+
+
+class FakeAsyncCollection:
+    '''
+    motor collection of docs, counts the windows that are read at the same time
+    '''
+    def __init__(self, docs):
+        self.docs = docs
+        self.filters = []
+        self.active = 0
+        self.max_active = 0
+
+    def find(self, filter=None, **kwargs):
+        self.filters.append(filter)
+        return FakeCursor(self, [doc for doc in self.docs if matches(doc, filter)])
+
+    async def find_one(self, query_filter, projection=None, sort=None):
+        (field, direction), = sort
+        docs = sorted(self.docs, key=lambda doc: doc[field], reverse=direction < 0)
+        return docs[0] if docs else None
+
+
+def make_client(docs, **kwargs):
+    with mock.patch.object(async_client, "AsyncIOMotorClient", mock.MagicMock()):
+        dbc = AsyncDBClient(database_name="db", collection_name="col", **kwargs)
+    dbc.collection = FakeAsyncCollection(docs)
+    return dbc
+
+
+async def read_all(windows):
+    return [window async for window in windows]
+
+
+class AsyncDBClientTest(unittest.TestCase):
+
+    def test_window_iteration(self):
+        dbc = make_client([{"t": t} for t in range(25)])
+        windows = asyncio.run(read_all(dbc.read_query_range("t", range_greater_equal=0, range_less_than=25,
+                                                            range_increment=10)))
+        self.assertEqual([[doc["t"] for doc in window] for window in windows],
+                         [list(range(10)), list(range(10, 20)), list(range(20, 25))])
+
+    def test_last_window(self):
+        # bounds from the collection: the last window is closed at the largest value, and there is none after it
+        dbc = make_client([{"t": t} for t in range(21)])
+        windows = asyncio.run(read_all(dbc.read_query_range("t", range_increment=10)))
+        self.assertEqual([len(window) for window in windows], [10, 11])
+        self.assertEqual(dbc.collection.filters[-1], {"t": {"$gte": 10, "$lte": 20}})
+        self.assertEqual(asyncio.run(read_all(make_client([]).read_query_range("t", range_increment=10))), [])
+
+    def test_gather_range_concurrency(self):
+        dbc = make_client([{"t": t} for t in range(100)], max_concurrency=3)
+        windows = asyncio.run(dbc.gather_range("t", 10, range_greater_equal=0, range_less_than=100))
+        self.assertEqual([window[0]["t"] for window in windows], list(range(0, 100, 10))) # in range order
+        self.assertEqual(dbc.collection.max_active, 3)
+        dbc.collection.max_active = 0
+        asyncio.run(dbc.gather_range("t", 10, range_greater_equal=0, range_less_than=100, max_concurrency=1))
+        self.assertEqual(dbc.collection.max_active, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
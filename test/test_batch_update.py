@@ -0,0 +1,197 @@
+from src.i24_database_api.batch_update import BatchUpdate
+from src.i24_database_api.change_stream_reader import RESUME_TOKEN, FileTokenStore
+from src.i24_database_api import batch_update as batch_update_module
+from src.i24_database_api.job_manifest import JobManifest
+from pymongo.errors import BulkWriteError
+from types import SimpleNamespace
+from unittest import mock
+import os
+import queue
+import tempfile
+import unittest
+
+MODE = SimpleNamespace(value="RECONCILED")
+
+
+class FakeCollection:
+    '''
+    records the timestamps written, the ones in failing are not written
+    '''
+    def __init__(self, failing=()):
+        self.written = []
+        self.failing = failing
+
+    def bulk_write(self, requests, ordered=True):
+        timestamps = [request._filter["timestamp"] for request in requests]
+        self.written.extend(t for t in timestamps if t not in self.failing)
+        errors = [{"index": i, "code": 2, "errmsg": "failed"} for i, t in enumerate(timestamps) if t in self.failing]
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+    def insert_many(self, docs, ordered=True, bypass_document_validation=False):
+        self.written.extend(doc["timestamp"] for doc in docs)
+
+
+class FakeTokenStore:
+    def __init__(self, collection):
+        self.collection = collection
+        self.saved = [] # (token, timestamps written when it was saved)
+
+    def save(self, token, committed_until=None):
+        self.saved.append((token, sorted(self.collection.written)))
+
+
+def make_batch_update(config, **kwargs):
+    with mock.patch.object(BatchUpdate, "connect_to_db"):
+        batch_update = BatchUpdate(config, **kwargs)
+    batch_update._collection = FakeCollection()
+    return batch_update
+
+
+class FakeManifest:
+    def __init__(self):
+        self.committed = []
+
+    def commit_until(self, timestamp):
+        self.committed.append(timestamp)
+
+
+class FakeJobs:
+    '''
+    __JOBS__ collection, supports the operations of JobManifest
+    '''
+    def __init__(self):
+        self.docs = {}
+
+    def with_options(self, **kwargs):
+        return self
+
+    def __getitem__(self, name):
+        return self
+
+    def find_one(self, query_filter):
+        return self.docs.get(query_filter["_id"])
+
+    def replace_one(self, query_filter, doc, upsert=False):
+        self.docs[query_filter["_id"]] = doc
+
+    def update_one(self, query_filter, update):
+        doc = self.docs[query_filter["_id"]]
+        doc.update(update.get("$set", {}))
+        for key, val in update.get("$max", {}).items():
+            doc[key] = max(doc.get(key, val), val)
+        for key, val in update.get("$addToSet", {}).items():
+            field, direction = key.split(".")
+            chunks = doc[field].setdefault(direction, [])
+            if val not in chunks:
+                chunks.append(val)
+
+
+class StallingQueue:
+    '''
+    items in order, STALL stands for a get that times out, the producer being busy
+    '''
+    STALL = "stall"
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    def get(self, block=True, timeout=None):
+        item = self.items.pop(0)
+        if item == self.STALL:
+            if timeout is None: # a blocking get waits for the next item
+                return self.get()
+            raise queue.Empty
+        return item
+
+    def empty(self):
+        return not self.items or self.items[0] == self.STALL
+
+
+def pieces(timestamps, vehicle_id):
+    return {t: [1, vehicle_id, (0.0, 0.0)] for t in timestamps}
+
+
+class BatchUpdateTest(unittest.TestCase):
+
+    def test_token_saved_after_its_batch_is_written(self):
+        batch_update = make_batch_update({}, streaming=True, allowed_lateness=1)
+        store = batch_update.token_store = FakeTokenStore(batch_update._collection)
+        connection = queue.Queue()
+        for item in [pieces([10.0, 10.5], "a"), {"kind": RESUME_TOKEN, "token": 1},
+                     pieces([12.0, 12.2], "b"), {"kind": RESUME_TOKEN, "token": 2}, None]:
+            connection.put(item)
+        batch_update.main_loop(MODE, connection)
+        # token 1 waits until the timestamps of its batch are closed by the next one, token 2 until the end
+        self.assertEqual(store.saved, [(1, [10.0, 10.5]), (2, [10.0, 10.5, 12.0, 12.2])])
+
+    def test_restart_keeps_written_timestamps(self):
+        config = {"host": "", "port": 0, "username": "", "password": "", "write_database_name": "transformed",
+                  "write_collection_name": "test"}
+        with tempfile.TemporaryDirectory() as tmp:
+            store = FileTokenStore(os.path.join(tmp, "token.json"))
+            batch_update = make_batch_update({}, streaming=True, allowed_lateness=1, token_store=store)
+            connection = queue.Queue()
+            for item in [pieces([10.0, 10.5], "a"), {"kind": RESUME_TOKEN, "token": {"_data": 1}},
+                         pieces([12.0, 12.2], "b"), None]: # stopped before the token of b
+                connection.put(item)
+            batch_update.main_loop(MODE, connection)
+            self.assertEqual((store.load(), store.committed_until()), ({"_data": 1}, 10.5))
+
+            client = mock.MagicMock()
+            with mock.patch.object(batch_update_module, "get_client", return_value=client):
+                BatchUpdate(config, streaming=True, token_store=store)
+            collection = client["transformed"]["test"]
+            collection.drop.assert_not_called()
+            # b is replayed after the token
+            collection.delete_many.assert_called_once_with({"timestamp": {"$gt": 10.5}})
+
+    def test_producer_stalls(self):
+        batch_update = make_batch_update({})
+        connection = StallingQueue([pieces([1.0, 1.04], "a"), StallingQueue.STALL, StallingQueue.STALL,
+                                    pieces([2.0], "b"), None])
+        batch_update.main_loop(MODE, connection)
+        self.assertEqual(sorted(batch_update._collection.written), [1.0, 1.04, 2.0])
+
+    def test_no_checkpoint_after_failed_write(self):
+        batch_update = make_batch_update({"checkpoint_interval": 0})
+        batch_update._collection = FakeCollection(failing=[2.0])
+        batch_update.manifest = FakeManifest()
+        connection = queue.Queue()
+        for item in [pieces([1.0, 1.04], "a"), pieces([2.0], "b"), pieces([3.0], "c"), pieces([4.0], "d"), None]:
+            connection.put(item)
+        with self.assertRaises(RuntimeError):
+            batch_update.main_loop(MODE, connection)
+        self.assertEqual(batch_update.manifest.committed, [2.0]) # not past the failed timestamp 2.0
+        self.assertEqual(batch_update._collection.written, [1.0, 1.04, 3.0, 4.0])
+
+    def test_resume_drops_written_timestamps(self):
+        batch_update = make_batch_update({"resume_from": 2.0})
+        connection = queue.Queue()
+        for item in [pieces([1.96, 2.0], "a"), pieces([2.0, 2.04], "b"), None]:
+            connection.put(item)
+        batch_update.main_loop(MODE, connection)
+        self.assertEqual(sorted(batch_update._collection.written), [2.0, 2.04])
+
+
+class JobManifestTest(unittest.TestCase):
+
+    def test_resumable(self):
+        manifest = JobManifest(FakeJobs(), "test")
+        params = {"transform": "transform2", "chunk_size": 50}
+        self.assertIsNone(manifest.resumable(params))
+        manifest.start(params, grid={"start": 0, "end": 100})
+        manifest.commit_chunk("eb", 0)
+        manifest.commit_chunk("eb", 0)
+        manifest.commit_until(20.0)
+        manifest.commit_until(10.0)
+        job = manifest.resumable(params)
+        self.assertEqual((job["grid"], job["committed_until"]), ({"start": 0, "end": 100}, 20.0))
+        self.assertEqual(manifest.committed_chunks("eb"), {0})
+        self.assertIsNone(manifest.resumable(dict(params, chunk_size=10))) # other parameters start over
+        manifest.complete()
+        self.assertIsNone(manifest.resumable(params))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+from src.i24_database_api import transform2
+from src.i24_database_api.transform2 import batch_write, update_command
+from unittest import mock
+import queue
+import unittest
+
+CONFIG = {"host": None, "port": None, "username": None, "password": None, "write_database_name": "transformed",
+          "write_collection_name": "test", "job_id": "test"}
+
+
+class FakeCollection:
+    def __init__(self):
+        self.written = [] # timestamps
+        self.chunks = {} # __JOBS__: direction: committed chunks
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def bulk_write(self, requests, ordered=True):
+        self.written.extend(request._filter["timestamp"] for request in requests)
+
+    def with_options(self, **kwargs):
+        return self
+
+    def update_one(self, query_filter, update, upsert=False):
+        for key, chunk in update.get("$addToSet", {}).items():
+            self.chunks.setdefault(key.split(".")[1], set()).add(chunk)
+
+
+class CrashingQueue(queue.Queue):
+    '''
+    the writer that gets from it fails once it is empty
+    '''
+    def get(self, block=True, timeout=None):
+        if self.empty():
+            raise RuntimeError("writer crashed")
+        return super().get(block, timeout)
+
+
+class BatchWriteTest(unittest.TestCase):
+
+    def test_restart_in_the_middle_of_a_chunk(self):
+        collection = FakeCollection()
+        client = mock.MagicMock()
+        client.__getitem__.return_value.__getitem__.return_value = collection
+        first, second = CrashingQueue(), queue.Queue()
+        for cmd in [("chunk", "eb", 0), update_command("eb", 0.04, {"a": [1]})]:
+            first.put(cmd)
+        for cmd in [update_command("eb", 0.08, {"a": [1]}), ("commit", "eb", 0, 0.08),
+                    ("chunk", "eb", 1), update_command("eb", 1.04, {"b": [1]}), ("commit", "eb", 1, 1.04), None]:
+            second.put(cmd)
+        with mock.patch.object(transform2, "get_client", return_value=client):
+            with self.assertRaises(RuntimeError):
+                batch_write(CONFIG, first)
+            batch_write(CONFIG, second) # returns at the None
+        # the commands of chunk 0 that the first writer held are lost, so only chunk 1 is committed
+        self.assertEqual(collection.chunks, {"eb": {1}})
+        self.assertEqual(collection.written, [0.08, 1.04])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+from src.i24_database_api import DBClient
+from src.i24_database_api.bulk_copy import copy_raw, export_raw, iter_raw_batches, range_filter
+from bson.raw_bson import RawBSONDocument
+import bson
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+
+class RawCollection:
+    '''
+    documents in memory, read back as RawBSONDocument like with RAW_CODEC_OPTIONS, inserts are recorded
+    '''
+    def __init__(self, docs=(), name="col", insert_delay=0):
+        self.docs = list(docs)
+        self.name = name
+        self.insert_delay = insert_delay
+        self.inserted = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def with_options(self, codec_options=None):
+        return self
+
+    def find(self, query_filter, batch_size=0):
+        bounds = query_filter.get("first_timestamp", {})
+        return iter(RawBSONDocument(bson.encode(doc)) for doc in self.docs
+                    if bounds.get("$gte", -1e20) <= doc["first_timestamp"] < bounds.get("$lt", 1e20))
+
+    def insert_many(self, docs, ordered=True, bypass_document_validation=False):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.insert_delay)
+        with self.lock:
+            self.active -= 1
+            self.inserted.append([bson.decode(doc.raw) for doc in docs])
+
+
+def make_docs(n):
+    return [{"_id": i, "first_timestamp": float(i), "x_position": [1.0, 2.0]} for i in range(n)]
+
+
+class BulkCopyTest(unittest.TestCase):
+
+    def test_batches(self):
+        batches = list(iter_raw_batches(RawCollection(make_docs(25)), batch_size=10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertTrue(all(isinstance(doc, RawBSONDocument) for batch in batches for doc in batch))
+
+    def test_copy_threads(self):
+        to_collection = RawCollection(insert_delay=0.02)
+        count = copy_raw(RawCollection(make_docs(100)), to_collection, batch_size=10, num_threads=3)
+        self.assertEqual(count, 100)
+        self.assertEqual(sorted(doc["_id"] for batch in to_collection.inserted for doc in batch), list(range(100)))
+        self.assertEqual(to_collection.max_active, 3) # batches are written concurrently, by at most num_threads
+
+    def test_export(self):
+        docs = make_docs(25)
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, "col.bson")
+            self.assertEqual(export_raw(RawCollection(docs), file_path, batch_size=10), 25)
+            with open(file_path, "rb") as f:
+                self.assertEqual(list(bson.decode_file_iter(f)), docs)
+
+    def test_range_filter(self):
+        self.assertEqual(range_filter({"direction": 1}, (10, None)), {"direction": 1, "first_timestamp": {"$gte": 10}})
+        self.assertEqual(range_filter(None, None), {})
+
+
+class DBClientCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dbc = DBClient(database_name="reconciled", collection_name="col") # lazy, nothing is sent to the server
+        self.source = RawCollection(make_docs(30))
+        self.target = RawCollection()
+        self.dbc.db = {"col": self.source}
+        self.dbc.client = {"stitched": {"col": self.target}}
+        self.dbc.collection = self.source
+        self.dbc._ready = True
+
+    def test_copy_collection(self):
+        count = self.dbc.copy_collection("stitched", first_timestamp_range=(10, 20), batch_size=4)
+        self.assertEqual(count, 10)
+        self.assertEqual(sorted(doc["_id"] for batch in self.target.inserted for doc in batch), list(range(10, 20)))
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, "col.bson")
+            self.assertEqual(self.dbc.export(file_path, first_timestamp_range=(None, 5)), 5)
+            with open(file_path, "rb") as f:
+                self.assertEqual([doc["_id"] for doc in bson.decode_file_iter(f)], list(range(5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+from src.i24_database_api.change_stream_reader import consume_change_stream, FileTokenStore, RESUME_TOKEN
+from pymongo.errors import AutoReconnect, OperationFailure
+import os
+import tempfile
+import threading
+import unittest
+
+
+class FakeStream:
+    '''
+    change stream over events[start:], fails with AutoReconnect after fail_after events
+    '''
+    def __init__(self, events, start, fail_after):
+        self.events, self.pos, self.fail_after = events, start, fail_after
+        self.resume_token = None
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.alive = False
+
+    def try_next(self):
+        if self.fail_after == 0:
+            raise AutoReconnect("connection lost")
+        if self.pos == len(self.events): # end of the test stream
+            self.alive = False
+            return None
+        self.fail_after -= 1
+        self.pos += 1
+        self.resume_token = {"_data": self.pos}
+        return {"fullDocument": self.events[self.pos-1]}
+
+
+class FakeCollection:
+    def __init__(self, events, failures):
+        self.events, self.failures = events, list(failures)
+        self.resumed_from = []
+
+    def watch(self, pipeline=None, resume_after=None, **kwargs):
+        self.resumed_from.append(resume_after)
+        if not self.failures:
+            raise OperationFailure("stop test", code=286)
+        start = resume_after["_data"] if resume_after else 0
+        return FakeStream(self.events, start, self.failures.pop(0))
+
+
+class ChangeStreamTest(unittest.TestCase):
+
+    def test_resume_after_failures(self):
+        events = [{"_id": i} for i in range(10)]
+        collection = FakeCollection(events, [4, 0, 3, 100])
+        with tempfile.TemporaryDirectory() as tmp:
+            store = FileTokenStore(os.path.join(tmp, "token.json"))
+            batches = []
+            with self.assertRaises(OperationFailure): # history lost is not retried
+                consume_change_stream(collection, batches.append, token_store=store, batch_size=3,
+                                      initial_backoff=0, stop=threading.Event())
+            self.assertEqual([doc["_id"] for batch in batches for doc in batch], list(range(10)))
+            self.assertEqual(store.load(), {"_data": 10})
+        # the partial batch of a failed stream is not forwarded nor checkpointed, it is read again
+        self.assertEqual(collection.resumed_from, [None, {"_data": 3}, {"_data": 3}, {"_data": 6}, {"_data": 10}])
+
+    def test_forward_tokens(self):
+        collection = FakeCollection([{"_id": i} for i in range(5)], [100])
+        with tempfile.TemporaryDirectory() as tmp:
+            store = FileTokenStore(os.path.join(tmp, "token.json"))
+            items = []
+            with self.assertRaises(OperationFailure):
+                consume_change_stream(collection, items.append, token_store=store, batch_size=3, forward_tokens=True)
+            self.assertIsNone(store.load()) # saved downstream
+        self.assertEqual(items, [[{"_id": 0}, {"_id": 1}, {"_id": 2}], {"kind": RESUME_TOKEN, "token": {"_data": 3}},
+                                 [{"_id": 3}, {"_id": 4}], {"kind": RESUME_TOKEN, "token": {"_data": 5}}])
+
+    def test_max_retries(self):
+        collection = FakeCollection([{"_id": 0}], [0, 0, 0])
+        with self.assertRaises(AutoReconnect):
+            consume_change_stream(collection, [].append, initial_backoff=0, max_retries=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
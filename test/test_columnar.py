@@ -0,0 +1,38 @@
+from src.i24_database_api.columnar import decode_columnar, split
+from bson.objectid import ObjectId
+import bson
+import numpy as np
+import unittest
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def test_matches_bson_decode(self):
+        '''
+        arrays across the 1, 2 and 3 digit key boundaries, non-double arrays and missing fields
+        '''
+        rng = np.random.default_rng(0)
+        docs = []
+        for i, n in enumerate([0, 1, 10, 11, 100, 101, 1500]):
+            docs.append({"_id": ObjectId(), "first_timestamp": float(i), "direction": 1, "compute_node_id": "videonode1",
+                         "timestamp": list(rng.uniform(size=n)), "x_position": list(rng.uniform(size=n))})
+        docs[1]["x_position"] = [1, None]
+        docs[2].pop("direction")
+        docs[3].pop("x_position")
+        result = decode_columnar([bson.encode(doc) for doc in docs])
+
+        self.assertEqual(result["_id"], [doc["_id"] for doc in docs])
+        self.assertEqual(result["compute_node_id"], ["videonode1"] * len(docs))
+        np.testing.assert_array_equal(result["direction"], [1, 1, np.nan, 1, 1, 1, 1])
+        for doc, timestamp, x in zip(docs, split(result, "timestamp"), split(result, "x_position")):
+            np.testing.assert_array_equal(timestamp, doc["timestamp"])
+            np.testing.assert_array_equal(x, [np.nan if val is None else val for val in doc.get("x_position", [])])
+
+    def test_empty(self):
+        result = decode_columnar([], fields=["_id", "x_position"])
+        self.assertEqual(len(result["x_position"]), 0)
+        self.assertEqual(split(result, "x_position"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+from src.i24_database_api import connections, db_writer
+from src.i24_database_api.db_writer import DBWriter
+from unittest import mock
+import unittest
+import warnings
+
+
+class ConnectionRegistryTest(unittest.TestCase):
+
+    def tearDown(self):
+        connections.close_all()
+
+    def test_shared_per_parameters(self):
+        client = connections.get_client("localhost", 27017, maxIdleTimeMS=None)
+        self.assertIs(connections.get_client("localhost", 27017), client)
+        self.assertIsNot(connections.get_client("localhost", 27017, maxPoolSize=5), client)
+        self.assertIsNot(connections.get_client("localhost", 27018), client)
+        self.assertEqual(connections.num_clients(), 3)
+        connections.close_all()
+        self.assertEqual(connections.num_clients(), 0)
+        self.assertIsNot(connections.get_client("localhost", 27017), client)
+
+
+
+class LazyWriterTest(unittest.TestCase):
+
+    def test_setup_on_first_use(self):
+        client = mock.MagicMock()
+        params = {"default_host": "localhost", "default_port": 27017, "default_username": None,
+                  "default_password": None, "db_name": "test_db", "server_id": 1, "session_config_id": 1}
+        with mock.patch.object(db_writer, "get_client", return_value=client):
+            dbw = DBWriter(params, collection_name="test_col")
+        client.admin.command.assert_not_called() # nothing is sent on construction
+        db = client["test_db"]
+        db.command.assert_not_called()
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            dbw.count()
+            dbw.count()
+        client.admin.command.assert_called_once_with("ping")
+        db.command.assert_called_once_with("collMod", "test_col", validator={})
+
+
+if __name__ == '__main__':
+    unittest.main()
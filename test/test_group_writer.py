@@ -0,0 +1,58 @@
+from src.i24_database_api.group_writer import GroupCommitWriter, DOCUMENT_VALIDATION_FAILURE
+from pymongo.errors import BulkWriteError
+import threading
+import unittest
+import warnings
+
+
+class ValidatingCollection:
+    '''
+    records insert_many calls, and rejects documents with "invalid" unless validation is bypassed
+    '''
+    full_name = "db.col"
+
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def insert_many(self, documents, ordered=True, bypass_document_validation=False):
+        errors = [{"index": i, "code": DOCUMENT_VALIDATION_FAILURE, "errmsg": "Document failed validation"}
+                  for i, doc in enumerate(documents) if doc.get("invalid") and not bypass_document_validation]
+        with self.lock:
+            self.batches.append([doc for i, doc in enumerate(documents) if i not in {err["index"] for err in errors}])
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+    def inserted(self):
+        return [doc for batch in self.batches for doc in batch]
+
+
+class GroupCommitWriterTest(unittest.TestCase):
+
+    def test_batches_and_schema_fallback(self):
+        col = ValidatingCollection()
+        writer = GroupCommitWriter(max_batch=100, max_delay_ms=200, max_queue=50)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for i in range(1000):
+                writer.submit(col, {"i": i, "invalid": i % 100 == 0})
+            self.assertTrue(writer.flush(timeout=10))
+        self.assertEqual(sorted(doc["i"] for doc in col.inserted()), list(range(1000)))
+        self.assertLess(len(col.batches), 100, "Documents are not grouped")
+        self.assertEqual(writer.stats()["completed"], 1000)
+
+    def test_close_waits_for_pending(self):
+        col = ValidatingCollection()
+        writer = GroupCommitWriter(max_batch=10, max_delay_ms=1000, num_flushers=2)
+        for i in range(25):
+            writer.submit(col, {"i": i})
+        self.assertTrue(writer.close(timeout=10))
+        self.assertEqual(len(col.inserted()), 25)
+        self.assertEqual(writer.pending, 0)
+        self.assertFalse(any(t.is_alive() for t in writer._flushers))
+        with self.assertRaises(RuntimeError):
+            writer.submit(col, {"i": 25})
+
+
+if __name__ == '__main__':
+    unittest.main()
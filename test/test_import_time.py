@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ["pandas", "numpy", "multiprocessing.managers", "motor", # loaded by the transform engines only
+                 "src.i24_database_api.transform2", "src.i24_database_api.transformation",
+                 "src.i24_database_api.batch_update", "src.i24_database_api.resample", "src.i24_database_api.columnar",
+                 "src.i24_database_api.async_client"]
+
+
+def run(code):
+    return subprocess.check_output([sys.executable, "-c", code], cwd=TEST_DIR).decode().strip()
+
+
+class ImportTimeTest(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        loaded = run("import sys, src.i24_database_api; print([m for m in {} if m in sys.modules])".format(HEAVY_MODULES))
+        self.assertEqual(loaded, "[]")
+
+    def test_aggregation_without_pandas(self):
+        loaded = run("import sys, src.i24_database_api.aggregation; print([m for m in ['pandas', 'src.i24_database_api.transform2'] if m in sys.modules])")
+        self.assertEqual(loaded, "[]")
+
+    def test_lazy_names(self):
+        self.assertEqual(run("from src.i24_database_api import TRANSPORTS, split; print(split.__module__)"),
+                         "src.i24_database_api.columnar")
+
+
+if __name__ == '__main__':
+    unittest.main()
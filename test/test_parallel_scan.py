@@ -0,0 +1,48 @@
+from src.i24_database_api import DBClient
+import unittest
+
+OPS = {"$gt": lambda a, b: a > b, "$gte": lambda a, b: a >= b, "$lt": lambda a, b: a < b, "$lte": lambda a, b: a <= b}
+
+
+class FakeCollection:
+    '''
+    documents in memory, find supports range filters on a single field
+    '''
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find_one(self, sort=None):
+        (field, direction), = sort
+        docs = sorted(self.docs, key=lambda doc: doc[field], reverse=direction < 0)
+        return docs[0] if docs else None
+
+    def find(self, query_filter, projection=None, sort=None, batch_size=0):
+        docs = [doc for doc in self.docs if all(OPS[op](doc[field], val) for field, cond in query_filter.items()
+                                                for op, val in cond.items())]
+        return sorted(docs, key=lambda doc: doc[sort[0][0]]) if sort else docs
+
+
+def make_client(docs):
+    dbc = DBClient(database_name="test_db", collection_name="test_col") # lazy, nothing is sent to the server
+    dbc._ready = True
+    dbc.collection = FakeCollection(docs)
+    return dbc
+
+
+class ParallelScanTest(unittest.TestCase):
+
+    def test_empty_collection(self):
+        self.assertEqual(list(make_client([]).parallel_scan("first_timestamp")), [])
+
+    def test_scan(self):
+        docs = [{"_id": i, "first_timestamp": (i * 7) % 50 / 2} for i in range(50)]
+        dbc = make_client(docs)
+        ordered = list(dbc.parallel_scan("first_timestamp", num_partitions=3, batch_size=4))
+        self.assertEqual(ordered, sorted(docs, key=lambda doc: doc["first_timestamp"]))
+        unordered = list(dbc.parallel_scan("first_timestamp", start=5, num_partitions=3, ordered=False))
+        self.assertEqual(sorted(doc["_id"] for doc in unordered),
+                         sorted(doc["_id"] for doc in docs if doc["first_timestamp"] >= 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+from src.i24_database_api.projections import PROJECTIONS, register_projection, resolve_projection
+import unittest
+
+
+class ProjectionsTest(unittest.TestCase):
+
+    def test_preset(self):
+        self.assertEqual(resolve_projection("bounds"), PROJECTIONS["bounds"])
+        self.assertIn("x_position", resolve_projection("positions"))
+        self.assertIsNone(resolve_projection("full"))
+
+    def test_passthrough(self):
+        projection = {"_id": 1, "timestamp": 1}
+        self.assertIs(resolve_projection(projection), projection)
+        self.assertEqual(resolve_projection(["timestamp"]), ["timestamp"])
+        self.assertIsNone(resolve_projection(None))
+
+    def test_unknown_name(self):
+        with self.assertRaises(ValueError):
+            resolve_projection("no_such_projection")
+
+    def test_register(self):
+        register_projection("test_ids", {"_id": 1})
+        try:
+            self.assertEqual(resolve_projection("test_ids"), {"_id": 1})
+        finally:
+            del PROJECTIONS["test_ids"]
+
+
+if __name__ == '__main__':
+    unittest.main()
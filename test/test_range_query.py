@@ -0,0 +1,93 @@
+from src.i24_database_api.range_query import range_windows, window_filter, edge_windows, RangeQuery, histogram_edges
+from src.i24_database_api import DBReadRangeIterator
+import threading
+import time
+import unittest
+
+
+class SlowReader:
+    '''
+    read_query of a DBClient on documents {"t": 0}, ..., {"t": 99}, the first windows take the longest
+    '''
+    def __init__(self):
+        self.filters = []
+
+    def read_query(self, query_filter, query_sort=None, **options):
+        self.filters.append(query_filter)
+        bounds = query_filter["t"]
+        time.sleep(max(0, 0.05 - bounds.get("$gte", 0) * 0.001))
+        return iter([t for t in range(100) if bounds.get("$gte", -1) <= t < bounds.get("$lt", 1000)])
+
+
+def range_iterator(start, stop, increment, prefetch):
+    options = {"limit": 0, "projection": None, "batch_size": 0, "hint": None, "max_time_ms": None, "columnar": False}
+    return DBReadRangeIterator(SlowReader(), RangeQuery("t", start, stop, True, False, increment, None, {}, None,
+                                                        options, prefetch))
+
+
+class RangeQueryTest(unittest.TestCase):
+
+    def test_windows(self):
+        windows = list(range_windows(0, 25, 10, start_closed=False, stop_closed=True))
+        self.assertEqual(windows, [(0, None, 10, None), (None, 10, 20, None), (None, 20, None, 25)])
+
+    def test_windows_stop_at_stop(self):
+        windows = list(range_windows(0, 1, 0.1))
+        self.assertEqual(len(windows), 10) # no empty window left by float drift
+        self.assertEqual(windows[-1][2], 1)
+        self.assertEqual(list(range_windows(0, 20, 10)), [(None, 0, 10, None), (None, 10, 20, None)])
+
+    def test_edge_windows(self):
+        windows = list(edge_windows(0, 25, [3, 4], start_closed=True, stop_closed=True))
+        self.assertEqual(windows, [(None, 0, 3, None), (None, 3, 4, None), (None, 4, None, 25)])
+        self.assertEqual(list(edge_windows(0, 25, [], start_closed=False)), [(0, None, 25, None)])
+
+    def test_range_query_windows(self):
+        spec = RangeQuery("first_timestamp", 0, 25, True, False, 10, None, {}, None, {}, 0)
+        self.assertEqual(list(spec.iter_windows()), list(spec.iter_windows())) # every iteration starts over
+        self.assertEqual(len(list(spec.iter_windows())), 3)
+
+    def test_window_filter(self):
+        query_filter = {"direction": 1}
+        self.assertEqual(window_filter("first_timestamp", (None, 0, 10, None), query_filter),
+                         {"direction": 1, "first_timestamp": {"$gte": 0, "$lt": 10}})
+        self.assertEqual(query_filter, {"direction": 1})
+
+    def test_histogram_sample_first(self):
+        class FakeCollection:
+            def __init__(self, total):
+                self.total, self.pipelines = total, []
+            def estimated_document_count(self):
+                return self.total
+            def aggregate(self, pipeline):
+                self.pipelines.append(pipeline)
+                return []
+        large = FakeCollection(10**7)
+        histogram_edges(large, "first_timestamp", 0, 10, 4, sample_size=1000, count=10**6)
+        self.assertEqual(large.pipelines[0][0], {"$sample": {"size": 10000}}) # random cursor, ~1000 match
+        small = FakeCollection(10**4)
+        histogram_edges(small, "first_timestamp", 0, 10, 4, sample_size=1000, count=5000)
+        self.assertIn("$match", small.pipelines[0][0])
+        self.assertEqual(small.pipelines[0][2], {"$sample": {"size": 1000}})
+
+
+
+class RangeIteratorTest(unittest.TestCase):
+
+    def test_prefetch_order(self):
+        windows = [list(window) for window in range_iterator(0, 100, 10, prefetch=4)]
+        self.assertEqual(windows, [list(range(s, s+10)) for s in range(0, 100, 10)])
+
+    def test_close(self):
+        threads = threading.active_count()
+        with range_iterator(0, 100, 10, prefetch=4) as windows:
+            self.assertEqual(list(next(windows)), list(range(10)))
+        self.assertIsNone(windows._executor)
+        self.assertRaises(StopIteration, next, windows)
+        time.sleep(0.2) # the windows that were being read finish
+        self.assertEqual(threading.active_count(), threads)
+        self.assertLess(len(windows._reader.filters), 10) # the rest is not read
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+from src.i24_database_api.transform2 import resample_pandas, resample_numpy, resample_numpy_batch
+from src.i24_database_api.transformation import resample_cars
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import unittest
+
+
+def make_traj(rng, t0, n, gap=False, length_type="list"):
+    '''
+    a synthetic trajectory document with jittered timestamps around 30Hz
+    '''
+    timestamp = t0 + np.cumsum(rng.uniform(0.02, 0.045, n))
+    if gap: # drop a chunk in the middle to create missing bins
+        timestamp = np.concatenate([timestamp[:n//3], timestamp[2*n//3:]+2.5])
+    m = len(timestamp)
+    x = 1000 + np.cumsum(rng.uniform(0.5, 1.5, m))
+    y = rng.normal(12, 0.3, m)
+    if length_type == "float":
+        length, width = 15.2, 6.1
+    elif length_type == "single":
+        length, width = [15.2], [6.1]
+    else:
+        length, width = list(rng.normal(15, 0.1, m)), list(rng.normal(6, 0.1, m))
+    return {"_id": "traj", "timestamp": list(timestamp), "x_position": list(x), "y_position": list(y),
+            "length": length, "width": width, "compute_node_id": "videonode1", "coarse_vehicle_class": 1}
+
+
+class ResampleTest(unittest.TestCase):
+
+    def assert_parity(self, traj, dir, interpolate):
+        t_pd, rows_pd = resample_pandas(dict(traj), dir, interpolate)
+        t_np, rows_np = resample_numpy(dict(traj), dir, interpolate)
+        self.assertEqual(len(t_pd), len(t_np), "Number of resampled timestamps differ")
+        np.testing.assert_array_equal(t_pd, t_np)
+        for row_pd, row_np in zip(rows_pd, rows_np):
+            np.testing.assert_allclose(row_pd[:4] + row_pd[5:7], row_np[:4] + row_np[5:7], rtol=1e-12, equal_nan=True)
+            self.assertEqual(row_pd[4], row_np[4])
+            self.assertEqual(row_pd[7:], row_np[7:])
+
+    def test_parity_epoch_timestamps(self):
+        '''
+        unix epoch timestamps, where float to nanoseconds conversion matters
+        '''
+        rng = np.random.default_rng(0)
+        for i in range(20):
+            traj = make_traj(rng, 1.668e9 + rng.uniform(0, 3600), int(rng.integers(5, 300)))
+            for dir in [1, -1]:
+                self.assert_parity(traj, dir, interpolate=False)
+                self.assert_parity(traj, dir, interpolate=True)
+
+    def test_parity_with_gaps(self):
+        '''
+        missing bins are left as nans, or filled if interpolate=True
+        '''
+        rng = np.random.default_rng(1)
+        for length_type in ["list", "float", "single"]:
+            traj = make_traj(rng, 1.668e9, 200, gap=True, length_type=length_type)
+            self.assert_parity(traj, 1, interpolate=False)
+            self.assert_parity(traj, 1, interpolate=True)
+
+        t_np, rows_np = resample_numpy(traj, 1, False)
+        self.assertTrue(np.isnan(np.array([row[0] for row in rows_np])).any(), "Gap is not left blank")
+
+    def test_parity_with_velocity(self):
+        rng = np.random.default_rng(2)
+        traj = make_traj(rng, 1.668e9, 100)
+        traj["velocity"] = list(rng.normal(30, 1, len(traj["timestamp"])))
+        self.assert_parity(traj, -1, interpolate=True)
+
+    def test_batch_matches_single(self):
+        '''
+        resampling a chunk of trajectories together gives the same result as one at a time
+        '''
+        rng = np.random.default_rng(3)
+        trajs = [make_traj(rng, 1.668e9 + rng.uniform(0, 60), int(rng.integers(3, 50)), gap=bool(i%2))
+                 for i in range(50)]
+        for interpolate in [False, True]:
+            batch = resample_numpy_batch(trajs, 1, interpolate)
+            for traj, (t_batch, rows_batch) in zip(trajs, batch):
+                t_pd, rows_pd = resample_pandas(traj, 1, interpolate)
+                np.testing.assert_array_equal(t_batch, t_pd)
+                np.testing.assert_allclose([row[:7] for row in rows_batch], [row[:7] for row in rows_pd],
+                                           rtol=1e-12, equal_nan=True)
+
+    def test_transformation_resample_parity(self):
+        '''
+        resample_cars against the pandas groupby(floor) + interpolate implementation in transformation
+        '''
+        rng = np.random.default_rng(4)
+        cars = []
+        for i in range(10):
+            traj = make_traj(rng, 1.668e9 + rng.uniform(0, 60), 100, gap=True)
+            traj["height"] = list(rng.normal(5, 0.1, len(traj["timestamp"])))
+            cars.append(traj)
+        expected = []
+        for car in cars:
+            df = pd.DataFrame({key: car[key] for key in ["timestamp", "x_position", "y_position", "length", "width", "height"]})
+            df = df.set_index(pd.to_timedelta(df["timestamp"], unit='s')).drop(columns = "timestamp")
+            df = df.groupby(df.index.floor('0.04S')).mean().resample('0.04S').asfreq()
+            df.index = df.index.values.astype('datetime64[ns]').astype('int64')*1e-9
+            expected.append(df.interpolate(method='linear'))
+
+        resampled = resample_cars([dict(car) for car in cars], SimpleNamespace(value="RAW"))
+        for car, df in zip(resampled, expected):
+            np.testing.assert_array_equal(car["timestamp"], df.index.values)
+            for key in ["x_position", "y_position", "length", "width", "height"]:
+                np.testing.assert_allclose(car[key], df[key].values, rtol=1e-12)
+
+    def test_transformation_resample_malformed_car(self):
+        '''
+        a car that fails to resample is left as is, the others in its batch are resampled
+        '''
+        rng = np.random.default_rng(5)
+        cars = [make_traj(rng, 1.668e9 + rng.uniform(0, 60), 100) for _ in range(5)]
+        bad = dict(cars[2], x_position=cars[2]["x_position"][:10]) # mismatched length
+        cars[2] = bad
+        raw = [dict(car) for car in cars]
+        resampled = resample_cars(cars, SimpleNamespace(value="RECONCILED"))
+        self.assertIs(resampled[2]["timestamp"], raw[2]["timestamp"])
+        for i in [0, 1, 3, 4]:
+            expected = resample_cars([raw[i]], SimpleNamespace(value="RECONCILED"))[0]
+            np.testing.assert_array_equal(resampled[i]["timestamp"], expected["timestamp"])
+            np.testing.assert_allclose(resampled[i]["x_position"], expected["x_position"], rtol=1e-12)
+            self.assertEqual(len(resampled[i]["timestamp"]), len(resampled[i]["x_position"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
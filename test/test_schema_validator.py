@@ -0,0 +1,51 @@
+from src.i24_database_api.schema_validator import compile_schema, flag_violations
+import json
+import os
+import unittest
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "reconciled_schema.json")
+
+
+class SchemaValidatorTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(SCHEMA_FILE) as f:
+            self.validate = compile_schema(json.load(f))
+
+    def test_valid_document(self):
+        doc = {"configuration_id": 1, "timestamp": [0.0, 0.04], "x_position": [1.0, 2.0], "y_position": [3.0, 4.0],
+               "first_timestamp": 0.0, "road_segment_ids": [1, 2]}
+        self.assertEqual(self.validate(doc), [])
+        self.assertEqual(flag_violations(self.validate, doc), [])
+        self.assertNotIn("flags", doc)
+
+    def test_violations_are_flagged(self):
+        doc = {"configuration_id": 1.5, "timestamp": [0.0, 1], "x_position": [1.0, 2.0], "flags": ["fragment"],
+               "road_segment_ids": [1, True]}
+        errors = flag_violations(self.validate, doc)
+        self.assertEqual(len(errors), 4) # configuration_id, timestamp items, road_segment_ids items, missing y_position
+        self.assertEqual(doc["flags"][0], "fragment")
+        self.assertEqual(len(doc["flags"]), 5)
+        self.assertTrue(any("timestamp.items" in err for err in errors))
+
+    def test_int_range(self):
+        validate = compile_schema({"bsonType": "array", "items": {"bsonType": "int"}})
+        self.assertEqual(validate([1, 2**31-1]), [])
+        self.assertEqual(len(validate([1, 2**31])), 1) # encoded as long
+
+    def test_subclasses(self):
+        import numpy as np
+        from bson.int64 import Int64
+        doc = {"configuration_id": 1, "timestamp": list(np.array([0.0, 0.04])), "x_position": [np.float64(1.0), 2.0],
+               "y_position": [3.0, 4.0], "first_timestamp": np.float64(0.0), "road_segment_ids": [1, 2]}
+        self.assertEqual(self.validate(doc), [])
+        self.assertEqual(len(compile_schema({"bsonType": "int"})(Int64(1))), 1) # always a long
+        self.assertEqual(len(compile_schema({"bsonType": "number", "minimum": 0})(False)), 1)
+
+    def test_unsupported_keyword(self):
+        with self.assertRaises(ValueError):
+            compile_schema({"bsonType": "object", "patternProperties": {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+from src.i24_database_api.time_index_writer import TimeIndexWriter, TimestampAccumulator
+from src.i24_database_api.transform2 import transform_chunk
+from test_resample import make_traj
+from pymongo import UpdateOne
+import numpy as np
+import math
+import unittest
+
+
+class RecordingCollection:
+    '''
+    records the write operations of TimeIndexWriter instead of sending them to MongoDB
+    '''
+    def __init__(self):
+        self.inserted = []
+        self.updates = []
+
+    def insert_many(self, docs, ordered=True, bypass_document_validation=False):
+        self.inserted.extend(docs)
+
+    def bulk_write(self, requests, ordered=True):
+        self.updates.extend(requests)
+
+
+class TimeIndexWriterTest(unittest.TestCase):
+
+    def test_insert_once_closed_for_all_directions(self):
+        col = RecordingCollection()
+        writer = TimeIndexWriter(col, batch_size=1)
+        writer.add("eb", 1.0, {"a": [1]})
+        writer.add("wb", 1.0, {"b": [2]})
+        writer.add("eb", 2.0, {"a": [3]})
+        writer.advance("eb", 1.5)
+        self.assertEqual(col.inserted, [], "Timestamp is inserted before wb is past it")
+
+        writer.advance("wb", 1.5)
+        self.assertEqual(col.inserted, [{"timestamp": 1.0, "eb": {"a": [1]}, "wb": {"b": [2]}}])
+
+        writer.advance("eb", math.inf)
+        writer.advance("wb", math.inf)
+        self.assertEqual([doc["timestamp"] for doc in col.inserted], [1.0, 2.0])
+        self.assertEqual(col.updates, [])
+
+    def test_open_and_late_timestamps_are_upserted(self):
+        col = RecordingCollection()
+        writer = TimeIndexWriter(col, batch_size=1)
+        writer.add("eb", 1.0, {"a": [1]})
+        writer.advance("eb", 1.5)
+        writer.advance("wb", 1.5)
+        writer.add("wb", 1.0, {"b": [2]}) # late
+        writer.add("eb", 3.0, {"c": [3]}) # still open
+        writer.flush()
+        self.assertEqual(len(col.inserted), 1)
+        self.assertEqual(len(col.updates), 2)
+        self.assertTrue(all(isinstance(cmd, UpdateOne) for cmd in col.updates))
+        self.assertEqual(len(writer), 0)
+
+
+class TrajectoryCollection:
+    '''
+    find(...).sort(...) returns the trajectories, which all match the query
+    '''
+    def __init__(self, trajs):
+        self.trajs = sorted(trajs, key=lambda traj: traj["first_timestamp"])
+
+    def find(self, query):
+        return self
+
+    def sort(self, key, direction):
+        return iter(self.trajs)
+
+
+def written_pieces(col):
+    '''
+    (timestamp, id) of everything written with inserts and upserts
+    '''
+    pieces = [(doc["timestamp"], key) for doc in col.inserted for key in doc["eb"]]
+    pieces += [(cmd._filter["timestamp"], key.split(".")[1]) for cmd in col.updates for key in cmd._doc["$set"]]
+    return sorted(pieces)
+
+
+class MaxOpenTest(unittest.TestCase):
+
+    def transform(self, trajs, max_open):
+        col = RecordingCollection()
+        writer = TimeIndexWriter(col, batch_size=10, max_open=max_open)
+        max_docs = 0
+        def send(t, d):
+            nonlocal max_docs
+            writer.add("eb", round(t, 2), d)
+            max_docs = max(max_docs, len(writer._docs))
+        transform_chunk(TrajectoryCollection(trajs), "eb", 0, math.inf, send, engine="numpy", max_open=max_open)
+        writer.flush()
+        return written_pieces(col), max_docs
+
+    def test_memory_held_to_max_open(self):
+        rng = np.random.default_rng(0)
+        trajs = []
+        for i in range(10):
+            traj = make_traj(rng, 1.668e9 + rng.uniform(0, 5), 150)
+            traj.update(_id="traj{}".format(i), first_timestamp=traj["timestamp"][0], direction=1)
+            trajs.append(traj)
+        # wb never advances, so nothing closes before flush
+        expected, max_docs = self.transform(trajs, max_open=None)
+        self.assertGreater(max_docs, 100)
+        pieces, max_docs = self.transform(trajs, max_open=20)
+        self.assertLessEqual(max_docs, 20)
+        self.assertEqual(pieces, expected)
+
+
+class TimestampAccumulatorTest(unittest.TestCase):
+
+    def test_watermark_and_spill(self):
+        acc = TimestampAccumulator(max_size=3)
+        for t in [3.0, 1.0, 2.0, 5.0]:
+            acc.setdefault(t, []).append(t)
+        acc.setdefault(1.0, []).append("b")
+        self.assertEqual(acc.spill(), [(1.0, [1.0, "b"])], "Earliest timestamp is not spilled first")
+        self.assertEqual(acc.advance(3.0), [(2.0, [2.0])])
+        self.assertEqual(acc.advance(2.5), [], "Watermark moved backwards")
+        self.assertEqual([t for t, _ in acc.pop_all()], [3.0, 5.0])
+        self.assertEqual(len(acc), 0)
+        self.assertEqual(acc.num_spilled, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
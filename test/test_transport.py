@@ -0,0 +1,68 @@
+from src.i24_database_api.transport import TimestampBatcher, iter_timestamps, pack_trajectories, unpack_trajectories, SharedMemoryRing, BoundedChannel
+import numpy as np
+import queue
+import threading
+import unittest
+
+
+class TransportTest(unittest.TestCase):
+
+    pieces = [(1.0, {"a": [1.5, 2.0, 15.0, 6.0, -1, 30.0, 0.1, 1, "node1"]}),
+              (1.04, {"a": [2.5, 2.0, 15.0, 6.0, -1, 30.0, 0.1, 1, "node1"],
+                      "b": [9.5, 5.0, 20.0, 7.0, -1, 25.0, -0.2, 2, "node2"]})]
+
+    def test_timestamp_batch_round_trip(self):
+        channel = queue.Queue()
+        batcher = TimestampBatcher(channel, "wb", batch_size=100)
+        for t, d in self.pieces:
+            batcher.add(t, d)
+        self.assertTrue(channel.empty(), "Batch is sent before batch_size or flush")
+        batcher.flush()
+        self.assertEqual(channel.qsize(), 1)
+        self.assertEqual(list(iter_timestamps(channel.get())), [("wb", t, d) for t, d in self.pieces])
+
+    def test_shared_memory_ring(self):
+        ring = SharedMemoryRing(num_slots=2, slot_size=2**16)
+        try:
+            trajs = [{"_id": "a", "configuration_id": 1, "timestamp": [0.0, 0.04], "x_position": [1.0, 2.0]},
+                     {"_id": "b", "configuration_id": 1, "timestamp": [0.04], "x_position": [5.0]}]
+            ring.put(pack_trajectories(trajs, ["x_position"]))
+            ring.put(("advance", "eb", 1.0))
+            unpacked = list(unpack_trajectories(ring.get(timeout=5)))
+            self.assertEqual([traj["_id"] for traj in unpacked], ["a", "b"])
+            np.testing.assert_array_equal(unpacked[0]["x_position"], [1.0, 2.0])
+            self.assertEqual(ring.get(timeout=5), ("advance", "eb", 1.0))
+            self.assertTrue(ring.empty())
+        finally:
+            ring.close()
+
+    def test_bounded_channel_spills_in_order(self):
+        channel = BoundedChannel(queue.Queue(3), maxsize=3, backpressure="spill")
+        for i in range(10):
+            channel.put(i)
+        self.assertEqual(channel.qsize(), 3)
+        self.assertEqual(channel.num_spilled.value, 7)
+        self.assertEqual(channel.high_water_mark.value, 3)
+        received = [channel.get(), channel.get()]
+        channel.put(10) # sends spilled items first
+        received += [channel.get() for _ in range(3)]
+        self.assertEqual(received, [0, 1, 2, 3, 4])
+        rest = []
+        consumer = threading.Thread(target=lambda: rest.extend(channel.get(timeout=5) for _ in range(6)))
+        consumer.start()
+        channel.flush() # waits until the consumer took the rest
+        consumer.join()
+        self.assertEqual(rest, [5, 6, 7, 8, 9, 10])
+        self.assertTrue(channel.empty())
+
+    def test_bounded_channel_blocks(self):
+        channel = BoundedChannel(queue.Queue(2), maxsize=2)
+        channel.put(0)
+        channel.put(1)
+        with self.assertRaises(queue.Full):
+            channel.put(2, timeout=0.01)
+        self.assertEqual(channel.num_spilled.value, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()